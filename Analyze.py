@@ -4,6 +4,19 @@ from arcpy import env
 from arcpy.sa import *
 import os
 import sys
+import numpy
+import d8
+import fill
+import accumulation
+import terrain
+import streams
+import catchment
+import masks
+import zonal
+import parallel
+import datasets
+from journal import Journal
+from profiling import Profiler
 
 XLSX = True
 try:
@@ -15,6 +28,34 @@ except ImportError:
 DEBUG = True
 TEST = False
 SAVE = False
+# Use the numpy engines instead of the arcpy tools where one exists
+NUMPY = True
+# Export stream.shp, watershed.shp and boundary.shp (always on without NUMPY, whose
+# area and river length come from the vector layers)
+VECTOR = False
+# Condition the whole DEM once (cached in output\hydrology) and take every basin as the upstream
+# set of its outlet cell, instead of clipping and reprocessing the DEM of each basin
+WHOLE_DEM = False
+# Skip basins already in the results journal, False starts from an empty journal
+RESUME = True
+# Process basins in a pool of worker processes
+PARALLEL = False
+# Worker processes, None uses every core
+PROCESSES = None
+# Basins per worker before it is recycled
+TASKS_PER_CHILD = parallel.TASKS_PER_CHILD
+# Time every step of every basin into output\profile_water.jsonl and print a summary at the end
+PROFILE = True
+# Add the 10th, 50th and 90th percentiles of height, slope and TWI and the hypsometric integral,
+# from fixed-bin histograms (zonal.ZonalQuantiles, within one bin of the exact value)
+DISTRIBUTION = True
+# Add the highest Strahler order, Shreve magnitude, longest flow path and the segments and
+# stream length of every order (streams.network, one sweep over the D8 grid)
+NETWORK = True
+# Add the stream length, link count and river density at every stream threshold of THRESHOLDS,
+# all from the one flow accumulation (streams.ThresholdSweep), to study density against threshold
+SWEEP = True
+THRESHOLDS = [250, 500, 1000, 2000, 4000]
 
 ############################################################################################################
 # Set environment settings
@@ -25,6 +66,65 @@ arcpy.CheckOutExtension("3D")
 # Overwrite output
 arcpy.env.overwriteOutput = True
 
+############################################################################################################
+# Conversion between arcpy rasters and numpy arrays
+############################################################################################################
+FLOAT_NODATA = -3.4028235e+38
+
+def toNumPy(raster):
+    # float array with NoData as NaN
+    arr = arcpy.RasterToNumPyArray(raster).astype(numpy.float32)
+    if raster.noDataValue is not None:
+        arr[arr == raster.noDataValue] = numpy.nan
+    return arr
+
+def toRaster(arr, template, nodata=None):
+    # raster on the same grid and spatial reference as template
+    if nodata is None and arr.dtype.kind == "f":
+        nodata = FLOAT_NODATA
+        arr = numpy.where(numpy.isnan(arr), nodata, arr)
+    lowerLeft = arcpy.Point(template.extent.XMin, template.extent.YMin)
+    out = arcpy.NumPyArrayToRaster(arr, lowerLeft, template.meanCellWidth, template.meanCellHeight, nodata)
+    arcpy.DefineProjection_management(out, template.spatialReference)
+    return out
+
+def cellSize(raster):
+    return (raster.meanCellWidth, raster.meanCellHeight)
+
+def cellSizes(raster):
+    # per-row cell sizes in metres, geodesic for a lat/lon raster
+    return terrain.cell_sizes(cellSize(raster), raster.height, raster.extent.YMax,
+                              raster.spatialReference.type == "Geographic")
+
+def networkRecord(net, topology, direction, streamArray, sizes, outlet):
+    # NETWORK_COLUMNS of the basin draining to the flat index outlet, net its streams.network
+    cells, lengths = streams.stream_cells(direction, streamArray, sizes, topology.receivers)
+    segments, length = streams.order_totals(net.strahler, streams.link_heads(topology, streamArray),
+                                            cells, lengths)
+    out = [int(net.strahler.max()), int(net.shreve.max()), float(net.upstream.ravel()[outlet])/1000]
+    for k in range(streams.MAX_ORDER):
+        out += [int(segments[k]), float(length[k])/1000]
+    return out
+
+NETWORK_COLUMNS = ['Subbasin Strahler Order', 'Subbasin Shreve Magnitude', 'Subbasin Longest Flow Path(km)']
+for order in range(1, streams.MAX_ORDER + 1):
+    label = str(order) + ("+" if order == streams.MAX_ORDER else "")
+    NETWORK_COLUMNS += ['Order ' + label + ' Segments', 'Order ' + label + ' Stream Length(km)']
+
+def sweepRecord(sweep, area, k=1):
+    # SWEEP_COLUMNS of zone k of a streams.ThresholdSweep result, densities over the basin area in km^2
+    out = []
+    for j in range(sweep["thresholds"].size):
+        length = float(sweep["length"][k, j])/1000
+        out += [length, int(sweep["links"][k, j]), length / area if area > 0 else float("nan")]
+    return out
+
+SWEEP_COLUMNS = []
+for threshold in sorted(set(THRESHOLDS)):
+    label = ' (acc > ' + str(threshold) + ')'
+    SWEEP_COLUMNS += ['Subbasin River Length(km)' + label, 'Subbasin Stream Links' + label,
+                      'Subbasin River Density(km/km^2)' + label]
+
 # Get current path
 path = os.getcwd()
 # Set workspace
@@ -61,41 +161,47 @@ if DEBUG:
     print("Suboutput list: " + str(suboutput))
     print("Number of suboutput: " + str(len(suboutput)))
 
+profiler = Profiler(outputFolder + "\\profile_water.jsonl", PROFILE)
+
 if TEST:
     subinput = ["15243_USGS_03203600_Boundary_Line.shp", "3170000.shp"]
     suboutput = [outputFolder + "\\" + sub[:-4] for sub in subinput]
     print("test subinput: " + str(subinput))
     print("test suboutput: " + str(suboutput))
 
-# data structure for each subbasin
-subbasin = {}
-# Save output to excel
-if XLSX:
-    wb = Workbook()
-    wb.create_sheet('Sheet1', 0)
-    ws = wb.active
-    ws.cell(1,1).value = 'Subbasin Number'
-    ws.cell(1,2).value = 'Subbasin Average Height'
-    ws.cell(1,3).value = 'Subbasin Area(km^2)'
-    ws.cell(1,4).value = 'Subbasin River Length(km)'
-    ws.cell(1,5).value = 'Subbasin River Density(km/km^2)'
-    ws.cell(1,6).value = 'Subbasin River Average Slope(Degree)'
-    ws.cell(1,7).value = 'Subbasin River Average TWI'
-else:
-    f = open(outputFolder + "\\result.txt", "w")
-    f.write("Subbasin Number\tSubbasin Average Height\tSubbasin Area(km^2)\tSubbasin River Length(km)\tSubbasin River Density(km/km^2)\tSubbasin River Average Slope(Degree)\tSubbasin River Average TWI\n")
+# Save output to excel, only the parent process writes output
+def open_output():
+    global wb, ws, f
+    if XLSX:
+        wb = Workbook()
+        wb.create_sheet('Sheet1', 0)
+        ws = wb.active
+        ws.cell(1,1).value = 'Subbasin Number'
+        columns = datasets.TERRAIN_COLUMNS + extraColumns()
+        for j in range(len(columns)):
+            ws.cell(1,j+2).value = columns[j]
+    else:
+        f = open(outputFolder + "\\result.txt", "w")
+        f.write("Subbasin Number\t" + "\t".join(datasets.TERRAIN_COLUMNS + extraColumns()))
+        f.write("\n")
+
+# headers of the optional columns, in the order they are appended to a record
+def extraColumns():
+    return ((datasets.DISTRIBUTION_COLUMNS if DISTRIBUTION else []) + (NETWORK_COLUMNS if NETWORK else []) +
+            (SWEEP_COLUMNS if SWEEP else []))
 
 ############################################################################################################
 # Part1: Hydrological Analysis
 ############################################################################################################
 # Step0: Iterate through subinput
 ############################################################################################################
-# data structure for each subbasin
-result = [[] for i in range(len(subinput))]
-
-for i in range(len(subinput)):
+# Returns (i, record) with the plain values of basin i, record is None on error
+def process_subbasin(i):
+    # data structure for each subbasin
+    result = []
     try:
         print("Processing subbasin: " + subinput[i])
+        profiler.begin(subinput[i][:-4])
         # set workspace to suboutput
         env.workspace = suboutput[i]
         print("Workspace set to: " + suboutput[i])
@@ -110,199 +216,296 @@ for i in range(len(subinput)):
             print("inMaskData: " + inMaskData)
         # Execute ExtractByMask
         outExtractByMask = ExtractByMask(inRaster, inMaskData)
+        # cells of the basin's grid, for the throughput of every step
+        cells = outExtractByMask.width * outExtractByMask.height
         if SAVE:
             outExtractByMask.save(suboutput[i] + "\\dem.tif")
             if DEBUG:
                 print("ExtractByMask saved to: " + suboutput[i] + "\\dem.tif")
+        profiler.lap("extract", cells)
     ############################################################################################################
     # Step2: Fill
     ############################################################################################################
-        outFill = Fill(outExtractByMask)
+        if NUMPY:
+            demArray = toNumPy(outExtractByMask)
+            fillArray = fill.fill_depressions(demArray)
+            outFill = toRaster(fillArray, outExtractByMask)
+        else:
+            outFill = Fill(outExtractByMask)
         if SAVE:
             outFill.save(suboutput[i] + "\\fill.tif")
             if DEBUG:
                 print("Fill saved to: " + suboutput[i] + "\\fill.tif")
+        profiler.lap("fill", cells)
     ############################################################################################################
     # Step3: Flow Direction
     ############################################################################################################
-        outFlowDirection = FlowDirection(outFill, "NORMAL")
+        if NUMPY:
+            dirArray = d8.flow_direction(fillArray, cellsize=cellSize(outFill))
+            outFlowDirection = toRaster(dirArray, outFill, d8.NODATA)
+        else:
+            outFlowDirection = FlowDirection(outFill, "NORMAL")
         if SAVE:
             outFlowDirection.save(suboutput[i] + "\\dir.tif")
             if DEBUG:
                 print("FlowDirection saved to: " + suboutput[i] + "\\dir.tif")
+        profiler.lap("direction", cells)
     ############################################################################################################
     # Step4: Flow Accumulation
     ############################################################################################################
-        outFlowAccumulation = FlowAccumulation(outFlowDirection)
+        if NUMPY:
+            # topology is kept for the later passes over the same direction grid
+            accArray, topology = accumulation.flow_accumulation(dirArray)
+            outFlowAccumulation = toRaster(accArray, outFlowDirection)
+        else:
+            outFlowAccumulation = FlowAccumulation(outFlowDirection)
         if SAVE:
             outFlowAccumulation.save(suboutput[i] + "\\acc.tif")
             if DEBUG:
                 print("FlowAccumulation saved to: " + suboutput[i] + "\\acc.tif")
+        profiler.lap("accumulation", cells)
     ############################################################################################################
     # Step5: AccFlow
     ############################################################################################################
-        outAccFlow = Con(outFlowAccumulation > 1000, 1)
-        if SAVE:
-            outAccFlow.save(suboutput[i] + "\\accflow.tif")
-            if DEBUG:
-                print("AccFlow saved to: " + suboutput[i] + "\\accflow.tif")
+        # the vector layers are only needed for export, the numpy metrics are raster-native
+        vector = VECTOR or not NUMPY
+        outAccFlow = outStreamLink = outStreamToFeature = outWatershed = outRasterToPolygon = outRasterDomain = None
+        if NUMPY:
+            streamArray = streams.stream_mask(accArray, streams.THRESHOLD)
+        if vector:
+            outAccFlow = Con(outFlowAccumulation > streams.THRESHOLD, 1)
+            if SAVE:
+                outAccFlow.save(suboutput[i] + "\\accflow.tif")
+                if DEBUG:
+                    print("AccFlow saved to: " + suboutput[i] + "\\accflow.tif")
     ############################################################################################################
     # Step6: Stream Link
     ############################################################################################################
-        outStreamLink = StreamLink(outAccFlow, outFlowDirection)
-        if SAVE:
-            outStreamLink.save(suboutput[i] + "\\link.tif")
-            if DEBUG:
-                print("StreamLink saved to: " + suboutput[i] + "\\link.tif")
+        if vector:
+            outStreamLink = StreamLink(outAccFlow, outFlowDirection)
+            if SAVE:
+                outStreamLink.save(suboutput[i] + "\\link.tif")
+                if DEBUG:
+                    print("StreamLink saved to: " + suboutput[i] + "\\link.tif")
+        profiler.lap("stream_link", cells)
     ############################################################################################################
     # Step7: Stream to Feature
     ############################################################################################################
-        outStreamToFeature = StreamToFeature(outStreamLink, outFlowDirection, suboutput[i] + "\\stream.shp", "SIMPLIFY")
-        if DEBUG:
-            print("StreamToFeature saved to: " + suboutput[i] + "\\stream.shp")
+        if vector:
+            outStreamToFeature = StreamToFeature(outStreamLink, outFlowDirection, suboutput[i] + "\\stream.shp", "SIMPLIFY")
+            if DEBUG:
+                print("StreamToFeature saved to: " + suboutput[i] + "\\stream.shp")
+        profiler.lap("stream_to_feature", cells)
     ############################################################################################################
     # Step8: Watershed
     ############################################################################################################
-        ## TODO May there be a problem with value logcurve.
-        outWatershed = Watershed(outFlowDirection, outStreamLink)
-        if SAVE:
-            outWatershed.save(suboutput[i] + "\\watershed.tif")
-            if DEBUG:
-                print("Watershed saved to: " + suboutput[i] + "\\watershed.tif")
+        if vector:
+            ## TODO May there be a problem with value logcurve.
+            outWatershed = Watershed(outFlowDirection, outStreamLink)
+            if SAVE:
+                outWatershed.save(suboutput[i] + "\\watershed.tif")
+                if DEBUG:
+                    print("Watershed saved to: " + suboutput[i] + "\\watershed.tif")
     ############################################################################################################
     # Step9: Raster to Polygon
     ############################################################################################################
-        outRasterToPolygon = arcpy.conversion.RasterToPolygon(outWatershed, suboutput[i] + "\\watershed.shp", "NO_SIMPLIFY", "VALUE")
-        if DEBUG:
-            print("RasterToPolygon saved to: " + suboutput[i] + "\\watershed.shp")
+        if vector:
+            outRasterToPolygon = arcpy.conversion.RasterToPolygon(outWatershed, suboutput[i] + "\\watershed.shp", "NO_SIMPLIFY", "VALUE")
+            if DEBUG:
+                print("RasterToPolygon saved to: " + suboutput[i] + "\\watershed.shp")
     ############################################################################################################
     # Step10: Raster Domain
     ############################################################################################################
-        try:
-            outRasterDomain = arcpy.ddd.RasterDomain(outWatershed, suboutput[i] + "\\boundary.shp", "LINE")
-            if DEBUG:
-                print("RasterDomain saved to: " + suboutput[i] + "\\boundary.shp")
-        except:
-            print("RasterDomain failed. Most likely because the license is not available.")
+        if vector:
+            try:
+                outRasterDomain = arcpy.ddd.RasterDomain(outWatershed, suboutput[i] + "\\boundary.shp", "LINE")
+                if DEBUG:
+                    print("RasterDomain saved to: " + suboutput[i] + "\\boundary.shp")
+            except:
+                print("RasterDomain failed. Most likely because the license is not available.")
         
 
+        profiler.lap("watershed", cells)
     ############################################################################################################
     # Part2: Terrain Analysis
     ############################################################################################################
     # Step1: Average Height of Subbasin
     ############################################################################################################
-        meanHeight = arcpy.GetRasterProperties_management(outExtractByMask, "MEAN")
-        result[i].append(meanHeight)
+        meanHeight = float(arcpy.GetRasterProperties_management(outExtractByMask, "MEAN").getOutput(0))
+        result.append(meanHeight)
+        if DISTRIBUTION:
+            heightDist = zonal.distribution(demArray if NUMPY else toNumPy(outExtractByMask))
         if DEBUG:
             print("Average Height of Subbasin: " + str(meanHeight))
     ############################################################################################################
     # Step2: Area of Subbasin
     ############################################################################################################
-        # deprecated method after ArcGIS 10.6
-        # area = arcpy.management.CalculateGeometryAttributes(outRasterToPolygon, "AREA")
-        arcpy.AddField_management(outRasterToPolygon,'AREA','DOUBLE')
-        arcpy.CalculateField_management(outRasterToPolygon,'AREA','!shape.area!','PYTHON')
-        #area = arcpy.ListFields(outRasterToPolygon, "AREA")
-        #print(area[0].Value)
-        areas = arcpy.SearchCursor(outRasterToPolygon, fields="AREA")
-        area_sum = sum([area.getValue("AREA") for area in areas])/1000000
-        result[i].append(area_sum)
+        if NUMPY:
+            # cells of the basin mask times their area
+            sizes = cellSizes(outFill)
+            area_sum = streams.area(~numpy.isnan(demArray), sizes)/1000000
+        else:
+            # deprecated method after ArcGIS 10.6
+            # area = arcpy.management.CalculateGeometryAttributes(outRasterToPolygon, "AREA")
+            arcpy.AddField_management(outRasterToPolygon,'AREA','DOUBLE')
+            arcpy.CalculateField_management(outRasterToPolygon,'AREA','!shape.area!','PYTHON')
+            #area = arcpy.ListFields(outRasterToPolygon, "AREA")
+            #print(area[0].Value)
+            areas = arcpy.SearchCursor(outRasterToPolygon, fields="AREA")
+            area_sum = sum([area.getValue("AREA") for area in areas])/1000000
+        result.append(area_sum)
         if DEBUG:
             print("Area of Subbasin: " + str(area_sum))
     ############################################################################################################
     # Step3: River Length of Subbasin
     ############################################################################################################
-        arcpy.AddField_management(outStreamToFeature,'LENGTH','DOUBLE')
-        arcpy.CalculateField_management(outStreamToFeature,'LENGTH','!shape.length!','PYTHON')
-        length = arcpy.SearchCursor(outStreamToFeature, fields="LENGTH")
-        riverLength = sum([length.getValue("LENGTH") for length in length])/1000
-        result[i].append(riverLength)
+        if NUMPY:
+            # D8 steps between stream cells, 1 or sqrt(2) cell sizes each
+            riverLength = streams.stream_length(dirArray, streamArray, sizes, topology.receivers)/1000
+        else:
+            arcpy.AddField_management(outStreamToFeature,'LENGTH','DOUBLE')
+            arcpy.CalculateField_management(outStreamToFeature,'LENGTH','!shape.length!','PYTHON')
+            length = arcpy.SearchCursor(outStreamToFeature, fields="LENGTH")
+            riverLength = sum([length.getValue("LENGTH") for length in length])/1000
+        result.append(riverLength)
         if DEBUG:
             print("River Length of Subbasin: " + str(riverLength))
     ############################################################################################################
     # Step4: River Density of Subbasin
     ############################################################################################################
         riverDensity = float(riverLength) / float(area_sum)
-        result[i].append(riverDensity)
+        result.append(riverDensity)
         if DEBUG:
             print("River Density of Subbasin: " + str(riverDensity))
+        profiler.lap("stats", cells)
+    ############################################################################################################
+    # Step4b: Stream orders and flow lengths of Subbasin
+    ############################################################################################################
+        if (NETWORK or SWEEP) and not NUMPY:
+            # the numpy engines on the direction grid of the arcpy tools
+            dirArray = arcpy.RasterToNumPyArray(outFlowDirection, nodata_to_value=d8.NODATA).astype(numpy.uint8)
+            accArray, topology = accumulation.flow_accumulation(dirArray)
+            streamArray = streams.stream_mask(accArray, streams.THRESHOLD)
+            sizes = cellSizes(outFill)
+        if NETWORK:
+            # the basin drains through the cell with the largest accumulation
+            outlet = int(numpy.nanargmax(accArray))
+            net = streams.network(topology, dirArray, streamArray, sizes)
+            networkResult = networkRecord(net, topology, dirArray, streamArray, sizes, outlet)
+            if DEBUG:
+                print("Stream Network of Subbasin: " + str(networkResult))
+            if SAVE:
+                # flow length down to the outlet, like FlowLength DOWNSTREAM
+                outFlowLength = toRaster(net.distance.astype(numpy.float32), outFill)
+                outFlowLength.save(suboutput[i] + "\\flow_length.tif")
+                arcpy.Delete_management(outFlowLength)
+            del net
+            profiler.lap("network", cells)
+        if SWEEP:
+            # every threshold from the accumulation at hand, no rerun of fill, direction and accumulation
+            sweepResult = sweepRecord(streams.threshold_sweep(topology, dirArray, accArray, THRESHOLDS, sizes),
+                                      area_sum)
+            if DEBUG:
+                print("Threshold Sweep of Subbasin: " + str(sweepResult))
+            profiler.lap("sweep", cells)
+        if NUMPY or NETWORK or SWEEP:
+            del streamArray
     ############################################################################################################
     # Step5: River Average Slope of Subbasin
     ############################################################################################################
-        outSlope = arcpy.ddd.Slope(outExtractByMask, "DEGREE")
-        riverSlope = arcpy.GetRasterProperties_management(outSlope, "MEAN")
-        result[i].append(riverSlope)
+        if NUMPY:
+            # raw and filled slope from one call over a shared padded buffer
+            outSlope = None
+            slopeArray, fillSlopeArray = terrain.slopes([demArray, fillArray], cellSizes(outFill))
+            riverSlope = float(numpy.nanmean(slopeArray))
+            if DISTRIBUTION:
+                slopeDist = zonal.distribution(slopeArray)
+            del slopeArray
+        else:
+            outSlope = arcpy.ddd.Slope(outExtractByMask, "DEGREE")
+            riverSlope = float(arcpy.GetRasterProperties_management(outSlope, "MEAN").getOutput(0))
+            if DISTRIBUTION:
+                slopeDist = zonal.distribution(toNumPy(outSlope))
+        result.append(riverSlope)
         if DEBUG:
             print("River Average Slope of Subbasin: " + str(riverSlope))
     ############################################################################################################
     # Step6: Average Slope of Subbasin After Fill
     ############################################################################################################
-        outFillSlope = Slope(outFill, "DEGREE")
+        if NUMPY:
+            outFillSlope = toRaster(fillSlopeArray, outFill) if SAVE else None
+            fillSlope = float(numpy.nanmean(fillSlopeArray))
+        else:
+            outFillSlope = Slope(outFill, "DEGREE")
+            fillSlope = arcpy.GetRasterProperties_management(outFillSlope, "MEAN")
         if SAVE:
             outFillSlope.save(suboutput[i] + "\\slope_fill.tif")
             if DEBUG:
                 print("FillSlope saved to: " + suboutput[i] + "\\slope_fill.tif")
-        fillSlope = arcpy.GetRasterProperties_management(outFillSlope, "MEAN")
-        # result[i].append(fillSlope)
+        # result.append(fillSlope)
         if DEBUG:
             print("Average Slope of Subbasin After Fill: " + str(fillSlope))
+        profiler.lap("slope", cells)
     ############################################################################################################
     # Step7: River Average TWI of Subbasin
     ############################################################################################################
-        Dir = outFlowDirection
-        Acc = outFlowAccumulation
-        outSCA = Con(Acc == 0,1,Acc) * 90*90 / Con( Dir == 1,90,Con(Dir == 4,90,Con(Dir == 16,90,Con(Dir == 64,90,Con(Dir == 2,90* SquareRoot(2),Con(Dir == 8,90* SquareRoot(2),Con(Dir == 32,90* SquareRoot(2),Con(Dir == 128,90* SquareRoot(2)))))))))
-        """ c = Con("dir.tif" == 128,90* SquareRoot(2))
-        d = Con("dir.tif" == 32,90* SquareRoot(2),c)
-        e = Con("dir.tif" == 8,90* SquareRoot(2),d)
-        f = Con("dir.tif" == 2,90* SquareRoot(2),e)
-        g = Con("dir.tif" == 64,90,f)
-        h = Con("dir.tif" == 16,90,g)
-        i = Con("dir.tif" == 4,90,h)
-        b = Con( "dir.tif" == 1,90,i)
-        a = Con("acc.tif" == 0,1,"acc.tif")
-        outSCA = a * 90 * 90 / b  """
-        if SAVE:
-            outSCA.save(suboutput[i] + "\\SCA.tif")
-            if DEBUG:
-                print("SCA saved to: " + suboutput[i] + "\\SCA.tif")
-        outTWI = Ln(outSCA/Tan(Con(outFillSlope<=0, 0.00001, Con(outFillSlope>0,outFillSlope*3.1415926/180))))
-        if SAVE:
-            outTWI.save(suboutput[i] + "\\TWI.tif")
-            if DEBUG:
-                print("TWI saved to: " + suboutput[i] + "\\TWI.tif")
-        riverTWI = arcpy.GetRasterProperties_management(outTWI, "MEAN")
-        result[i].append(riverTWI)
+        if NUMPY:
+            # SCA, radians, clamp and log in one chunked pass with the cell sizes of the raster
+            scaArray = numpy.empty(dirArray.shape, dtype=numpy.float32) if SAVE else None
+            twiArray = terrain.twi(dirArray, accArray, fillSlopeArray, cellSizes(outFill), sca=scaArray)
+            outSCA = outTWI = None
+            if SAVE:
+                outSCA = toRaster(scaArray, outFill)
+                outSCA.save(suboutput[i] + "\\SCA.tif")
+                outTWI = toRaster(twiArray, outFill)
+                outTWI.save(suboutput[i] + "\\TWI.tif")
+                if DEBUG:
+                    print("SCA saved to: " + suboutput[i] + "\\SCA.tif")
+                    print("TWI saved to: " + suboutput[i] + "\\TWI.tif")
+            riverTWI = float(numpy.nanmean(twiArray))
+            if DISTRIBUTION:
+                twiDist = zonal.distribution(twiArray)
+            del scaArray, twiArray, fillSlopeArray
+        else:
+            Dir = outFlowDirection
+            Acc = outFlowAccumulation
+            outSCA = Con(Acc == 0,1,Acc) * 90*90 / Con( Dir == 1,90,Con(Dir == 4,90,Con(Dir == 16,90,Con(Dir == 64,90,Con(Dir == 2,90* SquareRoot(2),Con(Dir == 8,90* SquareRoot(2),Con(Dir == 32,90* SquareRoot(2),Con(Dir == 128,90* SquareRoot(2)))))))))
+            """ c = Con("dir.tif" == 128,90* SquareRoot(2))
+            d = Con("dir.tif" == 32,90* SquareRoot(2),c)
+            e = Con("dir.tif" == 8,90* SquareRoot(2),d)
+            f = Con("dir.tif" == 2,90* SquareRoot(2),e)
+            g = Con("dir.tif" == 64,90,f)
+            h = Con("dir.tif" == 16,90,g)
+            i = Con("dir.tif" == 4,90,h)
+            b = Con( "dir.tif" == 1,90,i)
+            a = Con("acc.tif" == 0,1,"acc.tif")
+            outSCA = a * 90 * 90 / b  """
+            if SAVE:
+                outSCA.save(suboutput[i] + "\\SCA.tif")
+                if DEBUG:
+                    print("SCA saved to: " + suboutput[i] + "\\SCA.tif")
+            outTWI = Ln(outSCA/Tan(Con(outFillSlope<=0, 0.00001, Con(outFillSlope>0,outFillSlope*3.1415926/180))))
+            if SAVE:
+                outTWI.save(suboutput[i] + "\\TWI.tif")
+                if DEBUG:
+                    print("TWI saved to: " + suboutput[i] + "\\TWI.tif")
+            riverTWI = float(arcpy.GetRasterProperties_management(outTWI, "MEAN").getOutput(0))
+            if DISTRIBUTION:
+                twiDist = zonal.distribution(toNumPy(outTWI))
+        result.append(riverTWI)
         if DEBUG:
             print("River Average TWI of Subbasin: " + str(riverTWI))
+        if DISTRIBUTION:
+            # percentiles and hypsometric integral, bounded by the histogram bins
+            result.extend(datasets.distribution_record(heightDist, slopeDist, twiDist))
+            if DEBUG:
+                print("Distribution of Subbasin: " + str(result[-len(datasets.DISTRIBUTION_COLUMNS):]))
+        if NETWORK:
+            result.extend(networkResult)
+        if SWEEP:
+            result.extend(sweepResult)
 
-    ############################################################################################################
-    # Finish, save result
-    ############################################################################################################
-        if XLSX:
-            ws.cell(i+2,1).value = subinput[i][:-4]
-            ws.cell(i+2,2).value = result[i][0].getOutput(0)
-            ws.cell(i+2,3).value = result[i][1]
-            ws.cell(i+2,4).value = result[i][2]
-            ws.cell(i+2,5).value = result[i][3]
-            ws.cell(i+2,6).value = result[i][4].getOutput(0)
-            ws.cell(i+2,7).value = result[i][5].getOutput(0)
-            print("ws.cell(" + str(i+2) + ",1).value = " + subinput[i][:-4])
-            print("ws.cell(" + str(i+2) + ",2).value = " + str(result[i][0].getOutput(0)))
-            print("ws.cell(" + str(i+2) + ",3).value = " + str(result[i][1]))
-            print("ws.cell(" + str(i+2) + ",4).value = " + str(result[i][2]))
-            print("ws.cell(" + str(i+2) + ",5).value = " + str(result[i][3]))
-            print("ws.cell(" + str(i+2) + ",6).value = " + str(result[i][4].getOutput(0)))
-            print("ws.cell(" + str(i+2) + ",7).value = " + str(result[i][5].getOutput(0)))
-        else:
-            f.write(subinput[i][:-4] + "\t" + 
-                    str(result[i][0].getOutput(0)) + "\t" + 
-                    str(result[i][1]) + "\t" + 
-                    str(result[i][2]) + "\t" + 
-                    str(result[i][3]) + "\t" + 
-                    str(result[i][4].getOutput(0)) + "\t" + 
-                    str(result[i][5].getOutput(0)) + "\n")
-        
+        profiler.lap("twi", cells)
         ############################################################################################################
         # Clean up
         ############################################################################################################
@@ -312,25 +515,13 @@ for i in range(len(subinput)):
             arcpy.Delete_management(outFill)
             arcpy.Delete_management(outFlowDirection)
             arcpy.Delete_management(outFlowAccumulation)
-            arcpy.Delete_management(outAccFlow)
-            arcpy.Delete_management(outStreamLink)
-            arcpy.Delete_management(outStreamToFeature)
-            arcpy.Delete_management(outWatershed)
-            arcpy.Delete_management(outRasterToPolygon)
-            arcpy.Delete_management(outRasterDomain)
-            arcpy.Delete_management(outSlope)
-            arcpy.Delete_management(outFillSlope)
-            arcpy.Delete_management(outSCA)
-            arcpy.Delete_management(outTWI)
+            for tmp in (outAccFlow, outStreamLink, outStreamToFeature, outWatershed, outRasterToPolygon,
+                        outRasterDomain, outSlope, outFillSlope, outSCA, outTWI):
+                if tmp is not None:
+                    arcpy.Delete_management(tmp)
         except:
             print("Error deleting temporary files.")
-
-        ############################################################################################################
-        # Move the file to done folder
-        ############################################################################################################
-        # os.mkdir(path + "\\done\\" + subinput[i][:-4])
-        # move all files in subinput[i] to done folder
-        os.rename(subinput_dir + "\\" + subinput[i], path + "\\done\\" + subinput[i])
+        profiler.lap("cleanup", cells)
     except:
         print("Error processing subbasin: " + subinput[i])
         #print details of error
@@ -339,13 +530,167 @@ for i in range(len(subinput)):
         tbinfo = traceback.format_tb(tb)[0]
         pymsg = "ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n    " + str(sys.exc_info()[1])
         print(pymsg)
+        return i, None
+    return i, result
+
+############################################################################################################
+# Whole-DEM mode
+############################################################################################################
+# Returns {i: record} for the basins in todo, records as in process_subbasin
+def catchment_records(todo):
+    profiler.begin("all")
+    src = arcpy.Raster(input)
+    hyd = catchment.conditioned(input, outputFolder + "\\hydrology", lambda: toNumPy(src), cellSize(src))
+    cells = hyd.dem.size
+    profiler.lap("condition", cells)
+    sizes = cellSizes(src)
+    # outlet: the cell of the basin polygon draining out of it with the largest accumulation
+    outlets, polygonCells = [], []
+    for i in todo:
+        mask, row0, col0 = masks.rasterize(subinput_dir + "\\" + subinput[i], src)
+        outlets.append(catchment.outlet(hyd.accumulation, mask, row0, col0, hyd.topology.receivers))
+        polygonCells.append(int(mask.sum()))
+    basins = catchment.Catchments(hyd.topology, outlets, hyd.dem.shape)
+    # the clipped grids of process_subbasin end at the outlet, its step out of the basin is left out
+    found = numpy.flatnonzero(numpy.array(outlets) >= 0)
+    ends = numpy.array(outlets, dtype=numpy.int64)[found]
+    profiler.lap("extract", cells)
+    heightStats = basins.stats(hyd.dem)
+    meanHeight = heightStats["mean"]
+    if DISTRIBUTION:
+        heightDist = basins.distribution(hyd.dem, *zonal.value_range(hyd.dem))
+    slopeArray, fillSlopeArray = terrain.slopes([hyd.dem, hyd.fill], sizes)
+    riverSlope = basins.stats(slopeArray)["mean"]
+    if DISTRIBUTION:
+        slopeDist = basins.distribution(slopeArray, 0.0, 90.0)
+    del slopeArray
+    profiler.lap("slope", cells)
+    twiArray = terrain.twi(hyd.direction, hyd.accumulation, fillSlopeArray, sizes)
+    riverTWI = basins.stats(twiArray)["mean"]
+    if DISTRIBUTION:
+        twiDist = basins.distribution(twiArray, *zonal.value_range(twiArray))
+    del twiArray, fillSlopeArray
+    profiler.lap("twi", cells)
+    streamArray = streams.stream_mask(hyd.accumulation, streams.THRESHOLD)
+    # area of the cells of every basin, then the step lengths of the stream cells
+    weight = numpy.empty(hyd.dem.shape, dtype=numpy.float32)
+    weight[:] = (sizes[0] * sizes[1])[:, None]
+    weight[numpy.isnan(hyd.dem)] = 0
+    area_sum = basins.stats(weight)["sum"]/1000000
+    weight.fill(0)
+    streamCells, lengths = streams.stream_cells(hyd.direction, streamArray, sizes, hyd.topology.receivers)
+    weight.ravel()[streamCells] = lengths
+    outletStep = numpy.zeros(len(outlets))
+    outletStep[found] = weight.ravel()[ends]
+    riverLength = (basins.stats(weight)["sum"] - outletStep)/1000
+    profiler.lap("stats", cells)
+    if NETWORK:
+        net = streams.network(hyd.topology, hyd.direction, streamArray, sizes)
+        maxOrder = basins.stats(net.strahler)["max"]
+        magnitude = basins.stats(net.shreve)["max"]
+        longest = net.upstream.ravel()
+        order = numpy.minimum(net.strahler, streams.MAX_ORDER)
+        del net
+        # a segment belongs to the basins its head drains to, its length to those of its cells
+        heads = numpy.zeros(order.shape, dtype=numpy.uint8)
+        linkHeads = streams.link_heads(hyd.topology, streamArray)
+        heads.ravel()[linkHeads] = order.ravel()[linkHeads]
+        segments = basins.histogram(heads, streams.MAX_ORDER + 1)
+        del heads
+        orderLength = []
+        for k in range(1, streams.MAX_ORDER + 1):
+            length = basins.stats(numpy.where(order == k, weight, 0))["sum"]
+            length[found] -= numpy.where(order.ravel()[ends] == k, outletStep[found], 0)
+            orderLength.append(length/1000)
+        profiler.lap("network", cells)
+    if SWEEP:
+        sweep = streams.ThresholdSweep(THRESHOLDS, basins.nlabels).add(hyd.topology, hyd.direction,
+                                                                       hyd.accumulation, sizes, basins.grid)
+        groups, members = basins.pairs()
+        sweep = sweep.combine(groups, members, basins.nbasins).result()
+        rows, cols = hyd.dem.shape
+        step = streams.step_table(sizes, rows)[ends // cols, terrain.WIDTH_CLASS[hyd.direction.ravel()[ends]]]
+        step[hyd.topology.receivers[ends] < 0] = 0
+        above = sweep["thresholds"][None, :] < numpy.asarray(hyd.accumulation).ravel()[ends][:, None]
+        sweep["length"][found] -= above * step[:, None]
+        profiler.lap("sweep", cells)
+    records = {}
+    for k, i in enumerate(todo):
+        if outlets[k] < 0:
+            print("No outlet found for subbasin: " + subinput[i])
+            continue
+        if heightStats["count"][k] > catchment.OVERSIZE * polygonCells[k]:
+            print("Catchment of " + str(int(heightStats["count"][k])) + " cells for a polygon of " +
+                  str(polygonCells[k]) + ", skipped subbasin: " + subinput[i])
+            continue
+        riverDensity = riverLength[k] / area_sum[k] if area_sum[k] > 0 else float("nan")
+        records[i] = [float(meanHeight[k]), float(area_sum[k]), float(riverLength[k]),
+                      float(riverDensity), float(riverSlope[k]), float(riverTWI[k])]
+        if DISTRIBUTION:
+            records[i].extend(datasets.distribution_record(heightDist, slopeDist, twiDist, k))
+        if NETWORK:
+            records[i] += [int(maxOrder[k]), int(magnitude[k]), float(longest[outlets[k]])/1000]
+            for j in range(streams.MAX_ORDER):
+                records[i] += [int(segments[k][j + 1]), float(orderLength[j][k])]
+        if SWEEP:
+            records[i].extend(sweepRecord(sweep, area_sum[k], k))
+        if DEBUG:
+            print(subinput[i] + ": " + str(records[i]))
+    return records
+
+############################################################################################################
+# Finish, save result
+############################################################################################################
+def write_result(row, name, record):
+    if XLSX:
+        ws.cell(row,1).value = name
+        for j in range(len(record)):
+            ws.cell(row,j+2).value = record[j]
+            print("ws.cell(" + str(row) + "," + str(j+2) + ").value = " + str(record[j]))
+    else:
+        f.write(name + "\t" +
+                "\t".join([str(value) for value in record]) + "\n")
+
+def save():
+    if XLSX:
+        wb.save(outputFolder + "\\result_water.xlsx")
+        print("Output saved to: " + outputFolder + "\\result_water.xlsx")
+    else:
+        f.close()
+        print("Output saved to: " + outputFolder + "\\result_water.txt")
 
-    
-if XLSX:
-    wb.save(outputFolder + "\\result_water.xlsx")
-    print("Output saved to: " + outputFolder + "\\result_water.xlsx")
-else:
-    f.close()
-    print("Output saved to: " + outputFolder + "\\result_water.txt")
+    print("All done!")
 
-print("All done!")
\ No newline at end of file
+if __name__ == '__main__':
+    # every finished basin is committed to the journal at once, a rerun only does the missing ones
+    journal = Journal(outputFolder + "\\journal_water.sqlite")
+    if not RESUME:
+        journal.clear()
+    # the columns follow DISTRIBUTION, NETWORK, SWEEP and THRESHOLDS, and WHOLE_DEM computes area and
+    # length another way, so records of another setting are cleared
+    if journal.keyed(datasets.TERRAIN_COLUMNS + extraColumns() + [WHOLE_DEM]):
+        print("Columns or mode changed, journal cleared")
+    profiler.reset()
+    done = journal.done()
+    todo = [i for i in range(len(subinput)) if subinput[i][:-4] not in done]
+    print("Subbasins already in journal: " + str(len(subinput) - len(todo)))
+    if WHOLE_DEM and todo:
+        # one conditioned DEM serves every basin
+        records = catchment_records(todo)
+        results = [(i, records.get(i)) for i in todo]
+    else:
+        processes = PROCESSES if PARALLEL else 1
+        results = parallel.run(process_subbasin, todo, processes, TASKS_PER_CHILD)
+    # the journal alone tracks what is done, the boundary shapefiles stay where they are
+    for i, record in results:
+        if record is not None:
+            journal.record(subinput[i][:-4], record)
+    # the report is built from the journal, so it holds the basins of earlier runs too
+    profiler.begin("all")
+    open_output()
+    for row, (name, record) in enumerate(journal.records()):
+        write_result(row + 2, name, record)
+    journal.close()
+    save()
+    profiler.lap("output")
+    profiler.summary()
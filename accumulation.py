@@ -0,0 +1,83 @@
+# Flow accumulation on numpy arrays
+# Replacement for arcpy.sa.FlowAccumulation, linear time over the D8 graph
+from collections import namedtuple
+
+import numpy
+
+import d8
+
+# receivers: flat index of the downstream cell (-1 for none)
+# order: every cell in topological order, upstream cells first
+# bounds: order[bounds[i]:bounds[i + 1]] is wave i, cells of a wave are independent of each other
+Topology = namedtuple("Topology", ["receivers", "order", "bounds"])
+
+
+def reduce_by_index(index, values=None):
+    # Unique targets with the number of hits (or the sum of values) on each
+    u, inv = numpy.unique(index, return_inverse=True)
+    inv = inv.ravel()
+    if values is None:
+        return u, numpy.bincount(inv, minlength=u.size)
+    return u, numpy.bincount(inv, weights=values, minlength=u.size)
+
+
+def topological_order(recv, valid=None):
+    """Kahn's algorithm over the receiver graph, one vectorized frontier per wave.
+
+    Returns a Topology. Cells caught in a cycle (two pits draining into each other)
+    never reach in-degree zero and are left out of the order.
+    """
+    n = recv.size
+    if valid is None:
+        valid = numpy.ones(n, dtype=bool)
+    has = recv >= 0
+    indeg = numpy.bincount(recv[has], minlength=n).astype(numpy.uint8)
+    frontier = numpy.flatnonzero(valid & (indeg == 0)).astype(recv.dtype)
+    waves = []
+    bounds = [0]
+    while frontier.size:
+        waves.append(frontier)
+        bounds.append(bounds[-1] + frontier.size)
+        down = recv[frontier]
+        down = down[down >= 0]
+        if not down.size:
+            break
+        u, cnt = reduce_by_index(down)
+        indeg[u] -= cnt.astype(numpy.uint8)
+        frontier = u[indeg[u] == 0]
+    order = numpy.concatenate(waves) if waves else numpy.zeros(0, dtype=recv.dtype)
+    return Topology(recv, order, numpy.array(bounds, dtype=numpy.int64))
+
+
+def flow_accumulation(direction, weight=None, topology=None):
+    """Accumulated flow of every cell from a D8 direction array.
+
+    Like FlowAccumulation the value of a cell is the number of upstream cells (or
+    the sum of their weight), the cell itself excluded, and NoData stays NoData
+    (NaN). Returns (accumulation, topology) so later passes can reuse the order;
+    pass topology back in to skip rebuilding it for the same direction array.
+    """
+    direction = numpy.asarray(direction)
+    valid = direction.ravel() != d8.NODATA
+    if topology is None:
+        topology = topological_order(d8.receivers(direction), valid)
+    recv, order, bounds = topology
+
+    if weight is None:
+        total = numpy.ones(direction.size, dtype=numpy.float64)
+    else:
+        total = numpy.asarray(weight, dtype=numpy.float64).ravel().copy()
+        total[numpy.isnan(total)] = 0.0
+    own = total.copy()
+    # total = own weight + everything upstream, final once a cell's wave comes up
+    for i in range(bounds.size - 1):
+        wave = order[bounds[i]:bounds[i + 1]]
+        down = recv[wave]
+        keep = down >= 0
+        if not keep.any():
+            continue
+        u, s = reduce_by_index(down[keep], total[wave[keep]])
+        total[u] += s
+    total -= own
+    total[~valid] = numpy.nan
+    return total.reshape(direction.shape), topology
@@ -0,0 +1,283 @@
+# Benchmarks of the numpy engines on synthetic terrain, no data and no ArcGIS needed
+# Usage: python bench.py [--sizes 1000 2000] [--stages fill twi] [--out bench_results.jsonl]
+# The default sizes finish in about a minute; the large grids (5000 to 20000 per side, several GB
+# of memory at 20000) run only when asked for, e.g. --sizes 5000 10000 20000
+# Every timed stage appends one JSON line to the output file, so runs can be compared
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy
+
+try:
+    import tracemalloc
+except ImportError:
+    print("No tracemalloc module found. Peak memory is reported from the process maximum RSS.")
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import accumulation
+import boundary
+import d8
+import fill
+import streams
+import terrain
+import zonal
+
+# Grid sizes (cells per side) and the stages timed on each
+SIZES = (1000, 2000)
+STAGES = ("fill", "direction", "accumulation", "stream_link", "watershed", "slope", "twi",
+          "zonal_soil", "zonal_ndvi", "zonal_landcover")
+SEED = 42
+CELLSIZE = 90.0
+BASINS = 50
+SOIL_BANDS = 6
+NDVI_YEARS = 5
+NCLASSES = 19
+# Rows generated per chunk of the noise synthesis
+CHUNK_ROWS = 1024
+
+
+############################################################################################################
+# Synthetic data
+############################################################################################################
+def noise(n, seed, hurst=0.8):
+    """Fractal value noise in [0, 1], n x n float32, the same for the same (n, seed).
+
+    Octaves of random lattices, each twice as fine as the last with amplitude
+    2 ** (-k * hurst), are bilinearly upsampled and summed chunk by chunk.
+    """
+    rng = numpy.random.RandomState(seed)
+    out = numpy.zeros((n, n), dtype=numpy.float32)
+    k = 1
+    while 2 ** k < n // 2:
+        m = 2 ** k + 1
+        g = rng.uniform(-1, 1, (m, m)).astype(numpy.float32)
+        amp = numpy.float32(2.0 ** (-k * hurst))
+        pos = numpy.linspace(0, m - 1, n)
+        i0 = numpy.minimum(pos.astype(numpy.int64), m - 2)
+        w = (pos - i0).astype(numpy.float32)
+        for r in range(0, n, CHUNK_ROWS):
+            r1 = min(r + CHUNK_ROWS, n)
+            top, bot = g[i0[r:r1]], g[i0[r:r1] + 1]
+            rows = top + (bot - top) * w[r:r1, None]
+            left, right = rows[:, i0], rows[:, i0 + 1]
+            out[r:r1] += amp * (left + (right - left) * w)
+        k += 1
+    out -= out.min()
+    out /= max(float(out.max()), 1e-12)
+    return out
+
+
+def fractal_dem(n, seed=SEED, relief=1000.0):
+    # Fractal surface on a regional slope, so that most cells drain off the grid
+    z = noise(n, seed)
+    z *= numpy.float32(relief)
+    ramp = numpy.linspace(relief * 0.5, 0, n).astype(numpy.float32)
+    z += ramp[:, None]
+    z += ramp[None, :]
+    return z
+
+
+def random_basins(n, count=BASINS, seed=SEED, cellsize=CELLSIZE):
+    """Random star-shaped polygons over an n x n grid, some multipart, some with a hole.
+
+    Returns (shapes, transform); shapes are boundary.Shape polygons in map units of
+    the grid transform (x0, dx, y0, dy).
+    """
+    rng = numpy.random.RandomState(seed + 1)
+    transform = (0.0, cellsize, n * cellsize, -cellsize)
+
+    def star(cx, cy, radius, reverse=False):
+        k = rng.randint(12, 40)
+        angle = numpy.sort(rng.uniform(0, 2 * numpy.pi, k))
+        r = radius * rng.uniform(0.6, 1.0, k)
+        ring = numpy.column_stack((cx + r * numpy.cos(angle), cy + r * numpy.sin(angle)))
+        # closed and clockwise, the shapefile order for outer rings
+        ring = numpy.vstack((ring, ring[:1]))[::-1]
+        return ring[::-1] if reverse else ring
+
+    shapes = []
+    for b in range(count):
+        cx, cy = rng.uniform(0.1, 0.9, 2) * n * cellsize
+        radius = rng.uniform(0.02, 0.2) * n * cellsize
+        parts = [star(cx, cy, radius)]
+        kind = rng.randint(4)
+        if kind == 1:
+            parts.append(star(cx, cy, radius * 0.3, reverse=True))
+        elif kind == 2:
+            parts.append(star(cx + 1.5 * radius, cy, radius * 0.4))
+        points = numpy.vstack(parts)
+        bbox = (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+        shapes.append(boundary.Shape(5, bbox, parts, {"ID": b}))
+    return shapes, transform
+
+
+def basin_zones(shapes, transform, n):
+    # ZoneGrid of the (possibly overlapping) basins on the n x n grid
+    zones = zonal.ZoneGrid((n, n), len(shapes))
+    for b, shape in enumerate(shapes):
+        mask, row0, col0 = boundary.window_mask([shape], transform, (n, n))
+        if mask.size:
+            zones.burn(b, mask, row0, col0)
+    return zones
+
+
+def soil(n, bands=SOIL_BANDS, seed=SEED):
+    # Multi-band soil raster of percentages (0..100), (bands, n, n) uint8
+    out = numpy.empty((bands, n, n), dtype=numpy.uint8)
+    for b in range(bands):
+        out[b] = noise(n, seed + 10 + b) * 100
+    return out
+
+
+def ndvi_years(n, years=NDVI_YEARS, seed=SEED):
+    # NDVI x 10000 per year, (years, n, n) int16: a common pattern, a yearly anomaly and a trend
+    base = noise(n, seed + 100)
+    out = numpy.empty((years, n, n), dtype=numpy.int16)
+    for y in range(years):
+        out[y] = (base * 0.7 + noise(n, seed + 200 + y) * 0.3) * 9000 - 1000 + y * 50
+    return out
+
+
+def land_cover(n, seed=SEED):
+    # Class raster 1..NCLASSES, uint8, in spatially coherent patches
+    return (noise(n, seed + 300, hurst=0.5) * (NCLASSES - 1e-6)).astype(numpy.uint8) + 1
+
+
+############################################################################################################
+# Measuring
+############################################################################################################
+def maxrss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+def measure(stage, cells, func, *args):
+    """Run func(*args) and return (result, record) with its time and peak memory."""
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    result = func(*args)
+    seconds = time.time() - start
+    peak = None
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+        tracemalloc.stop()
+    record = {
+        "stage": stage,
+        "cells": cells,
+        "seconds": seconds,
+        "cells_per_s": cells / seconds if seconds > 0 else None,
+        "peak_mb": peak,
+        "maxrss_mb": maxrss_mb(),
+    }
+    return result, record
+
+
+def zonal_soil(zones, bands):
+    return [zonal.zonal_stats(zones, band) for band in bands]
+
+
+def zonal_ndvi(zones, layers):
+    # every year reduced over one selection of the basin cells, as masks.stack_stats does
+    years, n = layers.shape[0], layers.shape[1]
+    groups, atoms = zones.pairs()
+    accs = [zonal.ZonalStats(zones.natoms) for y in range(years)]
+    for r in range(0, n, zonal.CHUNK_ROWS):
+        z = zones.grid[r:r + zonal.CHUNK_ROWS].ravel()
+        sel = numpy.flatnonzero(z)
+        z = z[sel]
+        for acc, layer in zip(accs, layers):
+            acc.add_cells(z, layer[r:r + zonal.CHUNK_ROWS].ravel()[sel])
+    means = numpy.array([acc.combine(groups, atoms, zones.nbasins).result()["mean"] for acc in accs])
+    return zonal.linear_trend(numpy.arange(years), means)
+
+
+def bench(n, stages=STAGES, seed=SEED, basins=BASINS, cellsize=CELLSIZE):
+    """Time every stage of stages on an n x n synthetic grid, returns the records.
+
+    Stages that are not asked for still run when a later stage needs their output,
+    they are just not timed.
+    """
+    cells = n * n
+    records = []
+
+    def step(stage, func, *args, **kw):
+        # layers: rasters the stage reads, cells/s counts the cells of all of them
+        if stage not in stages:
+            return func(*args)
+        result, record = measure(stage, cells * kw.get("layers", 1), func, *args)
+        record.update({"size": n, "seed": seed})
+        records.append(record)
+        print("%-16s %6d^2 %9.2f s %14.0f cells/s %10s MB" % (
+            stage, n, record["seconds"], record["cells_per_s"] or 0,
+            "%.1f" % record["peak_mb"] if record["peak_mb"] is not None else "-"))
+        return result
+
+    hydrology = set(stages) & set(STAGES[:7])
+    if hydrology:
+        dem = fractal_dem(n, seed)
+        filled = step("fill", fill.fill_depressions, dem)
+        if hydrology - set(["fill", "slope"]):
+            direction = step("direction", d8.flow_direction, filled, None, cellsize)
+        if hydrology - set(["fill", "direction", "slope"]):
+            acc, topology = step("accumulation", accumulation.flow_accumulation, direction)
+        if hydrology & set(["stream_link", "watershed"]):
+            links = step("stream_link", streams.stream_link, topology, streams.stream_mask(acc))
+            step("watershed", streams.watershed, topology, links)
+            del links
+        if hydrology & set(["slope", "twi"]):
+            slope = step("slope", terrain.slopes, [dem, filled], cellsize)[1]
+        if "twi" in hydrology:
+            step("twi", terrain.twi, direction, acc, slope, cellsize)
+        del dem, filled
+    if set(stages) & set(STAGES[7:]):
+        shapes, transform = random_basins(n, basins, seed, cellsize)
+        zones = basin_zones(shapes, transform, n)
+        # the rasters are generated before the clock starts
+        if "zonal_soil" in stages:
+            bands = soil(n, SOIL_BANDS, seed)
+            step("zonal_soil", zonal_soil, zones, bands, layers=SOIL_BANDS)
+            del bands
+        if "zonal_ndvi" in stages:
+            layers = ndvi_years(n, NDVI_YEARS, seed)
+            step("zonal_ndvi", zonal_ndvi, zones, layers, layers=NDVI_YEARS)
+            del layers
+        if "zonal_landcover" in stages:
+            step("zonal_landcover", zonal.zonal_histogram, zones, land_cover(n, seed), NCLASSES + 1)
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the numpy engines on synthetic terrain.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="cells per side")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--basins", type=int, default=BASINS)
+    parser.add_argument("--out", default="bench_results.jsonl", help="JSON lines file the records are appended to")
+    args = parser.parse_args(argv)
+    run = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+    }
+    for n in args.sizes:
+        for record in bench(n, args.stages, args.seed, args.basins):
+            record.update(run)
+            with open(args.out, "a") as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+    print("Results appended to: " + args.out)
+
+
+if __name__ == '__main__':
+    main()
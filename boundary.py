@@ -0,0 +1,235 @@
+# Shapefile reader and polygon rasterizer, pure Python and numpy
+# Replacement for PolygonToRaster / the mask side of ExtractByMask, runs without ArcGIS
+import os
+import struct
+from collections import namedtuple
+
+import numpy
+
+# shapetype: 3 polyline, 5 polygon (13/15 with Z, 23/25 with M), 0 null
+# bbox: (xmin, ymin, xmax, ymax), parts: list of (n, 2) float64 vertex arrays, record: dict of the .dbf row
+Shape = namedtuple("Shape", ["shapetype", "bbox", "parts", "record"])
+POLYLINE = (3, 13, 23)
+POLYGON = (5, 15, 25)
+
+
+############################################################################################################
+# Reading
+############################################################################################################
+def read_dbf(path):
+    """Rows of a dBASE table as dicts; numbers are parsed, text is stripped, deleted rows skipped."""
+    with open(path, "rb") as f:
+        data = f.read()
+    nrecords, headerlen, recordlen = struct.unpack("<IHH", data[4:12])
+    fields = []
+    pos = 32
+    while pos < headerlen - 1 and data[pos:pos + 1] != b"\r":
+        name = data[pos:pos + 11].split(b"\0")[0].decode("latin-1")
+        kind = data[pos + 11:pos + 12].decode("latin-1")
+        fields.append((name, kind, ord(data[pos + 16:pos + 17])))
+        pos += 32
+    rows = []
+    for k in range(nrecords):
+        rec = data[headerlen + k * recordlen:headerlen + (k + 1) * recordlen]
+        if rec[:1] == b"*":
+            continue
+        row = {}
+        pos = 1
+        for name, kind, length in fields:
+            raw = rec[pos:pos + length].strip(b" \0")
+            pos += length
+            if kind in "NF":
+                try:
+                    value = float(raw)
+                    row[name] = int(value) if value.is_integer() and b"." not in raw else value
+                except ValueError:
+                    row[name] = None
+            elif kind == "L":
+                row[name] = raw[:1] in (b"T", b"t", b"Y", b"y") if raw else None
+            else:
+                row[name] = raw.decode("latin-1")
+        rows.append(row)
+    return rows
+
+
+def shapefile_bbox(path):
+    # (xmin, ymin, xmax, ymax) of all shapes, from the .shp main header
+    with open(os.path.splitext(path)[0] + ".shp", "rb") as f:
+        return struct.unpack("<4d", f.read(68)[36:68])
+
+
+def shape_offsets(path):
+    # Byte offset of every record of the .shp, from the .shx index
+    with open(path, "rb") as f:
+        data = f.read()
+    index = numpy.frombuffer(data[100:], dtype=">i4").reshape(-1, 2)
+    return (index[:, 0].astype(numpy.int64) * 2).tolist()
+
+
+def read_shapefile(path):
+    """Every shape of a polygon or polyline shapefile, with its .dbf row when there is one.
+
+    Records are located through the .shx index when it exists and read one after
+    the other otherwise; Z and M values are dropped.
+    """
+    base = os.path.splitext(path)[0]
+    with open(base + ".shp", "rb") as f:
+        data = f.read()
+    if os.path.exists(base + ".shx"):
+        offsets = shape_offsets(base + ".shx")
+    else:
+        offsets = []
+        pos = 100
+        while pos + 8 <= len(data):
+            offsets.append(pos)
+            pos += 8 + 2 * struct.unpack(">i", data[pos + 4:pos + 8])[0]
+    records = read_dbf(base + ".dbf") if os.path.exists(base + ".dbf") else []
+    shapes = []
+    for k, pos in enumerate(offsets):
+        record = records[k] if k < len(records) else {}
+        pos += 8
+        shapetype = struct.unpack("<i", data[pos:pos + 4])[0]
+        if shapetype not in POLYLINE + POLYGON:
+            shapes.append(Shape(shapetype, None, [], record))
+            continue
+        bbox = struct.unpack("<4d", data[pos + 4:pos + 36])
+        nparts, npoints = struct.unpack("<2i", data[pos + 36:pos + 44])
+        starts = list(struct.unpack("<%di" % nparts, data[pos + 44:pos + 44 + 4 * nparts])) + [npoints]
+        pos += 44 + 4 * nparts
+        points = numpy.frombuffer(data[pos:pos + 16 * npoints], dtype="<f8").reshape(-1, 2).astype(numpy.float64)
+        parts = [points[starts[i]:starts[i + 1]] for i in range(nparts)]
+        shapes.append(Shape(shapetype, bbox, parts, record))
+    return shapes
+
+
+############################################################################################################
+# Rasterizing
+############################################################################################################
+def pixel_edges(parts, transform):
+    # Edges of every part as (c0, r0, c1, r1) in fractional cell coordinates
+    x0, dx, y0, dy = transform
+    out = []
+    for p in parts:
+        if len(p) < 2:
+            continue
+        c = (p[:, 0] - x0) / dx
+        r = (p[:, 1] - y0) / dy
+        out.append(numpy.column_stack((c[:-1], r[:-1], c[1:], r[1:])))
+    if not out:
+        return numpy.zeros((0, 4))
+    return numpy.concatenate(out)
+
+
+def spans(rows, c0, c1, shape, out):
+    # Set out[rows[i], c0[i]:c1[i]] with one difference array, spans are clipped to the grid
+    nrows, ncols = shape
+    ok = (rows >= 0) & (rows < nrows)
+    rows, c0, c1 = rows[ok], numpy.clip(c0[ok], 0, ncols), numpy.clip(c1[ok], 0, ncols)
+    ok = c1 > c0
+    rows, c0, c1 = rows[ok], c0[ok], c1[ok]
+    diff = numpy.zeros((nrows, ncols + 1), dtype=numpy.int32)
+    numpy.add.at(diff, (rows, c0), 1)
+    numpy.add.at(diff, (rows, c1), -1)
+    out |= numpy.cumsum(diff, axis=1)[:, :ncols] > 0
+    return out
+
+
+def fill_polygon(edges, shape, out):
+    """Cells whose centre is inside the polygon (even-odd rule, so holes and parts just work).
+
+    Every edge is crossed with the centre line of each row it spans, all at once; the
+    sorted crossings of a row pair up into the spans that are inside.
+    """
+    if not edges.size:
+        return out
+    ca, ra, cb, rb = edges.T
+    lo, hi = numpy.minimum(ra, rb), numpy.maximum(ra, rb)
+    # rows r whose centre r + 0.5 lies in [lo, hi), horizontal edges cross none
+    first = numpy.ceil(lo - 0.5).astype(numpy.int64)
+    last = numpy.ceil(hi - 0.5).astype(numpy.int64)
+    n = numpy.maximum(last - first, 0)
+    if not n.sum():
+        return out
+    edge = numpy.repeat(numpy.arange(edges.shape[0]), n)
+    rows = numpy.repeat(first, n) + numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n) - n, n)
+    t = (rows + 0.5 - ra[edge]) / (rb[edge] - ra[edge])
+    x = ca[edge] + t * (cb[edge] - ca[edge])
+    order = numpy.lexsort((x, rows))
+    rows, x = rows[order], x[order]
+    # crossings of a row come in pairs, from the 1st to the 2nd, 3rd to the 4th...
+    rows, xa, xb = rows[0::2], x[0::2], x[1::2]
+    return spans(rows, numpy.ceil(xa - 0.5).astype(numpy.int64), numpy.ceil(xb - 0.5).astype(numpy.int64),
+                 shape, out)
+
+
+def trace_edges(edges, shape, out):
+    """Every cell an edge passes through (the supercover of each segment)."""
+    if not edges.size:
+        return out
+    ca, ra, cb, rb = edges.T
+    first = numpy.floor(numpy.minimum(ra, rb)).astype(numpy.int64)
+    last = numpy.floor(numpy.maximum(ra, rb)).astype(numpy.int64)
+    n = last - first + 1
+    edge = numpy.repeat(numpy.arange(edges.shape[0]), n)
+    rows = numpy.repeat(first, n) + numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n) - n, n)
+    # part of the edge inside the row band [row, row + 1]
+    lo = numpy.maximum(numpy.minimum(ra, rb)[edge], rows)
+    hi = numpy.minimum(numpy.maximum(ra, rb)[edge], rows + 1)
+    dr = rb[edge] - ra[edge]
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        slope = numpy.where(dr != 0, (cb[edge] - ca[edge]) / dr, 0.0)
+    xa = numpy.where(dr != 0, ca[edge] + (lo - ra[edge]) * slope, ca[edge])
+    xb = numpy.where(dr != 0, ca[edge] + (hi - ra[edge]) * slope, cb[edge])
+    c0 = numpy.floor(numpy.minimum(xa, xb)).astype(numpy.int64)
+    c1 = numpy.floor(numpy.maximum(xa, xb)).astype(numpy.int64) + 1
+    return spans(rows, c0, c1, shape, out)
+
+
+def rasterize(shapes, transform, shape, all_touched=False):
+    """Boolean mask of the cells covered by shapes on a grid.
+
+    transform is (x0, dx, y0, dy) as in raster.GeoTiff, shape is (rows, cols). Polygons
+    burn the cells whose centre is inside, like PolygonToRaster "CELL_CENTER", or with
+    all_touched every cell they touch; polylines burn every cell they pass through.
+    """
+    out = numpy.zeros(shape, dtype=bool)
+    for s in shapes:
+        if not s.parts:
+            continue
+        edges = pixel_edges(s.parts, transform)
+        if s.shapetype in POLYGON:
+            fill_polygon(edges, shape, out)
+            if all_touched:
+                trace_edges(edges, shape, out)
+        else:
+            trace_edges(edges, shape, out)
+    return out
+
+
+def basin_mask(path, transform, shape, all_touched=False):
+    """Mask of the shapes of a shapefile over the cells of their bounding box.
+
+    Returns (mask, row0, col0) with the mask placed at (row0, col0) of the grid,
+    clipped to it, like masks.rasterize.
+    """
+    return window_mask(read_shapefile(path), transform, shape, all_touched)
+
+
+def window_mask(shapes, transform, shape, all_touched=False):
+    # (mask, row0, col0) of shapes over the cells of their bounding box, see basin_mask
+    shapes = [s for s in shapes if s.parts]
+    if not shapes:
+        return numpy.zeros((0, 0), dtype=bool), 0, 0
+    x0, dx, y0, dy = transform
+    xmin = min(s.bbox[0] for s in shapes)
+    ymin = min(s.bbox[1] for s in shapes)
+    xmax = max(s.bbox[2] for s in shapes)
+    ymax = max(s.bbox[3] for s in shapes)
+    c0, c1 = sorted(((xmin - x0) / dx, (xmax - x0) / dx))
+    r0, r1 = sorted(((ymax - y0) / dy, (ymin - y0) / dy))
+    c0, r0 = max(int(numpy.floor(c0)), 0), max(int(numpy.floor(r0)), 0)
+    c1, r1 = min(int(numpy.ceil(c1)), shape[1]), min(int(numpy.ceil(r1)), shape[0])
+    if c1 <= c0 or r1 <= r0:
+        return numpy.zeros((0, 0), dtype=bool), r0, c0
+    window = (x0 + c0 * dx, dx, y0 + r0 * dy, dy)
+    return rasterize(shapes, window, (r1 - r0, c1 - c0), all_touched), r0, c0
@@ -0,0 +1,165 @@
+# Nested catchments on a DEM conditioned once
+# Fill, direction and accumulation of the whole DEM are cached; each basin is the upstream set of its outlet
+import json
+import os
+from collections import namedtuple
+
+import numpy
+
+import d8
+import fill
+import accumulation
+import streams
+import zonal
+
+# dem: raw elevations (float32, NaN for NoData), fill: filled elevations, direction: D8 codes,
+# accumulation: upstream cell count, topology: accumulation.Topology of direction
+Hydrology = namedtuple("Hydrology", ["dem", "fill", "direction", "accumulation", "topology"])
+ARRAYS = ("dem", "fill", "direction", "accumulation", "receivers", "order", "bounds")
+
+
+############################################################################################################
+# Conditioning
+############################################################################################################
+def condition(dem, nodata=None, cellsize=1.0):
+    """Hydrology of a whole DEM: one fill, one direction and one accumulation pass."""
+    z = d8.as_elevation(dem, nodata).astype(numpy.float32)
+    filled = fill.fill_depressions(z)
+    direction = d8.flow_direction(filled, cellsize=cellsize)
+    acc, topology = accumulation.flow_accumulation(direction)
+    return Hydrology(z, filled, direction, acc, topology)
+
+
+def conditioned(path, folder, read, cellsize=1.0):
+    """Hydrology of the DEM file at path, computed once and kept as .npy files in folder.
+
+    read() returns the DEM as a float array with NoData as NaN; it is only called
+    when folder holds no arrays for the current size and modification time of path.
+    Cached arrays are memory-mapped read-only, so a rerun starts without a pass
+    over the DEM.
+    """
+    st = os.stat(path)
+    stamp = {"path": os.path.abspath(path), "size": st.st_size, "mtime": st.st_mtime,
+             "cellsize": list(numpy.ravel(cellsize).tolist())}
+    stampFile = os.path.join(folder, "stamp.json")
+    if os.path.exists(stampFile):
+        with open(stampFile) as f:
+            if json.load(f) == stamp:
+                arr = dict((name, numpy.load(os.path.join(folder, name + ".npy"), mmap_mode="r"))
+                           for name in ARRAYS)
+                topology = accumulation.Topology(arr["receivers"], arr["order"], arr["bounds"])
+                return Hydrology(arr["dem"], arr["fill"], arr["direction"], arr["accumulation"], topology)
+    hyd = condition(read(), cellsize=cellsize)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    arr = dict(zip(ARRAYS, hyd[:4] + tuple(hyd.topology)))
+    for name in ARRAYS:
+        numpy.save(os.path.join(folder, name + ".npy"), arr[name])
+    # the stamp goes last, an interrupted save is never taken for a valid cache
+    with open(stampFile, "w") as f:
+        json.dump(stamp, f)
+    return hyd
+
+
+# a catchment with more than OVERSIZE times the cells of its polygon drains a river from outside it
+OVERSIZE = 2.0
+
+
+def outlet(acc, mask, row0=0, col0=0, recv=None):
+    """Flat index of the outlet cell of the polygon mask placed at (row0, col0), -1 if none.
+
+    With recv, the receivers of the grid of acc, only cells of mask draining out of
+    it are candidates, and those whose accumulation exceeds OVERSIZE times the cells
+    of mask (a river passing through or along the polygon) only when no other is
+    left. The outlet is the candidate with the largest accumulation.
+    """
+    mask = numpy.asarray(mask, dtype=bool)
+    win = numpy.asarray(acc[row0:row0 + mask.shape[0], col0:col0 + mask.shape[1]], dtype=numpy.float64)
+    mask = mask[:win.shape[0], :win.shape[1]] & ~numpy.isnan(win)
+    r, c = numpy.nonzero(mask)
+    if not r.size:
+        return -1
+    cols = acc.shape[1]
+    cells, a = (row0 + r) * cols + col0 + c, win[r, c]
+    if recv is not None:
+        down = numpy.asarray(recv)[cells]
+        dr, dc = down // cols - row0, down % cols - col0
+        inside = (down >= 0) & (dr >= 0) & (dr < win.shape[0]) & (dc >= 0) & (dc < win.shape[1])
+        inside[inside] = mask[dr[inside], dc[inside]]
+        if not inside.all():
+            cells, a = cells[~inside], a[~inside]
+        fits = a + 1 <= OVERSIZE * r.size
+        if fits.any():
+            cells, a = cells[fits], a[fits]
+    return int(cells[numpy.argmax(a)])
+
+
+############################################################################################################
+# Nested catchments
+############################################################################################################
+class Catchments(object):
+    """Upstream sets of many outlets on one Topology, labelled in a single sweep.
+
+    Every cell gets the label of the first outlet on its flow path (0 if none), so
+    the labels split the grid into disjoint local catchments. Outlets form a tree
+    (parent = label downstream of the outlet), and the catchment of a basin is the
+    union of the local catchments in its subtree. Per-label statistics are merged
+    into per-basin results like the atoms of zonal.ZoneGrid, so the cost is one pass
+    over the grid per layer, however deeply the basins are nested.
+    """
+
+    def __init__(self, topology, outlets, shape):
+        recv = topology.receivers
+        outlets = numpy.asarray(outlets, dtype=numpy.int64)
+        self.nbasins = outlets.size
+        # basins sharing an outlet cell share its label
+        cells = numpy.unique(outlets[outlets >= 0])
+        self.basin_label = numpy.zeros(self.nbasins, dtype=numpy.int64)
+        self.basin_label[outlets >= 0] = numpy.searchsorted(cells, outlets[outlets >= 0]) + 1
+        labels = numpy.zeros(numpy.prod(shape), dtype=numpy.int32)
+        labels[cells] = numpy.arange(1, cells.size + 1)
+        # every cell takes the label of the first outlet downstream
+        labels = streams.watershed(topology, labels)
+        self.grid = labels.reshape(shape)
+        self.parent = numpy.zeros(cells.size + 1, dtype=numpy.int64)
+        down = recv[cells]
+        self.parent[1:][down >= 0] = labels[down[down >= 0]]
+
+    @property
+    def nlabels(self):
+        return self.parent.size
+
+    def pairs(self):
+        # (basin, label) for every local catchment upstream of each basin's outlet
+        basins_of = {}
+        for b, lab in enumerate(self.basin_label.tolist()):
+            if lab:
+                basins_of.setdefault(lab, []).append(b)
+        basins, labels = [], []
+        for lab in range(1, self.nlabels):
+            a, seen = lab, set()
+            while a and a not in seen:
+                seen.add(a)
+                for b in basins_of.get(a, ()):
+                    basins.append(b)
+                    labels.append(lab)
+                a = int(self.parent[a])
+        return numpy.array(basins, dtype=numpy.int64), numpy.array(labels, dtype=numpy.int64)
+
+    def reduce(self, atoms, values, nodata=None):
+        # Per-basin result of a per-label accumulator (zonal.ZonalStats...) fed with values
+        atoms.add(self.grid, values, nodata)
+        groups, members = self.pairs()
+        return atoms.combine(groups, members, self.nbasins).result()
+
+    def stats(self, values, nodata=None):
+        """Per-basin statistics of values over each basin's upstream set, see zonal.zonal_stats."""
+        return self.reduce(zonal.ZonalStats(self.nlabels), values, nodata)
+
+    def distribution(self, values, lo, hi, bins=zonal.BINS, nodata=None):
+        """Per-basin quantiles of values over each basin's upstream set, see zonal.ZonalQuantiles."""
+        return self.reduce(zonal.ZonalQuantiles(self.nlabels, lo, hi, bins), values, nodata)
+
+    def histogram(self, values, nclasses, nodata=None):
+        """Per-basin class counts of values over each basin's upstream set, (basins, nclasses)."""
+        return self.reduce(zonal.ZonalHistogram(self.nlabels, nclasses), values, nodata)
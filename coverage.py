@@ -5,6 +5,11 @@ from arcpy.sa import *
 import os
 import sys
 import numpy
+import masks
+import parallel
+import datasets
+from journal import Journal
+from profiling import Profiler
 
 XLSX = True
 try:
@@ -16,6 +21,20 @@ except ImportError:
 DEBUG = True
 TEST = False
 SAVE = False
+# Count every class of every basin in one pass over the land cover raster
+ZONAL = True
+# Land cover classes 1..19 of NALCMS
+NCLASSES = len(datasets.COVERAGE_CLASSES)
+# Skip basins already in the results journal, False starts from an empty journal
+RESUME = True
+# Process basins in a pool of worker processes (per-basin path only)
+PARALLEL = False
+# Worker processes, None uses every core
+PROCESSES = None
+# Basins per worker before it is recycled
+TASKS_PER_CHILD = parallel.TASKS_PER_CHILD
+# Time every step of every basin into output\profile_coverage.jsonl and print a summary at the end
+PROFILE = True
 
 ############################################################################################################
 # Set environment settings
@@ -62,148 +81,88 @@ if DEBUG:
     print("Suboutput list: " + str(suboutput))
     print("Number of suboutput: " + str(len(suboutput)))
 
+profiler = Profiler(outputFolder + "\\profile_coverage.jsonl", PROFILE)
+# basin zone grids are kept in output\zones, later runs and datasets on the same grid load them
+masks.ZONE_FOLDER = outputFolder + "\\zones"
+
 if TEST:
     subinput = ["3170000.shp"]
     suboutput = [outputFolder + "\\" + sub[:-4] for sub in subinput]
     print("test subinput: " + str(subinput))
     print("test suboutput: " + str(suboutput))
 
-# data structure for each subbasin
-subbasin = {}
-# Save output to excel
-if XLSX:
-    wb = Workbook()
-    wb.create_sheet('Sheet1', 0)
-    ws = wb.active
-    ws.cell(1,1).value = "Subbasin Number"
-    ws.cell(1,2).value = "Temperate or sub-polar needleleaf forest Coverage"
-    ws.cell(1,3).value = "Sub-polar taiga needleleaf forest Coverage"
-    ws.cell(1,4).value = "Tropical or sub-tropical broadleaf evergreen forest Coverage"
-    ws.cell(1,5).value = "Tropical or sub-tropical broadleaf deciduous forest Coverage"
-    ws.cell(1,6).value = "Temperate or sub-polar broadleaf deciduous forest Coverage"
-    ws.cell(1,7).value = "Mixed forest Coverage"
-    ws.cell(1,8).value = "Tropical or sub-tropical shrubland Coverage"
-    ws.cell(1,9).value = "Temperate or sub-polar shrubland Coverage"
-    ws.cell(1,10).value = "Tropical or sub-tropical grassland Coverage"
-    ws.cell(1,11).value = "Temperate or sub-polar grassland Coverage"
-    ws.cell(1,12).value = "Sub-polar or polar shrubland-lichen-moss Coverage"
-    ws.cell(1,13).value = "Sub-polar or polar grassland-lichen-moss Coverage"
-    ws.cell(1,14).value = "Sub-polar or polar barren-lichen-moss Coverage"
-    ws.cell(1,15).value = "Wetland Coverage"
-    ws.cell(1,16).value = "Cropland Coverage"
-    ws.cell(1,17).value = "Barren land Coverage"
-    ws.cell(1,18).value = "Urban and built-up Coverage"
-    ws.cell(1,19).value = "Water Coverage"
-    ws.cell(1,20).value = "Permanent snow and ice Coverage"
-else:
-    f = open(outputFolder + "\\result.txt", "w")
-    f.write("Subbasin Number" + "\t" +
-            "Temperate or sub-polar needleleaf forest Coverage" + "\t" +
-            "Sub-polar taiga needleleaf forest Coverage" + "\t" +
-            "Tropical or sub-tropical broadleaf evergreen forest Coverage" + "\t" +
-            "Tropical or sub-tropical broadleaf deciduous forest Coverage" + "\t" +
-            "Temperate or sub-polar broadleaf deciduous forest Coverage" + "\t" +
-            "Mixed forest Coverage" + "\t" +
-            "Tropical or sub-tropical shrubland Coverage" + "\t" +
-            "Temperate or sub-polar shrubland Coverage" + "\t" +
-            "Tropical or sub-tropical grassland Coverage" + "\t" +
-            "Temperate or sub-polar grassland Coverage" + "\t" +
-            "Sub-polar or polar shrubland-lichen-moss Coverage" + "\t" +
-            "Sub-polar or polar grassland-lichen-moss Coverage" + "\t" +
-            "Sub-polar or polar barren-lichen-moss Coverage" + "\t" +
-            "Wetland Coverage" + "\t" +
-            "Cropland Coverage" + "\t" +
-            "Barren land Coverage" + "\t" +
-            "Urban and built-up Coverage" + "\t" +
-            "Water Coverage" + "\t" +
-            "Permanent snow and ice Coverage" + "\n")
+# Save output to excel, only the parent process writes output
+def open_output():
+    global wb, ws, f
+    if XLSX:
+        wb = Workbook()
+        wb.create_sheet('Sheet1', 0)
+        ws = wb.active
+        ws.cell(1,1).value = "Subbasin Number"
+        for j in range(len(datasets.COVERAGE_COLUMNS)):
+            ws.cell(1,j+2).value = datasets.COVERAGE_COLUMNS[j]
+    else:
+        f = open(outputFolder + "\\result.txt", "w")
+        f.write("Subbasin Number\t" + "\t".join(datasets.COVERAGE_COLUMNS) + "\n")
 
 ###########################################################################################################
 # Part1: Hydrological Analysis
 ############################################################################################################
 # Step0: Iterate through subinput
 ############################################################################################################
-# data structure for each subbasin
-result = [[] for i in range(len(subinput))]
-
-for i in range(len(subinput)):
+# Returns (i, record) with the plain values of basin i, record is None on error
+def process_subbasin(i):
+    # data structure for each subbasin
+    result = [0 for j in range(NCLASSES + 1)]
     try:
-        result[i] = [0 for j in range(20)]
         print("Processing subbasin: " + subinput[i])
+        profiler.begin(subinput[i][:-4])
         # set workspace to suboutput
         env.workspace = suboutput[i]
         print("Workspace set to: " + suboutput[i])
     ############################################################################################################
     # Step1: Extract by mask
     ############################################################################################################
-        # Set local variables
-        inRaster = input
-        inMaskData = inputFolder + "\\Boundary\\Ohio\\" + subinput[i]
-        if DEBUG:
-            print("inRaster: " + inRaster)
-            print("inMaskData: " + inMaskData)
-        # Execute ExtractByMask
-        outExtractByMask = ExtractByMask(inRaster, inMaskData)
-        if SAVE:
-            outExtractByMask.save(suboutput[i] + "\\dem.tif")
+        if ZONAL:
+            # class counts of every basin were computed in one pass before the loop
+            result[1:] = [int(c) for c in classCounts[i][1:]]
+        else:
+            # Set local variables
+            inRaster = input
+            inMaskData = inputFolder + "\\Boundary\\Ohio\\" + subinput[i]
             if DEBUG:
-                print("ExtractByMask saved to: " + suboutput[i] + "\\dem.tif")
+                print("inRaster: " + inRaster)
+                print("inMaskData: " + inMaskData)
+            # read only the tiles under the basin's bounding box
+            arr = masks.basin_values(inRaster, inMaskData)
+            print("Number of cells: " + str(arr.size))
+            profiler.lap("extract", arr.size)
+            if SAVE:
+                outExtractByMask = ExtractByMask(inRaster, inMaskData)
+                outExtractByMask.save(suboutput[i] + "\\dem.tif")
+                if DEBUG:
+                    print("ExtractByMask saved to: " + suboutput[i] + "\\dem.tif")
     ############################################################################################################
     # Step2: subbasin coverage
     ############################################################################################################
-        # Set local variables
-        inZoneData = outExtractByMask
-        # Execute GetCount
-        result[i][0] = arcpy.GetCount_management(inZoneData)
-        print("Number of cells: " + str(result[i][0].getOutput(0)))
-        # convert inZoneData to numpy array
-        arr = arcpy.RasterToNumPyArray(inZoneData)
-        # get unique values and their frequency of occurrence
-        for j in range(1,19):
-            result[i][j] = numpy.count_nonzero(arr == j)
-            if DEBUG:
-                print("Value " + str(j) + ": " + str(result[i][j]))
-        result[i][0] = sum(result[i][1:19])
+            # frequency of every class in a single histogram pass
+            arr = arr[(arr >= 0) & (arr <= NCLASSES)]
+            counts = numpy.bincount(arr.astype(numpy.int64), minlength=NCLASSES + 1)
+            result[1:] = [int(c) for c in counts[1:]]
+        if DEBUG:
+            for j in range(1, NCLASSES + 1):
+                print("Value " + str(j) + ": " + str(result[j]))
+        result[0] = sum(result[1:])
+        profiler.lap("stats", result[0])
         if DEBUG:
-            print("Total: " + str(result[i][0]))
+            print("Total: " + str(result[0]))
         # get percentage
-        for j in range(1,19):
-            result[i][j] = float(result[i][j]) / float(result[i][0])
+        for j in range(1, NCLASSES + 1):
+            result[j] = float(result[j]) / float(result[0])
             if DEBUG:
-                print("Value " + str(j) + ": " + str(result[i][j]))
+                print("Value " + str(j) + ": " + str(result[j]))
         
     
-    ############################################################################################################
-    # Finish, save result
-    ############################################################################################################
-        if XLSX:
-            ws.cell(i+2,1).value = subinput[i][:-4]
-            for j in range(1,19):
-                ws.cell(i+2,j+1).value = result[i][j]
-        else:
-            f.write(subinput[i][:-4] + "\t" +
-                    str(result[i][1]) + "\t" +
-                    str(result[i][2]) + "\t" +
-                    str(result[i][3]) + "\t" +
-                    str(result[i][4]) + "\t" +
-                    str(result[i][5]) + "\t" +
-                    str(result[i][6]) + "\t" +
-                    str(result[i][7]) + "\t" +
-                    str(result[i][8]) + "\t" +
-                    str(result[i][9]) + "\t" +
-                    str(result[i][10]) + "\t" +
-                    str(result[i][11]) + "\t" +
-                    str(result[i][12]) + "\t" +
-                    str(result[i][13]) + "\t" +
-                    str(result[i][14]) + "\t" +
-                    str(result[i][15]) + "\t" +
-                    str(result[i][16]) + "\t" +
-                    str(result[i][17]) + "\t" +
-                    str(result[i][18]) + "\t" +
-                    str(result[i][19]) + "\n")
-        
-        
-
         ############################################################################################################
         # Move the file to done folder
         ############################################################################################################
@@ -218,13 +177,63 @@ for i in range(len(subinput)):
         tbinfo = traceback.format_tb(tb)[0]
         pymsg = "ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n    " + str(sys.exc_info()[1])
         print(pymsg)
+        return i, None
+    return i, result[1:]
 
-    
-if XLSX:
-    wb.save(outputFolder + "\\result_coverage.xlsx")
-    print("Output saved to: " + outputFolder + "\\result_coverage.xlsx")
-else:
-    f.close()
-    print("Output saved to: " + outputFolder + "\\result_coverage.txt")
-
-print("All done!")
\ No newline at end of file
+############################################################################################################
+# Finish, save result
+############################################################################################################
+def write_result(row, name, record):
+    if XLSX:
+        ws.cell(row,1).value = name
+        for j in range(1, NCLASSES + 1):
+            ws.cell(row,j+1).value = record[j-1]
+    else:
+        f.write(name + "\t" +
+                "\t".join([str(value) for value in record]) + "\n")
+
+def save():
+    if XLSX:
+        wb.save(outputFolder + "\\result_coverage.xlsx")
+        print("Output saved to: " + outputFolder + "\\result_coverage.xlsx")
+    else:
+        f.close()
+        print("Output saved to: " + outputFolder + "\\result_coverage.txt")
+
+    print("All done!")
+
+if __name__ == '__main__':
+    # every finished basin is committed to the journal at once, a rerun only does the missing ones
+    journal = Journal(outputFolder + "\\journal_coverage.sqlite")
+    if not RESUME:
+        journal.clear()
+    profiler.reset()
+    done = journal.done()
+    todo = [i for i in range(len(subinput)) if subinput[i][:-4] not in done]
+    print("Subbasins already in journal: " + str(len(subinput) - len(todo)))
+    if ZONAL and todo:
+        profiler.begin("all")
+        classCounts = masks.basin_histograms([input], [subinput_dir + "\\" + sub for sub in subinput], NCLASSES + 1)[0]
+        profiler.lap("zonal")
+    # the zone statistics live in this process, workers only help the per-basin path
+    processes = PROCESSES if PARALLEL and not ZONAL else 1
+    if ZONAL:
+        results = parallel.run(process_subbasin, todo, processes, TASKS_PER_CHILD)
+    else:
+        # basins sharing raster tiles in one batch, batches along a Hilbert curve,
+        # so every tile is decoded once per batch
+        batches = masks.basin_batches(input, [subinput_dir + "\\" + subinput[i] for i in todo])
+        batches = [[todo[k] for k in batch] for batch in batches]
+        results = parallel.run_batches(process_subbasin, batches, processes, TASKS_PER_CHILD)
+    for i, record in results:
+        if record is not None:
+            journal.record(subinput[i][:-4], record)
+    # the report is built from the journal, so it holds the basins of earlier runs too
+    profiler.begin("all")
+    open_output()
+    for row, (name, record) in enumerate(journal.records()):
+        write_result(row + 2, name, record)
+    journal.close()
+    save()
+    profiler.lap("output")
+    profiler.summary()
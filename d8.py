@@ -0,0 +1,178 @@
+# D8 flow direction on numpy arrays
+# Drop-in for arcpy.sa.FlowDirection(dem, "NORMAL"), runs without ArcGIS
+import numpy
+
+############################################################################################################
+# ESRI direction codes
+############################################################################################################
+#   32  64  128
+#   16   x    1
+#    8   4    2
+D8_CODES = numpy.array([1, 2, 4, 8, 16, 32, 64, 128], dtype=numpy.uint8)
+# (row, col) offset of the neighbour each code points to, same order as D8_CODES
+D8_OFFSETS = ((0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1))
+# Value written to NoData cells, 0 is never a valid direction
+NODATA = 0
+# Order in which edge cells pick an outward direction: orthogonal first, then diagonal
+EDGE_ORDER = (0, 2, 4, 6, 1, 3, 5, 7)
+
+
+def step_lengths(cellsize=1.0):
+    # Distance to each neighbour in D8_CODES order, cellsize is a number or (dx, dy)
+    try:
+        dx, dy = cellsize
+    except TypeError:
+        dx = dy = cellsize
+    diag = (float(dx) ** 2 + float(dy) ** 2) ** 0.5
+    return numpy.array([dx, diag, dy, diag, dx, diag, dy, diag], dtype=numpy.float64)
+
+
+def as_elevation(dem, nodata=None):
+    # Float copy of dem with NoData cells set to NaN, int16/float32 input stays float32
+    z = numpy.asarray(dem)
+    z = z.astype(numpy.promote_types(z.dtype, numpy.float32))
+    if nodata is not None:
+        z[z == nodata] = numpy.nan
+    return z
+
+
+def padded(z):
+    # One-cell NaN border so every cell has eight neighbours
+    zp = numpy.empty((z.shape[0] + 2, z.shape[1] + 2), dtype=z.dtype)
+    zp.fill(numpy.nan)
+    zp[1:-1, 1:-1] = z
+    return zp
+
+
+def neighbour(zp, k):
+    # View of the padded array shifted so that [r, c] holds neighbour k of cell (r, c)
+    dr, dc = D8_OFFSETS[k]
+    rows, cols = zp.shape[0] - 2, zp.shape[1] - 2
+    return zp[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+
+
+def flow_direction(dem, nodata=None, cellsize=1.0):
+    """Steepest-descent D8 direction of every cell, as ESRI codes in a uint8 array.
+
+    Follows the rules of FlowDirection "NORMAL": edge cells (raster border or next to
+    NoData) without a downhill interior neighbour flow out of the raster, single-cell
+    pits flow to their lowest neighbour, and flats drain towards their nearest outlet.
+    Cells of a closed flat get the sum of their equal-height directions (undefined).
+    Equal steepest drops go to the first direction in D8_CODES order.
+    """
+    z = as_elevation(dem, nodata)
+    valid = ~numpy.isnan(z)
+    zp = padded(z)
+    dist = step_lengths(cellsize)
+
+    best = numpy.empty(z.shape, dtype=z.dtype)
+    best.fill(-numpy.inf)
+    out = numpy.zeros(z.shape, dtype=numpy.uint8)
+    # lowest neighbour by elevation alone, not weighted by distance, for the pits
+    lowest = numpy.empty(z.shape, dtype=z.dtype)
+    lowest.fill(numpy.inf)
+    low = numpy.zeros(z.shape, dtype=numpy.uint8)
+    edge = numpy.zeros(z.shape, dtype=bool)
+    with numpy.errstate(invalid="ignore"):
+        for k in range(8):
+            zn = neighbour(zp, k)
+            edge |= numpy.isnan(zn)
+            drop = (z - zn) / z.dtype.type(dist[k])
+            better = drop > best
+            best[better] = drop[better]
+            out[better] = D8_CODES[k]
+            lower = zn < lowest
+            lowest[lower] = zn[lower]
+            low[lower] = D8_CODES[k]
+        downhill = best > 0
+    edge &= valid
+
+    # edge cells that cannot drain inwards flow out of the raster
+    outward = edge & ~downhill
+    out[outward] = 0
+    for k in EDGE_ORDER:
+        missing = numpy.isnan(neighbour(zp, k)) & outward & (out == 0)
+        out[missing] = D8_CODES[k]
+
+    # pits flow to their lowest neighbour, flats are routed below
+    pit = valid & ~edge & (best < 0)
+    out[pit] = low[pit]
+    flat = valid & ~edge & (best == 0)
+    out[flat] = 0
+    out[~valid] = NODATA
+    if flat.any():
+        resolve_flats(z, out, flat)
+    return out
+
+
+def resolve_flats(z, out, flat):
+    # Breadth-first from the cells that already drain, one vectorized wave per step
+    rows, cols = z.shape
+    zf = z.ravel()
+    of = out.reshape(-1)
+    pending = flat.ravel().copy()
+    cand = numpy.flatnonzero(pending)
+    while cand.size:
+        r, c = cand // cols, cand % cols
+        codes = numpy.zeros(cand.size, dtype=numpy.uint8)
+        for k in range(8):
+            dr, dc = D8_OFFSETS[k]
+            nr, nc = r + dr, c + dc
+            ok = (codes == 0) & (nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols)
+            nidx = (nr * cols + nc)[ok]
+            hit = ~pending[nidx] & (of[nidx] != NODATA) & (zf[nidx] == zf[cand[ok]])
+            sel = numpy.flatnonzero(ok)[hit]
+            codes[sel] = D8_CODES[k]
+        got = cand[codes != 0]
+        of[got] = codes[codes != 0]
+        pending[got] = False
+        # next wave: pending cells of the same height next to the cells just assigned
+        nxt = []
+        r, c = got // cols, got % cols
+        for k in range(8):
+            dr, dc = D8_OFFSETS[k]
+            nr, nc = r + dr, c + dc
+            ok = (nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols)
+            nidx = nr[ok] * cols + nc[ok]
+            keep = pending[nidx] & (zf[nidx] == zf[got[ok]])
+            nxt.append(nidx[keep])
+        cand = numpy.unique(numpy.concatenate(nxt)) if nxt else cand[:0]
+
+    # closed flats have no outlet: undefined direction, the sum of the equal-height directions
+    left = numpy.flatnonzero(pending)
+    if left.size:
+        r, c = left // cols, left % cols
+        codes = numpy.zeros(left.size, dtype=numpy.uint8)
+        for k in range(8):
+            dr, dc = D8_OFFSETS[k]
+            nr, nc = r + dr, c + dc
+            ok = (nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols)
+            sel = numpy.flatnonzero(ok)
+            nidx = nr[ok] * cols + nc[ok]
+            codes[sel[zf[nidx] == zf[left[ok]]]] += D8_CODES[k]
+        of[left] = codes
+    return out
+
+
+def receivers(direction):
+    """Flat index of the cell each cell drains to, -1 where the flow leaves the grid.
+
+    Undefined directions, NoData cells and cells pointing out of the raster or into
+    NoData have no receiver. Indices are int32 unless the grid is too large for it.
+    """
+    direction = numpy.asarray(direction)
+    rows, cols = direction.shape
+    n = rows * cols
+    itype = numpy.int32 if n < 2 ** 31 else numpy.int64
+    recv = numpy.empty(n, dtype=itype)
+    recv.fill(-1)
+    df = direction.ravel()
+    for k in range(8):
+        dr, dc = D8_OFFSETS[k]
+        idx = numpy.flatnonzero(df == D8_CODES[k]).astype(itype)
+        r, c = idx // cols + dr, idx % cols + dc
+        idx = idx[(r >= 0) & (r < rows) & (c >= 0) & (c < cols)]
+        target = idx + itype(dr * cols + dc)
+        ok = df[target] != NODATA
+        recv[idx[ok]] = target[ok]
+    return recv
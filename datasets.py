@@ -0,0 +1,99 @@
+# Layers and column headers of every dataset, shared by the scripts and the pipeline.py plugins
+# Analyze.py, sand.py, coverage.py, ndvi.py and pipeline.py take them from here, so the same data
+# lands in the same columns in the same order whichever path computed it
+import os
+import re
+
+############################################################################################################
+# Terrain (Analyze.py)
+############################################################################################################
+TERRAIN_COLUMNS = ['Subbasin Average Height', 'Subbasin Area(km^2)', 'Subbasin River Length(km)',
+                   'Subbasin River Density(km/km^2)', 'Subbasin River Average Slope(Degree)',
+                   'Subbasin River Average TWI']
+# Percentiles of height, slope and TWI and the hypsometric integral (DISTRIBUTION)
+DISTRIBUTION_COLUMNS = ['Subbasin Height P10', 'Subbasin Median Height', 'Subbasin Height P90',
+                        'Subbasin Hypsometric Integral', 'Subbasin Slope P10(Degree)',
+                        'Subbasin Median Slope(Degree)', 'Subbasin Slope P90(Degree)',
+                        'Subbasin TWI P10', 'Subbasin Median TWI', 'Subbasin TWI P90']
+
+
+def distribution_record(height, slope, twi, k=None):
+    # DISTRIBUTION_COLUMNS from zonal.ZonalQuantiles results, of basin k when they hold arrays
+    pick = lambda dist, key: float(dist[key] if k is None else dist[key][k])
+    return ([pick(height, key) for key in ("p10", "median", "p90", "hypsometric")] +
+            [pick(slope, key) for key in ("p10", "median", "p90")] +
+            [pick(twi, key) for key in ("p10", "median", "p90")])
+
+
+############################################################################################################
+# Soil (sand.py)
+############################################################################################################
+# Clay, gravel, silt and sand content of the six depths, in column order
+SOIL_LAYERS = tuple(kind + str(depth) for kind in ("CLAY", "GRAV", "SILT", "SAND") for depth in range(1, 7))
+
+
+def soil_layer(name):
+    # Position in SOIL_LAYERS of the layer a file name holds, None if it holds none
+    stem = os.path.splitext(os.path.basename(name))[0].upper()
+    for k, layer in enumerate(SOIL_LAYERS):
+        if re.search(layer + r"(?!\d)", stem):
+            return k
+    return None
+
+
+def soil_files(folder):
+    """The .tif layers of folder in SOIL_LAYERS order, files naming no layer last by name."""
+    files = [file for file in os.listdir(folder) if file.endswith(".tif")]
+    rank = lambda file: (len(SOIL_LAYERS), file) if soil_layer(file) is None else (soil_layer(file), file)
+    return sorted(files, key=rank)
+
+
+def soil_columns(files):
+    # Header of every soil layer file: its SOIL_LAYERS name, or the file name without .tif
+    return [file[:-4] if soil_layer(file) is None else SOIL_LAYERS[soil_layer(file)] for file in files]
+
+
+############################################################################################################
+# Land cover (coverage.py), NALCMS classes 1..19
+############################################################################################################
+COVERAGE_CLASSES = ("Temperate or sub-polar needleleaf forest", "Sub-polar taiga needleleaf forest",
+                    "Tropical or sub-tropical broadleaf evergreen forest",
+                    "Tropical or sub-tropical broadleaf deciduous forest",
+                    "Temperate or sub-polar broadleaf deciduous forest", "Mixed forest",
+                    "Tropical or sub-tropical shrubland", "Temperate or sub-polar shrubland",
+                    "Tropical or sub-tropical grassland", "Temperate or sub-polar grassland",
+                    "Sub-polar or polar shrubland-lichen-moss", "Sub-polar or polar grassland-lichen-moss",
+                    "Sub-polar or polar barren-lichen-moss", "Wetland", "Cropland", "Barren land",
+                    "Urban and built-up", "Water", "Permanent snow and ice")
+COVERAGE_COLUMNS = [name + " Coverage" for name in COVERAGE_CLASSES]
+
+
+############################################################################################################
+# NDVI (ndvi.py)
+############################################################################################################
+YEAR = re.compile(r"(19|20)\d\d")
+
+
+def year_of(name, default=None):
+    # year of a yearly raster, taken from the file name
+    match = YEAR.search(name)
+    if match:
+        return int(match.group())
+    return default
+
+
+def yearly_files(folder):
+    """(files, years) of the .tif rasters of folder by year; files naming no year are skipped."""
+    files = []
+    for file in sorted(file for file in os.listdir(folder) if file.endswith(".tif")):
+        if year_of(file) is None:
+            # an invented year would bend the NDVI trend
+            print("No year in the name of " + file + ", skipped")
+        else:
+            files.append(file)
+    files.sort(key=year_of)
+    return files, [year_of(file) for file in files]
+
+
+def ndvi_columns(years):
+    return ["Average NDVI", "NDVI Trend(per year)"] + ["NDVI " + str(year) for year in years]
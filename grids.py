@@ -0,0 +1,75 @@
+# Registry of basin zone grids, one per distinct raster grid
+# Zone grids are kept as .npy files and memory-mapped, so reruns and other datasets on the same grid load them
+import hashlib
+import json
+import os
+
+import numpy
+
+import zonal
+
+# files of a shapefile besides the .shp; geometry, attributes and projection all shape the grid
+SIDECARS = (".shx", ".dbf", ".prj", ".cpg")
+
+
+def fingerprint(key, shapefiles):
+    """Name of the zone grid of shapefiles on the grid described by key.
+
+    key fingerprints the raster grid (origin, size, cell size, coordinate system,
+    see masks.grid_key); the shapefiles enter with the path, size and mtime of the
+    .shp and of its SIDECARS present, so an edited basin gets a new grid.
+    """
+    stamps = []
+    for path in shapefiles:
+        base = os.path.splitext(path)[0]
+        for name in [path] + [base + ext for ext in SIDECARS]:
+            if name == path or os.path.exists(name):
+                st = os.stat(name)
+                stamps.append([os.path.abspath(name), st.st_size, st.st_mtime])
+    text = json.dumps([list(key), stamps], sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class Registry(object):
+    """Zone grids by fingerprint, in memory for this process and in folder between runs.
+
+    get(key, shapefiles, build) returns (zones, row0, col0) as masks.zone_grid does;
+    build() is only called for a grid that is neither loaded nor on disk. A grid on
+    disk is memory-mapped read-only, so loading it costs no pass over the cells.
+    """
+
+    def __init__(self, folder=None):
+        self.folder = folder
+        self.grids = {}
+
+    def get(self, key, shapefiles, build):
+        name = fingerprint(key, shapefiles)
+        if name not in self.grids:
+            out = self.load(name) if self.folder else None
+            if out is None:
+                out = build()
+                if self.folder:
+                    self.save(name, out)
+            self.grids[name] = out
+        return self.grids[name]
+
+    def load(self, name):
+        meta = os.path.join(self.folder, name + ".json")
+        if not os.path.exists(meta):
+            return None
+        with open(meta) as f:
+            info = json.load(f)
+        zones = zonal.ZoneGrid((0, 0), info["nbasins"])
+        zones.grid = numpy.load(os.path.join(self.folder, name + ".npy"), mmap_mode="r")
+        zones.members = [tuple(m) for m in info["members"]]
+        return zones, info["row0"], info["col0"]
+
+    def save(self, name, out):
+        zones, row0, col0 = out
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        numpy.save(os.path.join(self.folder, name + ".npy"), zones.grid)
+        # the description goes last, an interrupted save is never taken for a valid grid
+        with open(os.path.join(self.folder, name + ".json"), "w") as f:
+            json.dump({"nbasins": zones.nbasins, "members": [list(m) for m in zones.members],
+                       "row0": int(row0), "col0": int(col0)}, f)
@@ -0,0 +1,129 @@
+# Crash-safe results journal
+# Every basin's record is committed to SQLite as soon as it is computed, reruns skip them
+# Aggregates keeps per-source partial sums so a rerun only reduces new or changed rasters
+import json
+import os
+import sqlite3
+import time
+
+
+class Journal(object):
+    """Append-only table of (basin, record) rows in an SQLite file.
+
+    A record is a list of plain values stored as JSON. Rows are committed one by
+    one, so a crash loses at most the basin that was being processed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "basin TEXT PRIMARY KEY, record TEXT NOT NULL, time REAL NOT NULL)")
+        self.db.commit()
+
+    def done(self):
+        # names of the basins already recorded
+        return set(row[0] for row in self.db.execute("SELECT basin FROM results"))
+
+    def record(self, basin, values):
+        self.db.execute("INSERT OR REPLACE INTO results (basin, record, time) VALUES (?, ?, ?)",
+                        (basin, json.dumps(list(values)), time.time()))
+        self.db.commit()
+
+    def records(self):
+        # (basin, values) in the order they were first recorded
+        for basin, record in self.db.execute("SELECT basin, record FROM results ORDER BY rowid"):
+            yield basin, json.loads(record)
+
+    def clear(self):
+        self.db.execute("DELETE FROM results")
+        self.db.commit()
+
+    def keyed(self, key):
+        """Clear the records unless key (plain values, e.g. the input files and their
+        stamps) is the one stored with them, then store key. Returns True if cleared."""
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        text = json.dumps(key, sort_keys=True)
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'key'").fetchone()
+        if row is not None and row[0] == text:
+            return False
+        self.db.execute("DELETE FROM results")
+        self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('key', ?)", (text,))
+        self.db.commit()
+        return True
+
+    def close(self):
+        self.db.close()
+
+
+class Aggregates(object):
+    """Per-basin partial sums of source rasters, keyed by the source file.
+
+    Each source is stored with the size and modification time of its file; when
+    either changes (or a basin is missing) the source is stale and has to be
+    reduced again. Sums and counts merge exactly, so averages over many sources
+    are rebuilt from the table without reading any raster.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sources ("
+                        "source TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sums ("
+                        "source TEXT NOT NULL, basin TEXT NOT NULL, count INTEGER NOT NULL, "
+                        "sum REAL NOT NULL, PRIMARY KEY (source, basin))")
+        self.db.commit()
+
+    @staticmethod
+    def stamp(source):
+        st = os.stat(source)
+        return st.st_size, st.st_mtime
+
+    def stale(self, sources, basins):
+        # sources that are new, changed on disk or lack one of basins
+        out = []
+        for source in sources:
+            row = self.db.execute("SELECT size, mtime FROM sources WHERE source = ?", (source,)).fetchone()
+            if row is None or tuple(row) != self.stamp(source):
+                out.append(source)
+                continue
+            have = set(b for (b,) in self.db.execute("SELECT basin FROM sums WHERE source = ?", (source,)))
+            if not have.issuperset(basins):
+                out.append(source)
+        return out
+
+    def store(self, source, basins, count, total):
+        # replace the sums of source in one transaction, count[i] and total[i] belong to basins[i]
+        size, mtime = self.stamp(source)
+        with self.db:
+            self.db.execute("DELETE FROM sums WHERE source = ?", (source,))
+            self.db.executemany("INSERT INTO sums (source, basin, count, sum) VALUES (?, ?, ?, ?)",
+                                [(source, b, int(n), float(s)) for b, n, s in zip(basins, count, total)])
+            self.db.execute("INSERT OR REPLACE INTO sources (source, size, mtime) VALUES (?, ?, ?)",
+                            (source, size, mtime))
+
+    def load(self, source, basins):
+        # (count, sum) lists of source in the order of basins, 0 for unknown basins
+        rows = dict((b, (n, s)) for b, n, s in
+                    self.db.execute("SELECT basin, count, sum FROM sums WHERE source = ?", (source,)))
+        count = [rows.get(b, (0, 0.0))[0] for b in basins]
+        total = [rows.get(b, (0, 0.0))[1] for b in basins]
+        return count, total
+
+    def forget(self, keep):
+        # drop every source not in keep (rasters removed from the archive)
+        keep = set(keep)
+        gone = [source for (source,) in self.db.execute("SELECT source FROM sources") if source not in keep]
+        with self.db:
+            for source in gone:
+                self.db.execute("DELETE FROM sums WHERE source = ?", (source,))
+                self.db.execute("DELETE FROM sources WHERE source = ?", (source,))
+        return gone
+
+    def close(self):
+        self.db.close()
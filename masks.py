@@ -0,0 +1,252 @@
+# Basin zone grids on the grid of a source raster, built with arcpy
+# Requirements: Spatial Analyst Extension
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import arcpy
+import numpy
+
+import boundary
+import grids
+import raster
+import spatial
+import zonal
+
+# Rows read from the source raster per RasterToNumPyArray call
+BLOCK_ROWS = 2048
+# Burn basins with boundary.py instead of PolygonToRaster when the shapefile is in the
+# coordinate system of the raster, no geoprocessing call per basin
+NATIVE = True
+# Folder the zone grids are kept in between runs, see grids.py; None builds them once per run
+ZONE_FOLDER = None
+
+# A raster reduced per basin: path, accumulator(natoms) making a fresh per-atom accumulator
+# (zonal.ZonalStats, zonal.ZonalHistogram...), and array, None to read the file at path or
+# the values themselves on the grid of path (NaN for NoData)
+Layer = namedtuple("Layer", ["path", "accumulator", "array"])
+
+
+def grid_key(raster):
+    # Rasters with the same key share cells, so they can share a zone grid
+    ext = raster.extent
+    return (round(ext.XMin, 6), round(ext.YMax, 6), raster.width, raster.height,
+            round(raster.meanCellWidth, 9), round(raster.meanCellHeight, 9),
+            raster.spatialReference.name)
+
+
+def same_projection(shapefile, src):
+    # The shapefile's .prj describes the spatial reference of src
+    prj = os.path.splitext(shapefile)[0] + ".prj"
+    return os.path.exists(prj) and arcpy.SpatialReference(prj).name == src.spatialReference.name
+
+
+def rasterize(shapefile, src):
+    # Cell-centre mask of a basin on the grid of src, with its (row, col) in src
+    if NATIVE and same_projection(shapefile, src):
+        transform = (src.extent.XMin, src.meanCellWidth, src.extent.YMax, -src.meanCellHeight)
+        return boundary.basin_mask(shapefile, transform, (src.height, src.width))
+    oldSnap, oldSR = arcpy.env.snapRaster, arcpy.env.outputCoordinateSystem
+    arcpy.env.snapRaster = src
+    arcpy.env.outputCoordinateSystem = src.spatialReference
+    try:
+        tmp = "in_memory\\basin_zone"
+        arcpy.PolygonToRaster_conversion(shapefile, "FID", tmp, "CELL_CENTER", "", src.meanCellWidth)
+        out = arcpy.Raster(tmp)
+        mask = arcpy.RasterToNumPyArray(out, nodata_to_value=-1) >= 0
+        col0 = int(round((out.extent.XMin - src.extent.XMin) / src.meanCellWidth))
+        row0 = int(round((src.extent.YMax - out.extent.YMax) / src.meanCellHeight))
+        arcpy.Delete_management(tmp)
+    finally:
+        arcpy.env.snapRaster, arcpy.env.outputCoordinateSystem = oldSnap, oldSR
+    # clip to the raster
+    r0, c0 = max(row0, 0), max(col0, 0)
+    mask = mask[r0 - row0:, c0 - col0:]
+    mask = mask[:max(src.height - r0, 0), :max(src.width - c0, 0)]
+    return mask, r0, c0
+
+
+def zone_grid(src, shapefiles):
+    """ZoneGrid of all basins over the window of src they cover.
+
+    Returns (zones, row0, col0), the grid's top-left cell in src.
+    """
+    burned = []
+    for b, shapefile in enumerate(shapefiles):
+        mask, row0, col0 = rasterize(shapefile, src)
+        if mask.any():
+            # packed to 1 bit per cell until the union window is known
+            burned.append((b, numpy.packbits(mask, axis=None), mask.shape, row0, col0))
+    if not burned:
+        return zonal.ZoneGrid((0, 0), len(shapefiles)), 0, 0
+    top = min(x[3] for x in burned)
+    left = min(x[4] for x in burned)
+    bottom = max(x[3] + x[2][0] for x in burned)
+    right = max(x[4] + x[2][1] for x in burned)
+    zones = zonal.ZoneGrid((bottom - top, right - left), len(shapefiles))
+    for b, bits, shape, row0, col0 in burned:
+        mask = numpy.unpackbits(bits)[:shape[0] * shape[1]].reshape(shape).astype(bool)
+        zones.burn(b, mask, row0 - top, col0 - left)
+    return zones, top, left
+
+
+# arcpy is not thread-safe, its calls from the read-ahead threads (see prefetch.py) take turns
+ARCPY = threading.RLock()
+
+# Zone grids of this process, by grid and basins
+registry = None
+
+
+def zones_for(src, shapefiles):
+    # zone_grid of src, built once per distinct grid (and kept in ZONE_FOLDER when set)
+    global registry
+    if registry is None or registry.folder != ZONE_FOLDER:
+        registry = grids.Registry(ZONE_FOLDER)
+    return registry.get(grid_key(src) + (NATIVE,), shapefiles, lambda: zone_grid(src, shapefiles))
+
+
+def read_block(src, row0, col0, nrows, ncols):
+    # Cells [row0:row0+nrows, col0:col0+ncols] of src
+    with ARCPY:
+        lowerLeft = arcpy.Point(src.extent.XMin + col0 * src.meanCellWidth,
+                                src.extent.YMax - (row0 + nrows) * src.meanCellHeight)
+        if src.noDataValue is None:
+            return arcpy.RasterToNumPyArray(src, lowerLeft, ncols, nrows)
+        return arcpy.RasterToNumPyArray(src, lowerLeft, ncols, nrows, src.noDataValue)
+
+
+# Open tile-aware readers, by path
+readers = {}
+
+
+def block_reader(path, src):
+    # read(row0, col0, nrows, ncols) for path: the GeoTIFF reader decodes only the
+    # tiles a window touches, arcpy is used for anything it cannot read
+    if path not in readers:
+        tif = None
+        if path.lower().endswith((".tif", ".tiff")):
+            tif = raster.open_raster(path)
+        if tif is not None and (tif.width, tif.height) != (src.width, src.height):
+            tif = None
+        readers[path] = tif
+    if readers[path] is not None:
+        return readers[path].read
+    return lambda row0, col0, nrows, ncols: read_block(src, row0, col0, nrows, ncols)
+
+
+def basin_batches(path, shapefiles):
+    """Basin indices in batches that share blocks of the raster at path, see spatial.block_batches."""
+    tif = raster.open_raster(path)
+    if tif is not None:
+        transform, block = tif.transform, tif.block_shape
+    else:
+        src = arcpy.Raster(path)
+        transform = (src.extent.XMin, src.meanCellWidth, src.extent.YMax, -src.meanCellHeight)
+        block = (BLOCK_ROWS, src.width)
+    return spatial.block_batches([boundary.shapefile_bbox(s) for s in shapefiles], transform, block)
+
+
+def basin_layers(paths, shapefile):
+    """Values of the cells of one basin in every raster, read from its bounding box only.
+
+    The basin is burned once per distinct grid. Safe to call from several threads:
+    the arcpy calls take turns, GeoTIFF windows are decoded concurrently.
+    """
+    burned = {}
+    out = []
+    for path in paths:
+        with ARCPY:
+            src = arcpy.Raster(path)
+            key = grid_key(src)
+            if key not in burned:
+                burned[key] = rasterize(shapefile, src)
+            read = block_reader(path, src)
+            nodata = src.noDataValue
+        mask, row0, col0 = burned[key]
+        values = read(row0, col0, mask.shape[0], mask.shape[1])[mask]
+        if nodata is not None:
+            values = values[values != nodata]
+        out.append(values)
+    return out
+
+
+def basin_values(path, shapefile):
+    # Values of the cells of one basin, read from the basin's bounding box only
+    return basin_layers([path], shapefile)[0]
+
+
+def reduce_raster(src, zones, row0, col0, acc, read=None):
+    # Feed src block by block over the zone grid window into a per-atom accumulator,
+    # then merge the atoms into per-basin results
+    if read is None:
+        read = lambda r0, c0, nr, nc: read_block(src, r0, c0, nr, nc)
+    nrows, ncols = zones.grid.shape
+    for r in range(0, nrows, BLOCK_ROWS):
+        n = min(BLOCK_ROWS, nrows - r)
+        acc.add(zones.grid[r:r + n], read(row0 + r, col0, n, ncols), src.noDataValue)
+    groups, atoms = zones.pairs()
+    return acc.combine(groups, atoms, zones.nbasins).result()
+
+
+def basin_reduce(rasters, shapefiles, accumulator):
+    # accumulator(natoms) makes a fresh per-atom accumulator for each raster;
+    # the zone grid is built once for every distinct raster grid
+    out = []
+    for path in rasters:
+        src = arcpy.Raster(path)
+        zones, row0, col0 = zones_for(src, shapefiles)
+        out.append(reduce_raster(src, zones, row0, col0, accumulator(zones.natoms), block_reader(path, src)))
+    return out
+
+
+def basin_stats(rasters, shapefiles):
+    """Per-basin statistics of every raster, see zonal.zonal_stats for the keys."""
+    return basin_reduce(rasters, shapefiles, zonal.ZonalStats)
+
+
+def reduce_layers(layers, shapefiles):
+    """Per-basin results of every Layer, in order, with one zone grid per raster grid.
+
+    Layers on the same grid are read as one (layer, row, col) stack: the basins are
+    burned once, each block of the shared zone grid selects its basin cells once
+    and every layer is reduced over the same selection.
+    """
+    stacks = OrderedDict()
+    for k, layer in enumerate(layers):
+        src = arcpy.Raster(layer.path)
+        stacks.setdefault(grid_key(src), []).append((k, layer, src))
+    out = [None] * len(layers)
+    for group in stacks.values():
+        zones, row0, col0 = zones_for(group[0][2], shapefiles)
+        accs, reads = [], []
+        for k, layer, src in group:
+            accs.append(layer.accumulator(zones.natoms))
+            if layer.array is None:
+                reads.append((block_reader(layer.path, src), src.noDataValue))
+            else:
+                reads.append((lambda r0, c0, nr, nc, a=layer.array: a[r0:r0 + nr, c0:c0 + nc], None))
+        nrows, ncols = zones.grid.shape
+        for r in range(0, nrows, BLOCK_ROWS):
+            n = min(BLOCK_ROWS, nrows - r)
+            z = zones.grid[r:r + n].ravel()
+            sel = numpy.flatnonzero(z)
+            z = z[sel]
+            for acc, (read, nodata) in zip(accs, reads):
+                acc.add_cells(z, numpy.asarray(read(row0 + r, col0, n, ncols)).ravel()[sel], nodata)
+        groups, atoms = zones.pairs()
+        for acc, (k, layer, src) in zip(accs, group):
+            out[k] = acc.combine(groups, atoms, zones.nbasins).result()
+    return out
+
+
+def stack_stats(rasters, shapefiles):
+    """Per-basin statistics of a time stack of rasters (e.g. one per year), in order.
+
+    Rasters on the same grid share the basin cell selection, see reduce_layers.
+    """
+    return reduce_layers([Layer(path, zonal.ZonalStats, None) for path in rasters], shapefiles)
+
+
+def basin_histograms(rasters, shapefiles, nclasses):
+    """Per-basin class counts of every raster, arrays of shape (basins, nclasses)."""
+    return basin_reduce(rasters, shapefiles, lambda natoms: zonal.ZonalHistogram(natoms, nclasses))
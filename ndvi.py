@@ -5,6 +5,12 @@ from arcpy.sa import *
 import os
 import sys
 import numpy
+import masks
+import zonal
+import parallel
+import datasets
+from journal import Journal, Aggregates
+from profiling import Profiler
 
 XLSX = True
 try:
@@ -16,6 +22,22 @@ except ImportError:
 DEBUG = True
 TEST = True
 SAVE = False
+# Compute all basins in one pass over the stack of yearly rasters instead of ExtractByMask per basin
+ZONAL = True
+# Skip basins already in the results journal, False starts from an empty journal
+RESUME = True
+# Keep per-year basin sums between runs (ZONAL only), a rerun reads only new or changed years
+INCREMENTAL = True
+# Process basins in a pool of worker processes (per-basin path only)
+PARALLEL = False
+# Worker processes, None uses every core
+PROCESSES = None
+# Basins per worker before it is recycled
+TASKS_PER_CHILD = parallel.TASKS_PER_CHILD
+# Read the years of the next basins in background threads while one is reduced (per-basin path only)
+PREFETCH = True
+# Time every step of every basin into output\profile_ndvi.jsonl and print a summary at the end
+PROFILE = True
 
 ############################################################################################################
 # Set environment settings
@@ -40,10 +62,10 @@ print("Output folder set to: " + outputFolder)
 
 # Set overall input
 input = inputFolder + "\\global_ndvi\\"
-subinputyear = []
-for file in os.listdir(input):
-    if file.endswith(".tif"):
-        subinputyear.append(file)
+# yearly rasters by year, the year taken from the file name
+subinputyear, years = datasets.yearly_files(input)
+if DEBUG:
+    print("Years: " + str(years))
         
 
 # Get list of subinput
@@ -67,23 +89,30 @@ if DEBUG:
     print("Suboutput list: " + str(suboutput))
     print("Number of suboutput: " + str(len(suboutput)))
 
+profiler = Profiler(outputFolder + "\\profile_ndvi.jsonl", PROFILE)
+# basin zone grids are kept in output\zones, later runs and datasets on the same grid load them
+masks.ZONE_FOLDER = outputFolder + "\\zones"
+
 if TEST:
     subinput = ["3078000.shp"]
     suboutput = [outputFolder + "\\" + sub[:-4] for sub in subinput]
     print("test subinput: " + str(subinput))
     print("test suboutput: " + str(suboutput))
 
-# data structure for each subbasin
-subbasin = {}
-# Save output to excel
-if XLSX:
-    wb = Workbook()
-    wb.create_sheet('Sheet1', 0)
-    ws = wb.active
-    ws.cell(1,1).value = "Subbasin Number"
-    ws.cell(1,2).value = "Average NDVI"
-else:
-    f = open(outputFolder + "\\result.txt", "w")
+# Save output to excel, only the parent process writes output
+def open_output():
+    global wb, ws, f
+    if XLSX:
+        wb = Workbook()
+        wb.create_sheet('Sheet1', 0)
+        ws = wb.active
+        ws.cell(1,1).value = "Subbasin Number"
+        columns = datasets.ndvi_columns(years)
+        for j in range(len(columns)):
+            ws.cell(1,j+2).value = columns[j]
+    else:
+        f = open(outputFolder + "\\result.txt", "w")
+        f.write("Subbasin Number\t" + "\t".join(datasets.ndvi_columns(years)) + "\n")
     
 
 ###########################################################################################################
@@ -91,50 +120,59 @@ else:
 ############################################################################################################
 # Step0: Iterate through subinput
 ############################################################################################################
-# data structure for each subbasin
-result = [[] for i in range(len(subinput))]
-# parallel processing
-import multiprocessing
-from multiprocessing import Pool
+def read_years(i):
+    # cells of every yearly raster under basin i
+    return masks.basin_layers([input + j for j in subinputyear], subinput_dir + "\\" + subinput[i])
 
-def process_subbasin(i):
+# Returns (i, record) with the plain values of basin i, record is None on error;
+# layers are the basin's cells of every year when they were read ahead
+def process_subbasin(i, layers=None):
+    # data structure for each subbasin
+    result = []
     try:
         print("Processing subbasin: " + subinput[i])
+        profiler.begin(subinput[i][:-4])
         # set workspace to suboutput
         env.workspace = suboutput[i]
         print("Workspace set to: " + suboutput[i])
     ############################################################################################################
     # Step1: Extract by mask
     ############################################################################################################
+        if not ZONAL and layers is None:
+            # the basin is burned once per grid for all years
+            layers = read_years(i)
         # Set local variables
-        for j in subinputyear:
+        for k, j in enumerate(subinputyear):
+            if ZONAL:
+                mean = float(yearStats[j]["mean"][i])
+                result.append(mean)
+                if DEBUG:
+                    print("Mean: " + str(mean))
+                continue
             inRaster = inputFolder + "\\global_ndvi\\" + j
             inMaskData = inputFolder + "\\Boundary\\Ohio\\" + subinput[i]
             if DEBUG:
                 print("inRaster: " + inRaster)
                 print("inMaskData: " + inMaskData)
-            # Execute ExtractByMask
-            outExtractByMask = ExtractByMask(inRaster, inMaskData)
-            if outExtractByMask is None:
-                print("Error extracting by mask")
-            else:
-                result[i].append(float(arcpy.GetRasterProperties_management(outExtractByMask, "MEAN").getOutput(0)))
+            # int16 cells of the basin in their own type, read from its bounding box only
+            arr = layers[k]
+            profiler.lap("extract", arr.size)
+            if SAVE:
+                outExtractByMask = ExtractByMask(inRaster, inMaskData)
+                outExtractByMask.save(j[:-4] + "_extract.tif")
+            # summed exactly in int64, scaled only in the record
+            result.append(float(zonal.exact_sum(arr)) / arr.size if arr.size else float("nan"))
+            profiler.lap("stats", arr.size)
             if DEBUG:
-                print("Mean: " + str(result[i][-1]))
+                print("Mean: " + str(result[-1]))
 
-        subbasin_result = sum(result[i])/float(len(result[i]))/10000.0
+        valid = [mean for mean in result if not numpy.isnan(mean)]
+        subbasin_result = sum(valid)/float(len(valid))/10000.0
         print("Average NDVI: " + str(subbasin_result))
-    
-    ############################################################################################################
-    # Finish, save result
-    ############################################################################################################
-        if XLSX:
-            ws.cell(i+2,1).value = subinput[i][:-4]
-            ws.cell(i+2,2).value = subbasin_result
-        else:
-            f.write(subinput[i][:-4] + "\t")
-            f.write(str(subbasin_result) + "\t")
-            f.write("\n")
+        # least-squares slope of the yearly means
+        trend = float(zonal.linear_trend(years, numpy.array(result)[:, None])[0]) / 10000.0
+        print("NDVI Trend: " + str(trend))
+        profiler.lap("trend")
             
         ############################################################################################################
         # Move the file to done folder
@@ -150,6 +188,24 @@ def process_subbasin(i):
         tbinfo = traceback.format_tb(tb)[0]
         pymsg = "ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n    " + str(sys.exc_info()[1])
         print(pymsg)
+        return i, None
+    return i, [subbasin_result, trend] + [mean / 10000.0 for mean in result]
+
+############################################################################################################
+# Finish, save result
+############################################################################################################
+def write_result(row, name, record):
+    if XLSX:
+        ws.cell(row,1).value = name
+        for j in range(len(record)):
+            # empty cell for years without data
+            if not numpy.isnan(record[j]):
+                ws.cell(row,j+2).value = record[j]
+    else:
+        f.write(name + "\t")
+        for value in record:
+            f.write(str(value) + "\t")
+        f.write("\n")
 
 def save():
     if XLSX:
@@ -162,10 +218,57 @@ def save():
     print("All done!")
 
 if __name__ == '__main__':
-    """ pool = Pool()
-    pool.map(process_subbasin, range(len(subinput)))
-    pool.close()
-    pool.join() """
-    for i in range(len(subinput)):
-        process_subbasin(i)
+    # every finished basin is committed to the journal at once, a rerun only does the missing ones
+    journal = Journal(outputFolder + "\\journal_ndvi.sqlite")
+    if not RESUME:
+        journal.clear()
+    # the year columns of every record follow the year files, a new, changed or removed year clears them
+    if journal.keyed([[j] + list(Aggregates.stamp(input + j)) for j in subinputyear]):
+        print("Year files changed, journal cleared")
+    profiler.reset()
+    names = [sub[:-4] for sub in subinput]
+    if ZONAL:
+        # per-year sums and counts of every basin, keyed by the year file's path, size and mtime
+        aggregates = Aggregates(outputFolder + "\\aggregates_ndvi.sqlite")
+        sources = [input + j for j in subinputyear]
+        aggregates.forget(sources)
+        stale = aggregates.stale(sources, names) if INCREMENTAL else sources
+        print("Years to compute: " + str(len(stale)) + " of " + str(len(sources)))
+        if stale:
+            profiler.begin("all")
+            shapes = [subinput_dir + "\\" + sub for sub in subinput]
+            for source, stats in zip(stale, masks.stack_stats(stale, shapes)):
+                aggregates.store(source, names, stats["count"], stats["sum"])
+            profiler.lap("zonal")
+        yearStats = {}
+        for j, source in zip(subinputyear, sources):
+            count, total = aggregates.load(source, names)
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                yearStats[j] = {"mean": numpy.array(total) / numpy.array(count, dtype=numpy.float64)}
+        aggregates.close()
+    done = journal.done()
+    todo = [i for i in range(len(subinput)) if names[i] not in done]
+    print("Subbasins already in journal: " + str(len(subinput) - len(todo)))
+    # the zone statistics live in this process, workers only help the per-basin path
+    processes = PROCESSES if PARALLEL and not ZONAL else 1
+    if ZONAL:
+        results = parallel.run(process_subbasin, todo, processes, TASKS_PER_CHILD)
+    else:
+        # basins sharing raster tiles in one batch, batches along a Hilbert curve,
+        # so every tile is decoded once per batch (the years share one grid)
+        batches = masks.basin_batches(input + subinputyear[0], [subinput_dir + "\\" + subinput[i] for i in todo])
+        batches = [[todo[k] for k in batch] for batch in batches]
+        results = parallel.run_batches(process_subbasin, batches, processes, TASKS_PER_CHILD,
+                                       read_years if PREFETCH else None)
+    for i, record in results:
+        if record is not None:
+            journal.record(subinput[i][:-4], record)
+    # the report is built from the journal, so it holds the basins of earlier runs too
+    profiler.begin("all")
+    open_output()
+    for row, (name, record) in enumerate(journal.records()):
+        write_result(row + 2, name, record)
+    journal.close()
     save()
+    profiler.lap("output")
+    profiler.summary()
@@ -0,0 +1,61 @@
+# Process pool for per-subbasin work
+# Workers return plain result records, only the parent process writes the output
+import multiprocessing
+
+import prefetch
+
+# Basins a worker process handles before it is replaced by a fresh one,
+# keeps the arcpy memory leak from building up over a long batch
+TASKS_PER_CHILD = 10
+
+
+def run(worker, items, processes=None, tasks_per_child=TASKS_PER_CHILD):
+    """Yield worker(item) for every item, in the order the results arrive.
+
+    worker must be a module-level function and its results must pickle. processes
+    None uses every core; processes 1 runs everything in this process.
+    """
+    items = list(items)
+    if processes == 1 or len(items) <= 1:
+        for item in items:
+            yield worker(item)
+        return
+    pool = multiprocessing.Pool(processes, maxtasksperchild=tasks_per_child)
+    try:
+        for result in pool.imap_unordered(worker, items):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def call_batch(job):
+    # one pool task per batch, the worker's block cache stays warm across its items
+    worker, batch, load = job
+    if load is None:
+        return [worker(item) for item in batch]
+    return [worker(item, data) for item, data in prefetch.Prefetcher(load, batch)]
+
+
+def run_batches(worker, batches, processes=None, tasks_per_child=TASKS_PER_CHILD, load=None):
+    """Like run, but every batch of items is handled in order by a single process.
+
+    worker must be a module-level function; tasks_per_child still counts items, so
+    in a pool batches are cut to at most tasks_per_child items and a worker is
+    recycled once it may have handled that many. With load, worker(item, load(item))
+    is called instead and the next items of the batch are loaded in background
+    threads meanwhile, see prefetch.Prefetcher.
+    """
+    batches = [list(batch) for batch in batches]
+    if processes != 1 and tasks_per_child:
+        batches = [batch[k:k + tasks_per_child] for batch in batches
+                   for k in range(0, len(batch), tasks_per_child)]
+        longest = max([len(batch) for batch in batches] + [1])
+        tasks_per_child = max(1, tasks_per_child // longest)
+    jobs = [(worker, batch, load) for batch in batches]
+    for results in run(call_batch, jobs, processes, tasks_per_child):
+        for result in results:
+            yield result
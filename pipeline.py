@@ -0,0 +1,328 @@
+# Requirements: Spatial Analyst Extension
+# All datasets of every subbasin in one run: terrain, soil, land cover and NDVI
+# The basins are burned once per raster grid and every plugin reads its layers over the same zones
+import arcpy
+import os
+import sys
+import numpy
+import terrain
+import streams
+import catchment
+import masks
+import zonal
+import datasets
+from journal import Journal
+from profiling import Profiler
+
+XLSX = True
+try:
+    from openpyxl import Workbook
+except ImportError:
+    print("No openpyxl module found. Saving output to txt file instead.")
+    XLSX = False
+
+DEBUG = True
+TEST = False
+# Datasets in the table, in column order
+PLUGINS = ("terrain", "soil", "coverage", "ndvi")
+# Percentiles of height, slope and TWI and the hypsometric integral in the terrain columns, as in Analyze.py
+DISTRIBUTION = True
+# Skip basins already in the results journal, False starts from an empty journal
+RESUME = True
+# Time every dataset into output\profile_pipeline.jsonl and print a summary at the end
+PROFILE = True
+
+############################################################################################################
+# Set environment settings
+############################################################################################################
+# Check out the ArcGIS Spatial Analyst extension license
+arcpy.CheckOutExtension("Spatial")
+# Overwrite output
+arcpy.env.overwriteOutput = True
+
+# Get current path
+path = os.getcwd()
+
+# Set input and output folders
+inputFolder = path + "\\data"
+outputFolder = path + "\\output"
+print("Input folder set to: " + inputFolder)
+print("Output folder set to: " + outputFolder)
+if not os.path.exists(outputFolder):
+    os.makedirs(outputFolder)
+
+# Inputs of every dataset, as in Analyze.py, sand.py, coverage.py and ndvi.py
+demInput = inputFolder + "\\Source\\ohio_90.tif"
+soilInput = inputFolder + "\\sand"
+coverageInput = inputFolder + "\\north_america_2015_v2\\NA_NALCMS_2015_v2_land_cover_30m\\NA_NALCMS_2015_v2_land_cover_30m.tif"
+ndviInput = inputFolder + "\\global_ndvi"
+
+# Get list of subinput
+subinput = []
+subinput_dir = inputFolder + "\\Boundary\\Ohio"
+for file in os.listdir(subinput_dir):
+    if file.endswith(".shp"):
+        subinput.append(file)
+if DEBUG:
+    print("Subinput list: " + str(subinput))
+    print("Number of subinput: " + str(len(subinput)))
+
+profiler = Profiler(outputFolder + "\\profile_pipeline.jsonl", PROFILE)
+# basin zone grids are kept in output\zones, later runs and datasets on the same grid load them
+masks.ZONE_FOLDER = outputFolder + "\\zones"
+
+if TEST:
+    subinput = ["3078000.shp"]
+    print("test subinput: " + str(subinput))
+
+############################################################################################################
+# Plugins
+############################################################################################################
+class Plugin(object):
+    """One dataset of the combined table.
+
+    layers() lists the masks.Layer rasters it reads, columns() the headers of its
+    part of a row, and record(results, b) turns the per-basin results of its layers
+    (in the order of layers()) into the values of basin b.
+    """
+    name = ""
+
+    def layers(self):
+        return []
+
+    def columns(self):
+        return []
+
+    def record(self, results, b):
+        return []
+
+
+class TerrainPlugin(Plugin):
+    """Height, area, river length and density, slope and TWI of Analyze.py.
+
+    The DEM is conditioned once (cached in output\\hydrology, as WHOLE_DEM does) and
+    the metrics are reduced over the basin polygons: area counts the cells of the
+    basin, river length the steps of the stream cells.
+    """
+    name = "terrain"
+
+    def __init__(self, dem):
+        self.dem = dem
+
+    def layers(self):
+        src = arcpy.Raster(self.dem)
+        sizes = terrain.cell_sizes((src.meanCellWidth, src.meanCellHeight), src.height, src.extent.YMax,
+                                   src.spatialReference.type == "Geographic")
+
+        def read():
+            arr = arcpy.RasterToNumPyArray(src).astype(numpy.float32)
+            if src.noDataValue is not None:
+                arr[arr == src.noDataValue] = numpy.nan
+            return arr
+
+        hyd = catchment.conditioned(self.dem, outputFolder + "\\hydrology", read,
+                                    (src.meanCellWidth, src.meanCellHeight))
+        slope, fillSlope = terrain.slopes([hyd.dem, hyd.fill], sizes)
+        twi = terrain.twi(hyd.direction, hyd.accumulation, fillSlope, sizes)
+        del fillSlope
+        stream = streams.stream_mask(hyd.accumulation, streams.THRESHOLD)
+        area = numpy.empty(hyd.dem.shape, dtype=numpy.float32)
+        area[:] = (sizes[0] * sizes[1])[:, None]
+        area[numpy.isnan(hyd.dem)] = 0
+        length = numpy.zeros(hyd.dem.shape, dtype=numpy.float32)
+        cells, lengths = streams.stream_cells(hyd.direction, stream, sizes, hyd.topology.receivers)
+        length.ravel()[cells] = lengths
+        layers = [masks.Layer(self.dem, zonal.ZonalStats, a) for a in (hyd.dem, area, length, slope, twi)]
+        if DISTRIBUTION:
+            # histograms over the range of each whole layer, the same bins for every basin
+            for a, (lo, hi) in ((hyd.dem, zonal.value_range(hyd.dem)), (slope, (0.0, 90.0)),
+                                (twi, zonal.value_range(twi))):
+                layers.append(masks.Layer(self.dem, lambda natoms, lo=lo, hi=hi: zonal.ZonalQuantiles(natoms, lo, hi), a))
+        return layers
+
+    def columns(self):
+        return datasets.TERRAIN_COLUMNS + (datasets.DISTRIBUTION_COLUMNS if DISTRIBUTION else [])
+
+    def record(self, results, b):
+        height, area, length, slope, twi = results[:5]
+        areaKm = float(area["sum"][b]) / 1000000
+        lengthKm = float(length["sum"][b]) / 1000
+        density = lengthKm / areaKm if areaKm > 0 else float("nan")
+        out = [float(height["mean"][b]), areaKm, lengthKm, density, float(slope["mean"][b]), float(twi["mean"][b])]
+        if DISTRIBUTION:
+            heightDist, slopeDist, twiDist = results[5:]
+            out += datasets.distribution_record(heightDist, slopeDist, twiDist, b)
+        return out
+
+
+class SoilPlugin(Plugin):
+    """Mean of every soil layer of sand.py, in percent / 100."""
+    name = "soil"
+
+    def __init__(self, folder):
+        self.folder = folder
+        # the layer and column order of sand.py
+        self.files = datasets.soil_files(folder)
+
+    def layers(self):
+        return [masks.Layer(self.folder + "\\" + file, zonal.ZonalStats, None) for file in self.files]
+
+    def columns(self):
+        return datasets.soil_columns(self.files)
+
+    def record(self, results, b):
+        return [float(stats["mean"][b]) / 100.0 for stats in results]
+
+
+class CoveragePlugin(Plugin):
+    """Fraction of the basin cells in every land-cover class of coverage.py."""
+    name = "coverage"
+    CLASSES = datasets.COVERAGE_CLASSES
+
+    def __init__(self, raster):
+        self.raster = raster
+
+    def layers(self):
+        nclasses = len(self.CLASSES) + 1
+        return [masks.Layer(self.raster, lambda natoms: zonal.ZonalHistogram(natoms, nclasses), None)]
+
+    def columns(self):
+        return list(datasets.COVERAGE_COLUMNS)
+
+    def record(self, results, b):
+        counts = results[0][b][1:]
+        total = float(counts.sum())
+        return [float(c) / total if total else float("nan") for c in counts]
+
+
+class NdviPlugin(Plugin):
+    """Average, trend and yearly means of the NDVI rasters of ndvi.py, / 10000."""
+    name = "ndvi"
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.files, self.years = datasets.yearly_files(folder)
+
+    def layers(self):
+        return [masks.Layer(self.folder + "\\" + file, zonal.ZonalStats, None) for file in self.files]
+
+    def columns(self):
+        return datasets.ndvi_columns(self.years)
+
+    def record(self, results, b):
+        means = numpy.array([stats["mean"][b] for stats in results], dtype=numpy.float64)
+        valid = means[~numpy.isnan(means)]
+        average = float(valid.mean()) / 10000.0 if valid.size else float("nan")
+        trend = float(zonal.linear_trend(self.years, means[:, None])[0]) / 10000.0
+        return [average, trend] + [float(mean) / 10000.0 for mean in means]
+
+
+def make_plugins(names):
+    plugins = {
+        "terrain": lambda: TerrainPlugin(demInput),
+        "soil": lambda: SoilPlugin(soilInput),
+        "coverage": lambda: CoveragePlugin(coverageInput),
+        "ndvi": lambda: NdviPlugin(ndviInput),
+    }
+    return [plugins[name]() for name in names]
+
+
+def run(plugins, shapefiles):
+    """Rows of values of every basin, the plugins' parts side by side.
+
+    The layers of all plugins are reduced together by masks.reduce_layers, so the
+    basins are burned once per distinct raster grid whatever the number of datasets.
+    """
+    layers, spans = [], []
+    for plugin in plugins:
+        profiler.begin(plugin.name)
+        own = plugin.layers()
+        profiler.lap("layers")
+        spans.append((len(layers), len(layers) + len(own)))
+        layers.extend(own)
+    profiler.begin("all")
+    results = masks.reduce_layers(layers, shapefiles)
+    profiler.lap("zonal")
+    rows = []
+    for b in range(len(shapefiles)):
+        row = []
+        for plugin, (start, stop) in zip(plugins, spans):
+            row.extend(plugin.record(results[start:stop], b))
+        rows.append(row)
+    return rows
+
+############################################################################################################
+# Finish, save result
+############################################################################################################
+def open_output(columns):
+    global wb, ws, f
+    if XLSX:
+        wb = Workbook()
+        wb.create_sheet('Sheet1', 0)
+        ws = wb.active
+        ws.cell(1,1).value = "Subbasin Number"
+        for j in range(len(columns)):
+            ws.cell(1,j+2).value = columns[j]
+    else:
+        f = open(outputFolder + "\\result_pipeline.txt", "w")
+        f.write("Subbasin Number\t" + "\t".join(columns) + "\n")
+
+def write_result(row, name, record):
+    if XLSX:
+        ws.cell(row,1).value = name
+        for j in range(len(record)):
+            # empty cell where a dataset has no data for the basin
+            if not numpy.isnan(record[j]):
+                ws.cell(row,j+2).value = record[j]
+    else:
+        f.write(name + "\t" + "\t".join([str(value) for value in record]) + "\n")
+
+def save():
+    if XLSX:
+        wb.save(outputFolder + "\\result_pipeline.xlsx")
+        print("Output saved to: " + outputFolder + "\\result_pipeline.xlsx")
+    else:
+        f.close()
+        print("Output saved to: " + outputFolder + "\\result_pipeline.txt")
+
+    print("All done!")
+
+if __name__ == '__main__':
+    plugins = make_plugins(PLUGINS)
+    columns = []
+    for plugin in plugins:
+        columns.extend(plugin.columns())
+    # every basin is committed to the journal at once, a rerun only does the missing ones
+    journal = Journal(outputFolder + "\\journal_pipeline.sqlite")
+    if not RESUME:
+        journal.clear()
+    profiler.reset()
+    # records of another set of datasets, layers or years have other columns
+    if journal.keyed(columns):
+        print("Columns changed, journal cleared")
+    done = journal.done()
+    todo = [i for i in range(len(subinput)) if subinput[i][:-4] not in done]
+    print("Subbasins already in journal: " + str(len(subinput) - len(todo)))
+    if todo:
+        try:
+            rows = run(plugins, [subinput_dir + "\\" + subinput[i] for i in todo])
+        except:
+            import traceback
+            tb = sys.exc_info()[2]
+            tbinfo = traceback.format_tb(tb)[0]
+            pymsg = "ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n    " + str(sys.exc_info()[1])
+            print(pymsg)
+            rows = []
+        for i, record in zip(todo, rows):
+            if DEBUG:
+                print(subinput[i] + ": " + str(record))
+            journal.record(subinput[i][:-4], record)
+    # the report is built from the journal, so it holds the basins of earlier runs too
+    profiler.begin("all")
+    open_output(columns)
+    for row, (name, record) in enumerate(journal.records()):
+        write_result(row + 2, name, record)
+    journal.close()
+    save()
+    profiler.lap("output")
+    profiler.summary()
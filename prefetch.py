@@ -0,0 +1,75 @@
+# Read-ahead for the per-basin loops
+# The rasters of the next basins are read in a few threads while the current one is reduced
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# Basins read ahead of the one being reduced
+DEPTH = 2
+# Reading threads
+THREADS = 2
+# Read-ahead data held at most, in MB; the next basin is always read, however large
+MAX_MB = 512
+
+
+def nbytes(value):
+    # bytes held by a loaded value: an array or a (nested) list or tuple of arrays
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    return getattr(value, "nbytes", 0)
+
+
+class Prefetcher(object):
+    """Iterate (item, load(item)) over items, loading the next ones in a thread pool.
+
+    Up to depth items are loaded ahead of the one handed out, and no further load
+    starts while the loaded items waiting to be handed out hold max_mb or more. A
+    failed load raises when its item is reached; loads not started by then are
+    cancelled, as they are when the loop is left early or close() is called.
+    load must be thread-safe (masks.basin_layers is).
+    """
+
+    def __init__(self, load, items, depth=DEPTH, threads=THREADS, max_mb=MAX_MB):
+        self.load = load
+        self.items = list(items)
+        self.depth = max(depth, 0)
+        self.threads = threads
+        self.max_bytes = max_mb * 1024 * 1024
+        self.cancelled = threading.Event()
+        self.pool = None
+
+    def _call(self, item):
+        if self.cancelled.is_set():
+            return None
+        return self.load(item)
+
+    def _held(self, pending):
+        return sum(nbytes(result.get()) for item, result in pending if result.ready() and result.successful())
+
+    def __iter__(self):
+        if not self.depth or len(self.items) <= 1:
+            for item in self.items:
+                yield item, self.load(item)
+            return
+        self.pool = ThreadPool(self.threads)
+        pending = deque()
+        k = 0
+        try:
+            while pending or k < len(self.items):
+                # the item handed out next and depth more in flight, within the memory cap
+                while (k < len(self.items) and len(pending) <= self.depth and
+                       (not pending or self._held(pending) < self.max_bytes)):
+                    pending.append((self.items[k], self.pool.apply_async(self._call, (self.items[k],))))
+                    k += 1
+                item, result = pending.popleft()
+                yield item, result.get()
+        finally:
+            self.close()
+
+    def close(self):
+        # cancel the loads not started yet and wait for the running ones
+        self.cancelled.set()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,107 @@
+# Per-stage profiling of the basin scripts
+# Each stage of each basin becomes one JSON line: wall time, CPU time, RSS change and cells
+import json
+import os
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Slowest basins listed by the summary
+TOP = 5
+
+
+def rss_mb():
+    # Resident set size of this process, the peak RSS where the current one is not available
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss / (1024.0 * 1024.0)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return None
+
+
+def cpu_seconds():
+    t = os.times()
+    return t[0] + t[1]
+
+
+class Profiler(object):
+    """Lap timer over the steps of a basin, appending a JSON line per step.
+
+    begin(basin) starts a basin, every lap(stage, cells) closes the step since the
+    previous mark. Workers append to the same file (one short write per line), so
+    the parent can summarize a parallel run; reset() empties it at the start.
+    """
+
+    def __init__(self, path, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.basin = None
+        self.mark = None
+
+    def reset(self):
+        if self.enabled:
+            open(self.path, "w").close()
+
+    def begin(self, basin):
+        self.basin = basin
+        self.mark = (time.time(), cpu_seconds(), rss_mb())
+
+    def lap(self, stage, cells=None):
+        if not self.enabled or self.mark is None:
+            return
+        wall, cpu, rss = time.time(), cpu_seconds(), rss_mb()
+        record = {
+            "basin": self.basin,
+            "stage": stage,
+            "wall": wall - self.mark[0],
+            "cpu": cpu - self.mark[1],
+            "rss_mb": rss,
+            "rss_delta_mb": rss - self.mark[2] if rss is not None and self.mark[2] is not None else None,
+            "cells": int(cells) if cells is not None else None,
+            "pid": os.getpid(),
+            "time": wall,
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.mark = (time.time(), cpu_seconds(), rss_mb())
+
+    def records(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def summary(self):
+        """Print the totals of every stage and the slowest basins of the run."""
+        if not self.enabled:
+            return
+        records = self.records()
+        stages, basins = {}, {}
+        for r in records:
+            s = stages.setdefault(r["stage"], {"n": 0, "wall": 0.0, "cpu": 0.0, "cells": 0, "max": 0.0})
+            s["n"] += 1
+            s["wall"] += r["wall"]
+            s["cpu"] += r["cpu"]
+            s["cells"] += r["cells"] or 0
+            s["max"] = max(s["max"], r["wall"])
+            basins[r["basin"]] = basins.get(r["basin"], 0.0) + r["wall"]
+        print("Profile of " + str(len(basins)) + " basins, " + str(len(records)) + " steps: " + self.path)
+        print("%-20s %6s %10s %10s %10s %14s" % ("stage", "steps", "wall(s)", "cpu(s)", "max(s)", "cells/s"))
+        for name, s in sorted(stages.items(), key=lambda item: -item[1]["wall"]):
+            rate = s["cells"] / s["wall"] if s["cells"] and s["wall"] > 0 else 0
+            print("%-20s %6d %10.2f %10.2f %10.2f %14.0f" % (name, s["n"], s["wall"], s["cpu"], s["max"], rate))
+        print("Slowest basins:")
+        for name, wall in sorted(basins.items(), key=lambda item: -item[1])[:TOP]:
+            print("    %-40s %10.2f s" % (name, wall))
@@ -0,0 +1,431 @@
+# Windowed GeoTIFF reader
+# Reads only the tiles or strips a window touches, without arcpy or GDAL
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy
+
+############################################################################################################
+# TIFF tags
+############################################################################################################
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+PREDICTOR = 317
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SAMPLE_FORMAT = 339
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+MODEL_TRANSFORMATION = 34264
+GEO_KEY_DIRECTORY = 34735
+GDAL_NODATA = 42113
+
+# field type -> (struct format, size)
+FIELD_TYPES = {
+    1: ("B", 1), 2: ("c", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8), 6: ("b", 1),
+    7: ("B", 1), 8: ("h", 2), 9: ("i", 4), 10: ("ii", 8), 11: ("f", 4), 12: ("d", 8),
+    16: ("Q", 8), 17: ("q", 8), 18: ("Q", 8),
+}
+# (SampleFormat, BitsPerSample) -> numpy type
+SAMPLE_TYPES = {
+    (1, 8): "u1", (1, 16): "u2", (1, 32): "u4", (1, 64): "u8",
+    (2, 8): "i1", (2, 16): "i2", (2, 32): "i4", (2, 64): "i8",
+    (3, 32): "f4", (3, 64): "f8",
+}
+COMPRESSIONS = (1, 5, 8, 32773, 32946)
+# GeoKeys
+MODEL_TYPE_KEY = 1024
+GEOGRAPHIC_TYPE_KEY = 2048
+PROJECTED_CS_TYPE_KEY = 3072
+
+# Decoded blocks kept in memory by the shared cache
+CACHE_BYTES = 256 * 1024 * 1024
+
+
+############################################################################################################
+# Block cache
+############################################################################################################
+class BlockCache(object):
+    """Least recently used cache of decoded blocks, bounded by their total size in bytes.
+
+    One cache is shared by every reader, so basins next to each other reuse the
+    tiles their neighbours already decoded.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            block = self._blocks.pop(key, None)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks[key] = block
+            self.hits += 1
+            return block
+
+    def put(self, key, block):
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._blocks[key] = block
+            self.nbytes += block.nbytes
+            while self.nbytes > self.max_bytes and len(self._blocks) > 1:
+                _, dropped = self._blocks.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.nbytes = 0
+
+
+CACHE = BlockCache()
+
+
+############################################################################################################
+# Decoders
+############################################################################################################
+def packbits_decode(data):
+    data = bytearray(data)
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        n = data[i]
+        i += 1
+        if n < 128:
+            out += data[i:i + n + 1]
+            i += n + 1
+        elif n > 128:
+            out += data[i:i + 1] * (257 - n)
+            i += 1
+    return bytes(out)
+
+
+def lzw_decode(data):
+    # TIFF flavour of LZW: MSB-first codes of 9 to 12 bits with early change
+    data = bytearray(data) + bytearray(3)
+    nbits = (len(data) - 3) * 8
+    out = bytearray()
+    base = [bytes(bytearray([i])) for i in range(256)] + [b"", b""]
+    table = list(base)
+    width = 9
+    pos = 0
+    prev = None
+    while pos + width <= nbits:
+        i = pos >> 3
+        code = ((data[i] << 16) | (data[i + 1] << 8) | data[i + 2]) >> (24 - width - (pos & 7))
+        code &= (1 << width) - 1
+        pos += width
+        if code == 256:
+            table = list(base)
+            width = 9
+            prev = None
+            continue
+        if code == 257:
+            break
+        if prev is None:
+            entry = table[code]
+        else:
+            entry = table[code] if code < len(table) else prev + prev[:1]
+            table.append(prev + entry[:1])
+        out += entry
+        prev = entry
+        if len(table) + 1 >= (1 << width) and width < 12:
+            width += 1
+    return bytes(out)
+
+
+############################################################################################################
+# Reader
+############################################################################################################
+class GeoTiff(object):
+    """Read-only view of a tiled or striped (Big)TIFF with its georeference.
+
+    read() decodes only the blocks a window touches. Uncompressed files are
+    memory-mapped and their blocks are used in place; compressed blocks are decoded
+    once and kept in a BlockCache shared by all readers.
+    """
+
+    def __init__(self, path, cache=None, mmap=True):
+        self.path = path
+        self.cache = CACHE if cache is None else cache
+        self._fh = open(path, "rb")
+        # cache entries of a file that was rewritten in place must not match
+        st = os.fstat(self._fh.fileno())
+        self._key = (os.path.abspath(path), st.st_size, st.st_mtime)
+        self._lock = threading.Lock()
+        try:
+            self._parse()
+        except Exception:
+            self._fh.close()
+            raise
+        self._mm = None
+        if mmap and self.compression == 1 and self.predictor == 1:
+            try:
+                self._mm = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+            except (OSError, ValueError, MemoryError, OverflowError):
+                # e.g. a file larger than the address space of a 32-bit python
+                self._mm = None
+
+    def close(self):
+        self._fh.close()
+        self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ########################################################################################################
+    # Header
+    ########################################################################################################
+    def _unpack(self, fmt, data):
+        return struct.unpack(self.order + fmt, data)
+
+    def _parse(self):
+        head = self._fh.read(16)
+        if head[:2] == b"II":
+            self.order = "<"
+        elif head[:2] == b"MM":
+            self.order = ">"
+        else:
+            raise ValueError("Not a TIFF file: " + self.path)
+        magic = self._unpack("H", head[2:4])[0]
+        if magic == 42:
+            self.bigtiff = False
+            ifd = self._unpack("I", head[4:8])[0]
+        elif magic == 43:
+            self.bigtiff = True
+            ifd = self._unpack("Q", head[8:16])[0]
+        else:
+            raise ValueError("Not a TIFF file: " + self.path)
+        tags = self._read_ifd(ifd)
+
+        self.width = int(tags[IMAGE_WIDTH][0])
+        self.height = int(tags[IMAGE_LENGTH][0])
+        self.samples = int(tags.get(SAMPLES_PER_PIXEL, (1,))[0])
+        self.planar = int(tags.get(PLANAR_CONFIGURATION, (1,))[0])
+        self.compression = int(tags.get(COMPRESSION, (1,))[0])
+        self.predictor = int(tags.get(PREDICTOR, (1,))[0])
+        bits = int(tags.get(BITS_PER_SAMPLE, (1,))[0])
+        fmt = int(tags.get(SAMPLE_FORMAT, (1,))[0])
+        if (fmt, bits) not in SAMPLE_TYPES:
+            raise ValueError("Unsupported sample type %d/%d bits: %s" % (fmt, bits, self.path))
+        if self.compression not in COMPRESSIONS:
+            raise ValueError("Unsupported compression %d: %s" % (self.compression, self.path))
+        self.dtype = numpy.dtype(self.order + SAMPLE_TYPES[(fmt, bits)])
+
+        if TILE_WIDTH in tags:
+            self.tiled = True
+            self.block_shape = (int(tags[TILE_LENGTH][0]), int(tags[TILE_WIDTH][0]))
+            self.offsets = tags[TILE_OFFSETS]
+            self.counts = tags[TILE_BYTE_COUNTS]
+        else:
+            self.tiled = False
+            rps = int(tags.get(ROWS_PER_STRIP, (self.height,))[0])
+            self.block_shape = (min(rps, self.height), self.width)
+            self.offsets = tags[STRIP_OFFSETS]
+            self.counts = tags[STRIP_BYTE_COUNTS]
+        self.offsets = numpy.asarray(self.offsets, dtype=numpy.int64)
+        self.counts = numpy.asarray(self.counts, dtype=numpy.int64)
+        bh, bw = self.block_shape
+        self.blocks_down = (self.height + bh - 1) // bh
+        self.blocks_across = (self.width + bw - 1) // bw
+
+        self.nodata = None
+        if GDAL_NODATA in tags:
+            text = b"".join(tags[GDAL_NODATA]).strip(b"\x00 ").decode("ascii")
+            if text:
+                self.nodata = self.dtype.type(float(text))
+
+        # cell (0, 0) top-left corner and cell sizes
+        if MODEL_TRANSFORMATION in tags:
+            m = tags[MODEL_TRANSFORMATION]
+            self.transform = (m[3], m[0], m[7], m[5])
+        elif MODEL_PIXEL_SCALE in tags and MODEL_TIEPOINT in tags:
+            sx, sy = tags[MODEL_PIXEL_SCALE][:2]
+            i, j, _, x, y, _ = tags[MODEL_TIEPOINT][:6]
+            self.transform = (x - i * sx, sx, y + j * sy, -sy)
+        else:
+            self.transform = (0.0, 1.0, 0.0, -1.0)
+        self.geokeys = {}
+        if GEO_KEY_DIRECTORY in tags:
+            keys = tags[GEO_KEY_DIRECTORY]
+            for k in range(4, 4 + 4 * keys[3], 4):
+                if keys[k + 1] == 0:
+                    self.geokeys[keys[k]] = keys[k + 3]
+
+    def _read_ifd(self, offset):
+        fh = self._fh
+        fh.seek(offset)
+        if self.bigtiff:
+            n = self._unpack("Q", fh.read(8))[0]
+            size, valfmt, valsize = 20, "Q", 8
+        else:
+            n = self._unpack("H", fh.read(2))[0]
+            size, valfmt, valsize = 12, "I", 4
+        raw = fh.read(n * size)
+        tags = {}
+        for e in range(n):
+            entry = raw[e * size:(e + 1) * size]
+            tag, typ = self._unpack("HH", entry[:4])
+            count = self._unpack(valfmt, entry[4:4 + valsize])[0]
+            if typ not in FIELD_TYPES:
+                continue
+            fmt, itemsize = FIELD_TYPES[typ]
+            nbytes = itemsize * count
+            if nbytes <= valsize:
+                data = entry[4 + valsize:4 + valsize + nbytes]
+            else:
+                fh.seek(self._unpack(valfmt, entry[4 + valsize:])[0])
+                data = fh.read(nbytes)
+            if typ in (5, 10):
+                vals = self._unpack(fmt[0] * (2 * count), data)
+                tags[tag] = tuple(float(vals[k]) / vals[k + 1] for k in range(0, len(vals), 2))
+            elif count > 64 and typ not in (2,):
+                # offsets and byte counts of large rasters
+                tags[tag] = numpy.frombuffer(data, dtype=numpy.dtype(self.order + fmt))
+            else:
+                tags[tag] = self._unpack(fmt * count, data)
+        return tags
+
+    ########################################################################################################
+    # Georeference
+    ########################################################################################################
+    @property
+    def cellsize(self):
+        return (abs(self.transform[1]), abs(self.transform[3]))
+
+    @property
+    def extent(self):
+        # (xmin, ymin, xmax, ymax)
+        x0, dx, y0, dy = self.transform
+        x1, y1 = x0 + dx * self.width, y0 + dy * self.height
+        return (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+    @property
+    def geographic(self):
+        # ModelTypeGeoKey 2 is a lat/lon raster
+        return self.geokeys.get(MODEL_TYPE_KEY) == 2
+
+    @property
+    def epsg(self):
+        return self.geokeys.get(PROJECTED_CS_TYPE_KEY, self.geokeys.get(GEOGRAPHIC_TYPE_KEY))
+
+    def window(self, xmin, ymin, xmax, ymax):
+        """(row0, col0, nrows, ncols) of the cells covering a bounding box, clipped to the raster."""
+        x0, dx, y0, dy = self.transform
+        c0, c1 = sorted(((xmin - x0) / dx, (xmax - x0) / dx))
+        r0, r1 = sorted(((ymax - y0) / dy, (ymin - y0) / dy))
+        c0, r0 = max(int(numpy.floor(c0)), 0), max(int(numpy.floor(r0)), 0)
+        c1, r1 = min(int(numpy.ceil(c1)), self.width), min(int(numpy.ceil(r1)), self.height)
+        return r0, c0, max(r1 - r0, 0), max(c1 - c0, 0)
+
+    ########################################################################################################
+    # Pixels
+    ########################################################################################################
+    def block_index(self, by, bx, band=0):
+        index = by * self.blocks_across + bx
+        if self.planar == 2:
+            index += band * self.blocks_down * self.blocks_across
+        return index
+
+    def block(self, by, bx, band=0):
+        """Decoded block (rows, cols) of one band; strips at the bottom may be short."""
+        bh, bw = self.block_shape
+        rows = bh if self.tiled else min(bh, self.height - by * bh)
+        spp = 1 if self.planar == 2 else self.samples
+        index = self.block_index(by, bx, band)
+        offset, count = int(self.offsets[index]), int(self.counts[index])
+        if count == 0:
+            # sparse file, block was never written
+            out = numpy.zeros((rows, bw), dtype=self.dtype)
+            if self.nodata is not None:
+                out.fill(self.nodata)
+            return out
+        if self._mm is not None:
+            size = rows * bw * spp * self.dtype.itemsize
+            arr = self._mm[offset:offset + size].view(self.dtype).reshape(rows, bw, spp)
+            return arr[:, :, band if self.planar == 1 else 0]
+        key = (self._key, index)
+        arr = self.cache.get(key)
+        if arr is None:
+            with self._lock:
+                self._fh.seek(offset)
+                raw = self._fh.read(count)
+            arr = self._decode(raw, rows, bw, spp)
+            self.cache.put(key, arr)
+        return arr[:, :, band if self.planar == 1 else 0]
+
+    def _decode(self, raw, rows, cols, spp):
+        if self.compression in (8, 32946):
+            raw = zlib.decompress(raw)
+        elif self.compression == 5:
+            raw = lzw_decode(raw)
+        elif self.compression == 32773:
+            raw = packbits_decode(raw)
+        size = rows * cols * spp * self.dtype.itemsize
+        if self.predictor == 3:
+            # floating point predictor: byte planes, differenced along the row
+            b = numpy.frombuffer(raw[:size], dtype=numpy.uint8).reshape(rows, -1)
+            b = numpy.cumsum(b, axis=1, dtype=numpy.uint8)
+            b = b.reshape(rows, self.dtype.itemsize, cols * spp).transpose(0, 2, 1)
+            arr = numpy.ascontiguousarray(b).view(self.dtype.newbyteorder(">")).reshape(rows, cols, spp)
+            return arr.astype(self.dtype.newbyteorder("="))
+        arr = numpy.frombuffer(raw[:size], dtype=self.dtype).reshape(rows, cols, spp)
+        arr = arr.astype(self.dtype.newbyteorder("="))
+        if self.predictor == 2:
+            arr = numpy.cumsum(arr, axis=1, dtype=arr.dtype)
+        return arr
+
+    def read(self, row0, col0, nrows, ncols, band=0):
+        """Cells [row0:row0+nrows, col0:col0+ncols] of a band; cells off the raster are NoData (or 0)."""
+        out = numpy.empty((nrows, ncols), dtype=self.dtype.newbyteorder("="))
+        out.fill(self.nodata if self.nodata is not None else 0)
+        r0, r1 = max(row0, 0), min(row0 + nrows, self.height)
+        c0, c1 = max(col0, 0), min(col0 + ncols, self.width)
+        if r0 >= r1 or c0 >= c1:
+            return out
+        bh, bw = self.block_shape
+        for by in range(r0 // bh, (r1 - 1) // bh + 1):
+            for bx in range(c0 // bw, (c1 - 1) // bw + 1):
+                blk = self.block(by, bx, band)
+                br0, bc0 = by * bh, bx * bw
+                ra, rb = max(r0, br0), min(r1, br0 + blk.shape[0])
+                ca, cb = max(c0, bc0), min(c1, bc0 + bw)
+                out[ra - row0:rb - row0, ca - col0:cb - col0] = blk[ra - br0:rb - br0, ca - bc0:cb - bc0]
+        return out
+
+    def read_bbox(self, xmin, ymin, xmax, ymax, band=0):
+        """(values, row0, col0) of the window covering a bounding box."""
+        row0, col0, nrows, ncols = self.window(xmin, ymin, xmax, ymax)
+        return self.read(row0, col0, nrows, ncols, band), row0, col0
+
+
+def open_raster(path, cache=None):
+    # GeoTiff reader for path, None where the file is not a TIFF this module can decode
+    try:
+        return GeoTiff(path, cache)
+    except (ValueError, KeyError, IOError, struct.error):
+        return None
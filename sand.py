@@ -5,6 +5,12 @@ from arcpy.sa import *
 import os
 import sys
 import numpy
+import masks
+import zonal
+import parallel
+import datasets
+from journal import Journal
+from profiling import Profiler
 
 XLSX = True
 try:
@@ -16,6 +22,20 @@ except ImportError:
 DEBUG = True
 TEST = False
 SAVE = False
+# Compute all basins in one pass over each layer instead of ExtractByMask per basin
+ZONAL = True
+# Skip basins already in the results journal, False starts from an empty journal
+RESUME = True
+# Process basins in a pool of worker processes (per-basin path only)
+PARALLEL = False
+# Worker processes, None uses every core
+PROCESSES = None
+# Basins per worker before it is recycled
+TASKS_PER_CHILD = parallel.TASKS_PER_CHILD
+# Read the layers of the next basins in background threads while one is reduced (per-basin path only)
+PREFETCH = True
+# Time every step of every basin into output\profile_sand.jsonl and print a summary at the end
+PROFILE = True
 
 ############################################################################################################
 # Set environment settings
@@ -40,10 +60,9 @@ print("Output folder set to: " + outputFolder)
 
 # Set overall input
 input = inputFolder + "\\sand"
-subinputlayer_dir = []
-for file in os.listdir(input):
-    if file.endswith(".tif"):
-        subinputlayer_dir.append(file)
+# layers in column order (CLAY1..6, GRAV1..6, SILT1..6, SAND1..6), the same as the soil plugin of pipeline.py
+subinputlayer_dir = datasets.soil_files(input)
+columns = datasets.soil_columns(subinputlayer_dir)
 if DEBUG:
     print("Subinput layer list: " + str(subinputlayer_dir))
     print("Number of subinput layer: " + str(len(subinputlayer_dir)))
@@ -69,122 +88,84 @@ if DEBUG:
     print("Suboutput list: " + str(suboutput))
     print("Number of suboutput: " + str(len(suboutput)))
 
+profiler = Profiler(outputFolder + "\\profile_sand.jsonl", PROFILE)
+# basin zone grids are kept in output\zones, later runs and datasets on the same grid load them
+masks.ZONE_FOLDER = outputFolder + "\\zones"
+
 if TEST:
     subinput = ["3170000.shp"]
     suboutput = [outputFolder + "\\" + sub[:-4] for sub in subinput]
     print("test subinput: " + str(subinput))
     print("test suboutput: " + str(suboutput))
 
-# data structure for each subbasin
-subbasin = {}
-# Save output to excel
-if XLSX:
-    wb = Workbook()
-    wb.create_sheet('Sheet1', 0)
-    ws = wb.active
-    ws.cell(1,1).value = "Subbasin Number"
-    ws.cell(1,2).value = "CLAY1"
-    ws.cell(1,3).value = "CLAY2"
-    ws.cell(1,4).value = "CLAY3"
-    ws.cell(1,5).value = "CLAY4"
-    ws.cell(1,6).value = "CLAY5"
-    ws.cell(1,7).value = "CLAY6"
-    ws.cell(1,8).value = "GRAV1"
-    ws.cell(1,9).value = "GRAV2"
-    ws.cell(1,10).value = "GRAV3"
-    ws.cell(1,11).value = "GRAV4"
-    ws.cell(1,12).value = "GRAV5"
-    ws.cell(1,13).value = "GRAV6"
-    ws.cell(1,14).value = "SILT1"
-    ws.cell(1,15).value = "SILT2"
-    ws.cell(1,16).value = "SILT3"
-    ws.cell(1,17).value = "SILT4"
-    ws.cell(1,18).value = "SILT5"
-    ws.cell(1,19).value = "SILT6"
-    ws.cell(1,20).value = "SAND1"
-    ws.cell(1,21).value = "SAND2"
-    ws.cell(1,22).value = "SAND3"
-    ws.cell(1,23).value = "SAND4"
-    ws.cell(1,24).value = "SAND5"
-    ws.cell(1,25).value = "SAND6"
-else:
-    f = open(outputFolder + "\\result.txt", "w")
-    f.write("Subbasin Number\t" +
-            "CLAY1\t" +
-            "CLAY2\t" +
-            "CLAY3\t" +
-            "CLAY4\t" +
-            "CLAY5\t" +
-            "CLAY6\t" +
-            "GRAV1\t" +
-            "GRAV2\t" +
-            "GRAV3\t" +
-            "GRAV4\t" +
-            "GRAV5\t" +
-            "GRAV6\t" +
-            "SILT1\t" +
-            "SILT2\t" +
-            "SILT3\t" +
-            "SILT4\t" +
-            "SILT5\t" +
-            "SILT6\t" +
-            "SAND1\t" +
-            "SAND2\t" +
-            "SAND3\t" +
-            "SAND4\t" +
-            "SAND5\t" +
-            "SAND6\t" )
-    f.write("\n")
+# Save output to excel, only the parent process writes output
+def open_output():
+    global wb, ws, f
+    if XLSX:
+        wb = Workbook()
+        wb.create_sheet('Sheet1', 0)
+        ws = wb.active
+        ws.cell(1,1).value = "Subbasin Number"
+        for j in range(len(columns)):
+            ws.cell(1,j+2).value = columns[j]
+    else:
+        f = open(outputFolder + "\\result.txt", "w")
+        f.write("Subbasin Number\t" + "\t".join(columns) + "\t")
+        f.write("\n")
 
 ###########################################################################################################
 # Part1: Hydrological Analysis
 ############################################################################################################
 # Step0: Iterate through subinput
 ############################################################################################################
-# data structure for each subbasin
-result = [[] for i in range(len(subinput))]
-
-for i in range(len(subinput)):
+def read_layers(i):
+    # cells of every layer under basin i
+    return masks.basin_layers([input + "\\" + layer for layer in subinputlayer_dir], subinput_dir + "\\" + subinput[i])
+
+# Returns (i, record) with the plain values of basin i, record is None on error;
+# layers are the basin's cells of every layer when they were read ahead
+def process_subbasin(i, layers=None):
+    # data structure for each subbasin
+    result = [0 for j in range(len(subinputlayer_dir))]
     try:
-        result[i] = [0 for j in range(24)]
         print("Processing subbasin: " + subinput[i])
+        profiler.begin(subinput[i][:-4])
         # set workspace to suboutput
         env.workspace = suboutput[i]
         print("Workspace set to: " + suboutput[i])
     ############################################################################################################
     # Step1: Extract by mask
     ############################################################################################################
+        if not ZONAL and layers is None:
+            # the basin is burned once per grid for all layers
+            layers = read_layers(i)
         # for each subinput, extract all subinputlayer
         for j in range(len(subinputlayer_dir)):
-            # Extract by mask
+            if ZONAL:
+                result[j] = float(layerStats[j]["mean"][i])
+                if DEBUG:
+                    print("Mean of " + subinputlayer_dir[j] + " is " + str(result[j]))
+                continue
+            # Extract by mask, the tiles under the basin's bounding box were read by read_layers
             inRaster = input + "\\" + subinputlayer_dir[j]
             inMaskData = inputFolder + "\\Boundary\\Ohio\\" + subinput[i]
-            outExtractByMask = ExtractByMask(inRaster, inMaskData)
+            arr = layers[j]
+            profiler.lap("extract", arr.size)
             # Save the output 
             if SAVE:
+                outExtractByMask = ExtractByMask(inRaster, inMaskData)
                 outExtractByMask.save(subinputlayer_dir[j][:-4] + "_extract.tif")
                 print("Extracted " + subinputlayer_dir[j] + " to " + subinputlayer_dir[j][:-4] + "_extract.tif")
 
             ############################################################################################################
             # Step2: Calculate mean
             ############################################################################################################
-            result[i][j] = arcpy.GetRasterProperties_management(outExtractByMask, "MEAN")
+            # integer layers are summed in their own type into int64, no float copy
+            result[j] = float(zonal.exact_sum(arr)) / arr.size if arr.size else float("nan")
+            profiler.lap("stats", arr.size)
             if DEBUG:
-                print("Mean of " + subinputlayer_dir[j] + " is " + str(result[i][j]))
+                print("Mean of " + subinputlayer_dir[j] + " is " + str(result[j]))
     
-    ############################################################################################################
-    # Finish, save result
-    ############################################################################################################
-        if XLSX:
-            ws.cell(i+2,1).value = subinput[i][:-4]
-            for j in range(0,24):
-                ws.cell(i+2,j+2).value = float(result[i][j].getOutput(0)) / 100.0
-        else:
-            f.write(subinput[i][:-4] + "\t")
-            for j in range(24):
-                f.write(str(float(result[i][j].getOutput(0)) / 100.0) + "\t")
-            f.write("\n")
-        
 
         ############################################################################################################
         # Move the file to done folder
@@ -200,13 +181,71 @@ for i in range(len(subinput)):
         tbinfo = traceback.format_tb(tb)[0]
         pymsg = "ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n    " + str(sys.exc_info()[1])
         print(pymsg)
+        return i, None
+    return i, [value / 100.0 for value in result]
 
-    
-if XLSX:
-    wb.save(outputFolder + "\\result_sand.xlsx")
-    print("Output saved to: " + outputFolder + "\\result_sand.xlsx")
-else:
-    f.close()
-    print("Output saved to: " + outputFolder + "\\result_sand.txt")
-
-print("All done!")
\ No newline at end of file
+############################################################################################################
+# Finish, save result
+############################################################################################################
+def write_result(row, name, record):
+    if XLSX:
+        ws.cell(row,1).value = name
+        for j in range(len(record)):
+            ws.cell(row,j+2).value = record[j]
+    else:
+        f.write(name + "\t")
+        for j in range(len(record)):
+            f.write(str(record[j]) + "\t")
+        f.write("\n")
+
+def save():
+    if XLSX:
+        wb.save(outputFolder + "\\result_sand.xlsx")
+        print("Output saved to: " + outputFolder + "\\result_sand.xlsx")
+    else:
+        f.close()
+        print("Output saved to: " + outputFolder + "\\result_sand.txt")
+
+    print("All done!")
+
+if __name__ == '__main__':
+    # every finished basin is committed to the journal at once, a rerun only does the missing ones
+    journal = Journal(outputFolder + "\\journal_sand.sqlite")
+    if not RESUME:
+        journal.clear()
+    # the columns follow the layer files, another set of layers clears the records
+    if journal.keyed(subinputlayer_dir):
+        print("Soil layers changed, journal cleared")
+    profiler.reset()
+    done = journal.done()
+    todo = [i for i in range(len(subinput)) if subinput[i][:-4] not in done]
+    print("Subbasins already in journal: " + str(len(subinput) - len(todo)))
+    if ZONAL and todo:
+        profiler.begin("all")
+        layerStats = masks.basin_stats([input + "\\" + layer for layer in subinputlayer_dir],
+                                       [subinput_dir + "\\" + sub for sub in subinput])
+        profiler.lap("zonal")
+    # the zone statistics live in this process, workers only help the per-basin path
+    processes = PROCESSES if PARALLEL and not ZONAL else 1
+    if ZONAL:
+        results = parallel.run(process_subbasin, todo, processes, TASKS_PER_CHILD)
+    else:
+        # basins sharing raster tiles in one batch, batches along a Hilbert curve,
+        # so every tile is decoded once per batch (the layers share one grid)
+        batches = masks.basin_batches(input + "\\" + subinputlayer_dir[0],
+                                      [subinput_dir + "\\" + subinput[i] for i in todo])
+        batches = [[todo[k] for k in batch] for batch in batches]
+        results = parallel.run_batches(process_subbasin, batches, processes, TASKS_PER_CHILD,
+                                       read_layers if PREFETCH else None)
+    for i, record in results:
+        if record is not None:
+            journal.record(subinput[i][:-4], record)
+    # the report is built from the journal, so it holds the basins of earlier runs too
+    profiler.begin("all")
+    open_output()
+    for row, (name, record) in enumerate(journal.records()):
+        write_result(row + 2, name, record)
+    journal.close()
+    save()
+    profiler.lap("output")
+    profiler.summary()
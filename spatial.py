@@ -0,0 +1,108 @@
+# Spatial ordering of basins for the per-basin path
+# Basins that read the same raster blocks are batched and visited along a Hilbert curve
+import numpy
+
+# Basins per batch at most, a basin covering the whole raster would otherwise pull everything into one
+MAX_BATCH = 32
+# Bits per axis of the Hilbert curve
+ORDER = 16
+
+
+def hilbert_index(x, y, order=ORDER):
+    """Distance along the Hilbert curve of the integer points (x, y), 0 <= x, y < 2 ** order."""
+    n = 1 << order
+    x = numpy.array(x, dtype=numpy.int64, ndmin=1)
+    y = numpy.array(y, dtype=numpy.int64, ndmin=1)
+    d = numpy.zeros(x.shape, dtype=numpy.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(numpy.int64)) ^ ry.astype(numpy.int64))
+        # rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap].copy()
+        s >>= 1
+    return d
+
+
+class GridIndex(object):
+    """Uniform grid over bounding boxes, one bucket per raster block.
+
+    boxes are (row0, col0, row1, col1) block ranges, inclusive; every box is listed
+    in the bucket of each block it covers, so the basins that read a block are a
+    single lookup.
+    """
+
+    def __init__(self, boxes):
+        self.buckets = {}
+        for i, (r0, c0, r1, c1) in enumerate(boxes):
+            for r in range(r0, r1 + 1):
+                for c in range(c0, c1 + 1):
+                    self.buckets.setdefault((r, c), []).append(i)
+
+    def query(self, box):
+        # ids of the boxes sharing a block with box
+        r0, c0, r1, c1 = box
+        out = set()
+        for r in range(r0, r1 + 1):
+            for c in range(c0, c1 + 1):
+                out.update(self.buckets.get((r, c), ()))
+        return sorted(out)
+
+
+def block_ranges(boxes, transform, block_shape):
+    # (row0, col0, row1, col1) of the raster blocks under each (xmin, ymin, xmax, ymax) box
+    x0, dx, y0, dy = transform
+    bh, bw = block_shape
+    out = []
+    for xmin, ymin, xmax, ymax in boxes:
+        c0, c1 = sorted(((xmin - x0) / dx, (xmax - x0) / dx))
+        r0, r1 = sorted(((ymax - y0) / dy, (ymin - y0) / dy))
+        out.append((max(int(r0 // bh), 0), max(int(c0 // bw), 0),
+                    max(int(r1 // bh), 0), max(int(c1 // bw), 0)))
+    return out
+
+
+def block_batches(boxes, transform, block_shape, limit=MAX_BATCH):
+    """Batches of basin ids, basins of a batch sharing raster blocks, in Hilbert order.
+
+    boxes are the basins' (xmin, ymin, xmax, ymax) bounding boxes in the coordinates of
+    the raster with the given transform (x0, dx, y0, dy) and block_shape (rows, cols).
+    Basins that share a block end up in the same batch (components of the overlap
+    graph, cut into pieces of at most limit basins along the curve), and batches come
+    in the order of the curve, so a block is decoded once per batch and the blocks of
+    the next batch are mostly next to the ones still in the cache.
+    """
+    if not boxes:
+        return []
+    ranges = block_ranges(boxes, transform, block_shape)
+    centre = numpy.array([((r0 + r1) // 2, (c0 + c1) // 2) for r0, c0, r1, c1 in ranges])
+    key = hilbert_index(centre[:, 1], centre[:, 0])
+    # union-find over the basins of every block
+    parent = list(range(len(boxes)))
+
+    def find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    for ids in GridIndex(ranges).buckets.values():
+        root = find(ids[0])
+        for i in ids[1:]:
+            other = find(i)
+            if other != root:
+                parent[other] = root
+    groups = {}
+    for i in numpy.argsort(key, kind="mergesort").tolist():
+        groups.setdefault(find(i), []).append(i)
+    batches = []
+    # a group starts where its first basin lies on the curve
+    for group in sorted(groups.values(), key=lambda g: key[g[0]]):
+        for k in range(0, len(group), limit):
+            batches.append(group[k:k + limit])
+    return batches
@@ -0,0 +1,324 @@
+# Stream network metrics on numpy arrays
+# Replacement for StreamToFeature / Watershed / RasterToPolygon + field sums, no vector I/O
+from collections import namedtuple
+
+import numpy
+
+import accumulation
+import d8
+import terrain
+
+# Flow accumulation above which a cell is a stream, as in Con(acc > 1000, 1)
+THRESHOLD = 1000
+# Strahler orders reported one by one, higher orders are counted with the last
+MAX_ORDER = 6
+
+
+def stream_mask(accumulation, threshold=THRESHOLD):
+    # Stream cells, NoData (NaN) is never a stream
+    with numpy.errstate(invalid="ignore"):
+        return numpy.asarray(accumulation) > threshold
+
+
+def stream_cells(direction, streams, cellsize=1.0, recv=None):
+    """Stream cells that continue into another stream cell, with the length of that step.
+
+    Like the polylines of StreamToFeature, every stream cell carries the D8 step to
+    its receiver (cell size or diagonal) when that receiver is a stream cell too, so
+    lines end at the centre of the outlet cell. cellsize is a number, (dx, dy) or
+    the per-row arrays of terrain.cell_sizes; recv are the receivers of direction
+    (d8.receivers), passed in to reuse a Topology. Returns (flat indices, lengths).
+    """
+    direction = numpy.asarray(direction)
+    rows, cols = direction.shape
+    if recv is None:
+        recv = d8.receivers(direction)
+    lengths = step_table(cellsize, rows)
+    flat = numpy.asarray(streams, dtype=bool).ravel()
+    cells = numpy.flatnonzero(flat)
+    down = recv[cells]
+    cells = cells[down >= 0]
+    cells = cells[flat[recv[cells]]]
+    return cells, lengths[cells // cols, terrain.WIDTH_CLASS[direction.ravel()[cells]]]
+
+
+def step_table(cellsize, rows):
+    # (rows, 4) length of the step of every terrain.WIDTH_CLASS in every row, 0 for none
+    dx, dy = terrain.per_row(cellsize, rows)
+    lengths = numpy.zeros((rows, 4), dtype=numpy.float64)
+    lengths[:, 0] = dx
+    lengths[:, 1] = dy
+    lengths[:, 2] = numpy.hypot(dx, dy)
+    return lengths
+
+
+def step_lengths(direction, cellsize=1.0):
+    # Length of the D8 step out of every cell, 0 where there is none; cellsize as in stream_cells
+    direction = numpy.asarray(direction)
+    rows = direction.shape[0]
+    return step_table(cellsize, rows)[numpy.arange(rows)[:, None], terrain.WIDTH_CLASS[direction]]
+
+
+def stream_length(direction, streams, cellsize=1.0, recv=None):
+    # Total length of the stream lines through the centres of the stream cells, see stream_cells
+    return float(stream_cells(direction, streams, cellsize, recv)[1].sum())
+
+
+def draining_to(topology, target):
+    """Cells whose flow path reaches a target cell, targets included.
+
+    This is the area Watershed assigns to the stream links; the waves of the
+    Topology are walked from the outlets upstream, so each cell is visited once.
+    """
+    recv, order, bounds = topology
+    reach = numpy.asarray(target, dtype=bool).ravel().copy()
+    for i in range(bounds.size - 2, -1, -1):
+        wave = order[bounds[i]:bounds[i + 1]]
+        down = recv[wave]
+        keep = down >= 0
+        reach[wave[keep]] |= reach[down[keep]]
+    return reach.reshape(numpy.shape(target))
+
+
+def stream_link(topology, streams):
+    """Stream link id of every stream cell, 0 elsewhere, like StreamLink.
+
+    A link starts at a stream source or just below a junction (a stream cell with
+    other than one stream cell draining into it) and runs down to the next
+    junction. Ids are given to the link heads in raster order, from 1.
+    """
+    recv, order, bounds = topology
+    flat = numpy.asarray(streams, dtype=bool).ravel()
+    heads, down, ndonors = _heads(recv, flat)
+    link = numpy.zeros(flat.size, dtype=numpy.int32)
+    link[heads] = numpy.arange(1, heads.size + 1)
+    follows = numpy.zeros(flat.size, dtype=bool)
+    follows[down] = ndonors[down] == 1
+    # upstream cells first, a link runs on into a receiver with no other stream donor
+    for i in range(bounds.size - 1):
+        wave = order[bounds[i]:bounds[i + 1]]
+        wave = wave[flat[wave]]
+        d = recv[wave]
+        keep = d >= 0
+        wave, d = wave[keep], d[keep]
+        keep = follows[d]
+        link[d[keep]] = link[wave[keep]]
+    return link.reshape(numpy.shape(streams))
+
+
+def _heads(recv, flat):
+    # Link heads of the stream cells flat, the stream receivers of stream cells and the
+    # number of stream donors of every cell
+    donors = numpy.flatnonzero(flat)
+    down = recv[donors]
+    down = down[down >= 0]
+    down = down[flat[down]]
+    ndonors = numpy.bincount(down, minlength=flat.size)
+    return numpy.flatnonzero(flat & (ndonors != 1)), down, ndonors
+
+
+def link_heads(topology, streams):
+    # Flat indices of the first cell of every stream link, see stream_link
+    return _heads(topology.receivers, numpy.asarray(streams, dtype=bool).ravel())[0]
+
+
+# strahler: Strahler order of the stream cells (0 elsewhere), shreve: number of sources
+# upstream of each stream cell, upstream: length of the longest flow path down to each
+# cell, distance: flow length from each cell down to the end of its path (the outlet)
+Network = namedtuple("Network", ["strahler", "shreve", "upstream", "distance"])
+
+
+def network(topology, direction, streams, cellsize=1.0):
+    """Stream orders and flow lengths of a D8 grid, as a Network of arrays shaped like direction.
+
+    A source is order 1; below a junction of two or more streams of the highest
+    order among them the order rises by one. Orders, magnitudes and the longest
+    flow path come from a single sweep over the waves, upstream cells first: a
+    cell is final when its wave comes up and is pushed into its receiver with a
+    few array operations per wave. The distances come from the sweep back.
+    """
+    recv, order, bounds = topology
+    shape = numpy.shape(direction)
+    flat = numpy.asarray(streams, dtype=bool).ravel()
+    step = step_lengths(direction, cellsize).ravel()
+    strahler = numpy.zeros(flat.size, dtype=numpy.uint8)
+    shreve = numpy.zeros(flat.size, dtype=numpy.int64)
+    # highest order among the stream donors of a cell so far, and how many have it
+    top = numpy.zeros(flat.size, dtype=numpy.uint8)
+    ntop = numpy.zeros(flat.size, dtype=numpy.uint8)
+    upstream = numpy.zeros(flat.size, dtype=numpy.float64)
+    for i in range(bounds.size - 1):
+        wave = order[bounds[i]:bounds[i + 1]]
+        s = wave[flat[wave]]
+        strahler[s] = numpy.where(top[s] == 0, 1, top[s] + (ntop[s] >= 2))
+        shreve[s] = numpy.maximum(shreve[s], 1)
+        down = recv[wave]
+        keep = down >= 0
+        wave, down = wave[keep], down[keep]
+        if not wave.size:
+            continue
+        u, inv = numpy.unique(down, return_inverse=True)
+        inv = inv.ravel()
+        longest = numpy.zeros(u.size, dtype=numpy.float64)
+        numpy.maximum.at(longest, inv, upstream[wave] + step[wave])
+        upstream[u] = numpy.maximum(upstream[u], longest)
+        # stream cells into stream cells carry their order and magnitude down
+        keep = flat[wave] & flat[down]
+        if not keep.any():
+            continue
+        s, d = wave[keep], down[keep]
+        u, inv = numpy.unique(d, return_inverse=True)
+        inv = inv.ravel()
+        o = strahler[s]
+        high = numpy.zeros(u.size, dtype=numpy.uint8)
+        numpy.maximum.at(high, inv, o)
+        nhigh = numpy.bincount(inv, weights=o == high[inv], minlength=u.size).astype(numpy.uint8)
+        new = numpy.maximum(top[u], high)
+        ntop[u] = numpy.where(top[u] == new, ntop[u], 0) + numpy.where(high == new, nhigh, 0)
+        top[u] = new
+        u, total = accumulation.reduce_by_index(d, shreve[s])
+        shreve[u] += total.astype(numpy.int64)
+    distance = numpy.zeros(flat.size, dtype=numpy.float64)
+    for i in range(bounds.size - 2, -1, -1):
+        wave = order[bounds[i]:bounds[i + 1]]
+        down = recv[wave]
+        keep = down >= 0
+        distance[wave[keep]] = distance[down[keep]] + step[wave[keep]]
+    return Network(strahler.reshape(shape), shreve.reshape(shape), upstream.reshape(shape),
+                   distance.reshape(shape))
+
+
+def order_totals(strahler, heads, cells, lengths, max_order=MAX_ORDER):
+    """(segments, lengths) per Strahler order 1..max_order, higher orders in the last.
+
+    heads are the link heads (link_heads), cells and lengths the stream steps
+    (stream_cells); every link is one segment of the order of its head.
+    """
+    strahler = numpy.minimum(numpy.asarray(strahler).ravel(), max_order)
+    segments = numpy.bincount(strahler[heads], minlength=max_order + 1)[1:]
+    length = numpy.bincount(strahler[cells], weights=lengths, minlength=max_order + 1)[1:]
+    return segments, length
+
+
+class ThresholdSweep(object):
+    """Stream length, link count and draining area of every threshold, from one accumulation.
+
+    A cell is a stream at threshold t when its accumulation is above t. As the
+    accumulation grows downstream, the step out of a stream cell always ends in a
+    stream cell, and a cell is a link head unless exactly one donor is a stream,
+    i.e. unless t lies between the accumulations of its second and first donors.
+    So every cell adds its step, its count and its head status to a contiguous
+    range of the sorted thresholds, and each sum is one difference histogram per
+    zone over the threshold bins, whatever the number of thresholds. The area
+    draining to the streams comes from the highest accumulation on each flow path.
+    """
+
+    def __init__(self, thresholds, nzones=2):
+        self.thresholds = numpy.unique(numpy.asarray(thresholds, dtype=numpy.float64))
+        self.nzones = nzones
+        shape = (nzones, self.thresholds.size)
+        self.length = numpy.zeros(shape, dtype=numpy.float64)
+        self.links = numpy.zeros(shape, dtype=numpy.int64)
+        self.area = numpy.zeros(shape, dtype=numpy.float64)
+
+    def _spans(self, zones, lo, hi, weights=None):
+        # (zones, thresholds) sums of weights over the threshold bins [lo, hi) of every cell
+        n = self.thresholds.size + 1
+        size = self.nzones * n
+        diff = (numpy.bincount(zones * n + lo, weights=weights, minlength=size) -
+                numpy.bincount(zones * n + hi, weights=weights, minlength=size))
+        return numpy.cumsum(diff.reshape(self.nzones, n), axis=1)[:, :-1]
+
+    def add(self, topology, direction, accumulation, cellsize=1.0, zones=None):
+        """Add the cells of zones (a zone id per cell, 0 skipped; None puts every cell in zone 1).
+
+        direction and accumulation are the D8 grid of topology and its flow
+        accumulation, NaN for NoData; cellsize as in stream_cells.
+        """
+        recv, order, bounds = topology
+        acc = numpy.asarray(accumulation, dtype=numpy.float64).ravel()
+        valid = ~numpy.isnan(acc)
+        if zones is None:
+            zones = numpy.ones(acc.size, dtype=numpy.int64)
+        zones = numpy.asarray(zones).ravel().astype(numpy.int64)
+        # number of thresholds below a value, the cell counts for the thresholds before it
+        below = lambda values: numpy.searchsorted(self.thresholds, values, side="left")
+        level = below(numpy.where(valid, acc, -numpy.inf))
+        # first and second highest accumulation among the donors of every cell
+        donors = numpy.flatnonzero(valid & (recv >= 0))
+        down, a = recv[donors], acc[donors]
+        keep = valid[down]
+        down, a = down[keep], a[keep]
+        first = numpy.full(acc.size, -numpy.inf)
+        numpy.maximum.at(first, down, a)
+        top = a == first[down]
+        second = numpy.full(acc.size, -numpy.inf)
+        numpy.maximum.at(second, down[~top], a[~top])
+        second = numpy.where(numpy.bincount(down[top], minlength=acc.size) >= 2, first, second)
+        # highest accumulation on the flow path of every cell, downstream cells first
+        highest = numpy.where(valid, acc, -numpy.inf)
+        for i in range(bounds.size - 2, -1, -1):
+            wave = order[bounds[i]:bounds[i + 1]]
+            d = recv[wave]
+            keep = d >= 0
+            wave, d = wave[keep], d[keep]
+            highest[wave] = numpy.maximum(highest[wave], highest[d])
+        rows, cols = numpy.shape(direction)
+        dx, dy = terrain.per_row(cellsize, rows)
+        cellarea = numpy.repeat(dx * dy * numpy.ones(rows), cols)
+        step = step_lengths(direction, cellsize).ravel()
+        cells = numpy.flatnonzero(valid & (zones > 0))
+        z, lo = zones[cells], numpy.zeros(cells.size, dtype=numpy.int64)
+        d = recv[cells]
+        step = numpy.where((d >= 0) & valid[numpy.maximum(d, 0)], step[cells], 0.0)
+        self.length += self._spans(z, lo, level[cells], step)
+        self.links += (self._spans(z, lo, level[cells]) -
+                       self._spans(z, below(second[cells]), below(first[cells]))).round().astype(numpy.int64)
+        self.area += self._spans(z, lo, below(highest[cells]), cellarea[cells])
+        return self
+
+    def combine(self, groups, atoms, ngroups):
+        # Sums of ngroups groups, zone atoms[i] belonging to group groups[i]
+        out = ThresholdSweep(self.thresholds, ngroups)
+        numpy.add.at(out.length, groups, self.length[atoms])
+        numpy.add.at(out.links, groups, self.links[atoms])
+        numpy.add.at(out.area, groups, self.area[atoms])
+        return out
+
+    def result(self):
+        """Dict of (zones, thresholds) arrays: stream length, link count, draining area and
+        drainage density (length / area, NaN without streams), thresholds sorted."""
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            density = numpy.where(self.area > 0, self.length / self.area, numpy.nan)
+        return {"thresholds": self.thresholds, "length": self.length, "links": self.links,
+                "area": self.area, "density": density}
+
+
+def threshold_sweep(topology, direction, accumulation, thresholds, cellsize=1.0, zones=None, nzones=2):
+    # Per-zone stream metrics of every threshold from one accumulation, see ThresholdSweep
+    return ThresholdSweep(thresholds, nzones).add(topology, direction, accumulation, cellsize, zones).result()
+
+
+def watershed(topology, labels):
+    """Every cell labelled with the first labelled cell on its flow path, like Watershed.
+
+    labels holds the pour points (e.g. stream links) as positive ids and 0 elsewhere;
+    cells whose path reaches no pour point stay 0. One sweep over the waves,
+    downstream cells first.
+    """
+    recv, order, bounds = topology
+    out = numpy.asarray(labels, dtype=numpy.int32).ravel().copy()
+    for i in range(bounds.size - 2, -1, -1):
+        wave = order[bounds[i]:bounds[i + 1]]
+        wave = wave[out[wave] == 0]
+        down = recv[wave]
+        keep = down >= 0
+        out[wave[keep]] = out[down[keep]]
+    return out.reshape(numpy.shape(labels))
+
+
+def area(mask, cellsize=1.0):
+    # Area of the cells of mask, cellsize as in stream_length
+    mask = numpy.asarray(mask, dtype=bool)
+    dx, dy = terrain.per_row(cellsize, mask.shape[0])
+    return float((mask.sum(axis=1) * dx * dy).sum())
@@ -0,0 +1,188 @@
+# Terrain indices on numpy arrays
+# Replacement for Slope and the Con/Ln/Tan raster algebra of the TWI step, one chunked pass per index
+import numpy
+
+import d8
+
+# Rows computed per chunk, bounds the float32 temporaries
+CHUNK_ROWS = 1024
+# Slope (radians) used for flat cells, as in Con(slope <= 0, 0.00001, ...)
+MIN_SLOPE = 0.00001
+# WGS84 ellipsoid
+SEMI_MAJOR = 6378137.0
+FLATTENING = 1 / 298.257223563
+
+
+############################################################################################################
+# Cell sizes
+############################################################################################################
+def cell_sizes(cellsize, rows, top=None, geographic=False):
+    """Width and height in metres of the cells of every row, two float64 arrays of rows values.
+
+    cellsize is a number or (dx, dy) in the units of the raster. For a lat/lon raster
+    (geographic, cellsize in degrees, top the latitude of the top edge) the sizes are
+    the lengths of the cell sides on the WGS84 ellipsoid at the row's centre latitude,
+    so slopes can be computed without projecting the DEM.
+    """
+    try:
+        dx, dy = cellsize
+    except TypeError:
+        dx = dy = cellsize
+    dx, dy = abs(float(dx)), abs(float(dy))
+    if not geographic:
+        return numpy.zeros(rows) + dx, numpy.zeros(rows) + dy
+    lat = numpy.radians(float(top) - (numpy.arange(rows) + 0.5) * dy)
+    e2 = FLATTENING * (2 - FLATTENING)
+    w = 1 - e2 * numpy.sin(lat) ** 2
+    # prime vertical and meridional radii of curvature
+    n = SEMI_MAJOR / numpy.sqrt(w)
+    m = SEMI_MAJOR * (1 - e2) / w ** 1.5
+    return n * numpy.cos(lat) * numpy.radians(dx), m * numpy.radians(dy)
+
+
+def per_row(cellsize, rows):
+    # (dx, dy) arrays of rows values from a number, a pair or a pair of arrays (see cell_sizes)
+    try:
+        dx, dy = cellsize
+    except TypeError:
+        dx = dy = cellsize
+    dx = numpy.abs(numpy.zeros(rows) + numpy.asarray(dx, dtype=numpy.float64))
+    dy = numpy.abs(numpy.zeros(rows) + numpy.asarray(dy, dtype=numpy.float64))
+    return dx, dy
+
+
+############################################################################################################
+# Slope and aspect
+############################################################################################################
+def horn(zp, r0, r1, dx, dy):
+    """dz/dx and dz/dy of rows r0:r1 with Horn's 3x3 kernel.
+
+    zp is the DEM padded with a NaN border (d8.padded), dx and dy hold the cell sizes
+    of every row. As in Slope, NoData neighbours take the value of the centre cell;
+    dz/dy is positive towards the south, the sign convention of the ESRI kernel.
+    """
+    cols = zp.shape[1] - 2
+    c = zp[1 + r0:1 + r1, 1:1 + cols]
+
+    def nb(k):
+        dr, dc = d8.D8_OFFSETS[k]
+        v = zp[1 + r0 + dr:1 + r1 + dr, 1 + dc:1 + dc + cols]
+        return numpy.where(numpy.isnan(v), c, v)
+
+    # neighbours in D8_OFFSETS order: E, SE, S, SW, W, NW, N, NE
+    gx = nb(7) + 2 * nb(0) + nb(1) - nb(5) - 2 * nb(4) - nb(3)
+    gx /= (8 * dx[r0:r1])[:, None].astype(gx.dtype)
+    gy = nb(3) + 2 * nb(2) + nb(1) - nb(5) - 2 * nb(6) - nb(7)
+    gy /= (8 * dy[r0:r1])[:, None].astype(gy.dtype)
+    return gx, gy
+
+
+def slopes(dems, cellsize=1.0, nodata=None, top=None, geographic=False, aspect=False):
+    """Slope in degrees of every DEM in dems, which all lie on the same grid.
+
+    Like Slope(dem, "DEGREE") with Horn's kernel, computed in chunks of rows over
+    one shared padded buffer, so the raw and the filled DEM of a basin cost a single
+    call. cellsize, top and geographic are passed to cell_sizes; a pair of per-row
+    arrays is used as is. Returns a list of float32 arrays, or of (slope, aspect)
+    pairs with aspect=True: aspect in degrees clockwise from north, -1 on flat cells.
+    """
+    rows, cols = numpy.shape(dems[0])
+    if geographic:
+        dx, dy = cell_sizes(cellsize, rows, top, True)
+    else:
+        dx, dy = per_row(cellsize, rows)
+    zp = d8.padded(numpy.zeros((rows, cols), dtype=numpy.float32))
+    inner = zp[1:-1, 1:-1]
+    out = []
+    for dem in dems:
+        inner[...] = dem
+        if nodata is not None:
+            inner[inner == nodata] = numpy.nan
+        slope = numpy.empty((rows, cols), dtype=numpy.float32)
+        asp = numpy.empty((rows, cols), dtype=numpy.float32) if aspect else None
+        for r in range(0, rows, CHUNK_ROWS):
+            r1 = min(r + CHUNK_ROWS, rows)
+            gx, gy = horn(zp, r, r1, dx, dy)
+            missing = numpy.isnan(inner[r:r1])
+            s = numpy.degrees(numpy.arctan(numpy.hypot(gx, gy)))
+            s[missing] = numpy.nan
+            slope[r:r1] = s
+            if aspect:
+                # angle of the downslope direction, turned into a compass bearing
+                a = numpy.degrees(numpy.arctan2(gy, -gx))
+                a = numpy.where(a < 0, 90.0 - a, numpy.where(a > 90, 450.0 - a, 90.0 - a))
+                a[(gx == 0) & (gy == 0)] = -1
+                a[missing] = numpy.nan
+                asp[r:r1] = a
+        out.append((slope, asp) if aspect else slope)
+    return out
+
+
+############################################################################################################
+# Wetness index
+############################################################################################################
+# Axis of each D8 code: 0 east/west, 1 north/south, 2 diagonal, 3 none; the class of both the
+# flow width (flow_widths) and the step length (streams.step_lengths) of a cell
+WIDTH_CLASS = numpy.empty(256, dtype=numpy.uint8)
+WIDTH_CLASS.fill(3)
+WIDTH_CLASS[d8.D8_CODES] = (0, 2, 1, 2, 0, 2, 1, 2)
+
+
+def flow_widths(cellsize=1.0, rows=1):
+    """Width of the flow of every WIDTH_CLASS in every row, a (rows, 4) float32 table.
+
+    Flow to E/W crosses the cell height, flow to N/S the cell width and diagonal
+    flow the cell diagonal; class 3 (NoData, undefined flats) is NaN. cellsize is a
+    number, (dx, dy) or the per-row arrays of cell_sizes. The width of the flow out
+    of a cell is widths[row, WIDTH_CLASS[code]].
+    """
+    dx, dy = per_row(cellsize, rows)
+    widths = numpy.empty((rows, 4), dtype=numpy.float32)
+    widths[:, 0] = dy
+    widths[:, 1] = dx
+    widths[:, 2] = numpy.hypot(dx, dy)
+    widths[:, 3] = numpy.nan
+    return widths
+
+
+def twi(direction, accumulation, slope, cellsize=1.0, out=None, sca=None):
+    """Topographic wetness index ln(SCA / tan(slope)) of every cell.
+
+    direction holds D8 codes, accumulation the upstream cell count (0 counts as
+    one cell, as in Con(Acc == 0, 1, Acc)) and slope the slope in degrees; flat
+    cells use MIN_SLOPE radians. SCA is the contributing area over the flow width
+    of the cell's direction, taken from flow_widths; cellsize may also be the
+    per-row (dx, dy) arrays of cell_sizes. Rows are processed in chunks into the
+    float32 out array; pass an array as sca to keep the SCA as well. Cells that
+    are NoData in any input are NaN.
+    """
+    direction = numpy.asarray(direction)
+    accumulation = numpy.asarray(accumulation)
+    slope = numpy.asarray(slope)
+    rows = direction.shape[0]
+    dx, dy = per_row(cellsize, rows)
+    widths = flow_widths((dx, dy), rows)
+    area = (dx * dy).astype(numpy.float32)
+    rad = numpy.float32(numpy.pi / 180.0)
+    if out is None:
+        out = numpy.empty(direction.shape, dtype=numpy.float32)
+    for r in range(0, rows, CHUNK_ROWS):
+        part = slice(r, min(r + CHUNK_ROWS, rows))
+        # specific catchment area
+        a = accumulation[part].astype(numpy.float32)
+        a[a == 0] = 1
+        a *= area[part, None]
+        cls = WIDTH_CLASS[direction[part]]
+        a /= widths[part][numpy.arange(cls.shape[0])[:, None], cls]
+        if sca is not None:
+            sca[part] = a
+        # tangent of the clamped slope in radians
+        s = slope[part].astype(numpy.float32)
+        s *= rad
+        with numpy.errstate(invalid="ignore"):
+            s[s <= 0] = MIN_SLOPE
+        numpy.tan(s, out=s)
+        a /= s
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            numpy.log(a, out=out[part])
+    return out
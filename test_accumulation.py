@@ -0,0 +1,40 @@
+# Checks of the wave accumulation against walking every flow path
+import numpy
+
+import accumulation
+import d8
+
+
+def walked(direction, weight):
+    # reference accumulation: every cell adds its weight to each cell down its flow path
+    recv = d8.receivers(direction)
+    out = numpy.zeros(direction.size)
+    for cell in range(direction.size):
+        down = recv[cell]
+        while down >= 0:
+            out[down] += weight[cell]
+            down = recv[down]
+    out[direction.ravel() == d8.NODATA] = numpy.nan
+    return out.reshape(direction.shape)
+
+
+def tilted_dem():
+    # a plane falling one unit per cell towards the top left with noise below that, so no pits
+    rows, cols = numpy.mgrid[0:20, 0:25]
+    noise = numpy.random.RandomState(3).rand(20, 25) * 0.4
+    dem = (rows + cols + noise).astype(numpy.float32)
+    dem[5, 7] = numpy.nan
+    return dem
+
+
+def test_matches_walked_flow_paths():
+    direction = d8.flow_direction(tilted_dem())
+    acc, topology = accumulation.flow_accumulation(direction)
+    numpy.testing.assert_array_equal(acc, walked(direction, numpy.ones(direction.size)))
+
+
+def test_weighted_matches_walked_flow_paths():
+    direction = d8.flow_direction(tilted_dem())
+    weight = numpy.arange(direction.size, dtype=numpy.float64) % 7
+    acc, topology = accumulation.flow_accumulation(direction, weight.reshape(direction.shape))
+    numpy.testing.assert_allclose(acc, walked(direction, weight))
@@ -0,0 +1,71 @@
+# Checks of the polygon rasterizer against point-in-polygon at the cell centres
+import numpy
+
+import boundary
+
+# cells of 10 x 10 map units, the grid's top left corner at (1000, 2000)
+TRANSFORM = (1000.0, 10.0, 2000.0, -10.0)
+SHAPE = (12, 15)
+
+
+def ring(*points):
+    # closed ring of (x, y) map coordinates
+    return numpy.array(points + points[:1], dtype=numpy.float64)
+
+
+def inside(parts, x, y):
+    # even-odd rule over all parts, by counting the edges a ray to the east crosses
+    hit = False
+    for p in parts:
+        for (xa, ya), (xb, yb) in zip(p[:-1], p[1:]):
+            if (ya > y) != (yb > y) and x < xa + (y - ya) * (xb - xa) / (yb - ya):
+                hit = not hit
+    return hit
+
+
+def centres_inside(parts):
+    x0, dx, y0, dy = TRANSFORM
+    out = numpy.zeros(SHAPE, dtype=bool)
+    for r in range(SHAPE[0]):
+        for c in range(SHAPE[1]):
+            out[r, c] = inside(parts, x0 + (c + 0.5) * dx, y0 + (r + 0.5) * dy)
+    return out
+
+
+def polygon(parts):
+    points = numpy.concatenate(parts)
+    bbox = (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+    return boundary.Shape(5, bbox, parts, {})
+
+
+# a skewed quadrilateral with a triangular hole, and a triangle reaching off the grid
+PARTS = [ring((1013.0, 1987.0), (1121.0, 1969.0), (1097.0, 1893.0), (1031.0, 1905.0)),
+         ring((1050.0, 1950.0), (1080.0, 1940.0), (1060.0, 1915.0)),
+         ring((1120.0, 1900.0), (1190.0, 1860.0), (1110.0, 1840.0))]
+
+
+def test_cell_centres_inside():
+    mask = boundary.rasterize([polygon(PARTS)], TRANSFORM, SHAPE)
+    numpy.testing.assert_array_equal(mask, centres_inside(PARTS))
+    assert mask.any() and not mask.all()
+
+
+def test_all_touched_covers_centres_and_edges():
+    centres = boundary.rasterize([polygon(PARTS)], TRANSFORM, SHAPE)
+    touched = boundary.rasterize([polygon(PARTS)], TRANSFORM, SHAPE, all_touched=True)
+    assert (touched >= centres).all()
+    # the cell of every vertex on the grid is touched
+    x0, dx, y0, dy = TRANSFORM
+    for x, y in numpy.concatenate(PARTS):
+        r, c = int((y - y0) // dy), int((x - x0) // dx)
+        if 0 <= r < SHAPE[0] and 0 <= c < SHAPE[1]:
+            assert touched[r, c]
+
+
+def test_window_mask_places_the_bounding_box():
+    shapes = [polygon(PARTS[:2])]
+    mask, row0, col0 = boundary.window_mask(shapes, TRANSFORM, SHAPE)
+    full = boundary.rasterize(shapes, TRANSFORM, SHAPE)
+    assert (row0, col0) == (1, 1)
+    numpy.testing.assert_array_equal(full[row0:row0 + mask.shape[0], col0:col0 + mask.shape[1]], mask)
+    assert full.sum() == mask.sum()
@@ -0,0 +1,22 @@
+# Checks of the numpy D8 engine against the FlowDirection rules
+import numpy
+
+import d8
+
+
+def test_pit_flows_to_lowest_neighbour():
+    # the E neighbour is lowest, the diagonals have the smaller distance-weighted rise
+    dem = numpy.array([[4.5, 9.0, 4.5],
+                       [9.0, 1.0, 3.9],
+                       [4.5, 9.0, 4.5]])
+    dem = numpy.pad(dem, 1, mode="constant", constant_values=10.0)
+    assert d8.flow_direction(dem)[2, 2] == 1
+
+
+def test_downhill_cell_takes_steepest_drop():
+    # a drop of 1 east beats a drop of 1.2 on the diagonal once divided by sqrt(2)
+    dem = numpy.array([[5.0, 5.0, 5.0],
+                       [5.0, 5.0, 4.0],
+                       [5.0, 5.0, 3.8]])
+    dem = numpy.pad(dem, 1, mode="constant", constant_values=10.0)
+    assert d8.flow_direction(dem)[2, 2] == 1
@@ -0,0 +1,53 @@
+# Checks of the vectorized priority flood against a plain heapq one
+import heapq
+
+import numpy
+
+import fill
+
+
+def priority_flood(dem):
+    # reference fill: border cells seed a heap, every cell popped raises its unvisited neighbours
+    rows, cols = dem.shape
+    level = dem.copy()
+    seen = numpy.zeros(dem.shape, dtype=bool)
+    seen[[0, -1], :] = seen[:, [0, -1]] = True
+    heap = [(level[r, c], r, c) for r, c in zip(*numpy.nonzero(seen))]
+    heapq.heapify(heap)
+    while heap:
+        z, r, c = heapq.heappop(heap)
+        for rr in range(max(r - 1, 0), min(r + 2, rows)):
+            for cc in range(max(c - 1, 0), min(c + 2, cols)):
+                if not seen[rr, cc]:
+                    seen[rr, cc] = True
+                    level[rr, cc] = max(level[rr, cc], z)
+                    heapq.heappush(heap, (level[rr, cc], rr, cc))
+    return level
+
+
+def test_pit_fills_to_spill_level():
+    # the pit spills over the 4 on the east border
+    dem = numpy.array([[5, 5, 5, 5],
+                       [5, 1, 2, 5],
+                       [5, 2, 3, 4],
+                       [5, 5, 5, 5]], dtype=numpy.float32)
+    expected = numpy.where(dem < 4, 4, dem)
+    expected[1:3, 1:3] = 4
+    numpy.testing.assert_array_equal(fill.fill_depressions(dem), expected)
+
+
+def test_matches_heapq_priority_flood(monkeypatch):
+    # small rounds, so the frontier is carried over many round bounds
+    monkeypatch.setattr(fill, "ROUND", 16)
+    dem = (numpy.random.RandomState(7).rand(30, 40) * 100).astype(numpy.float32)
+    numpy.testing.assert_array_equal(fill.fill_depressions(dem), priority_flood(dem))
+
+
+def test_nodata_stays_nodata_and_seeds():
+    # a cell next to NoData drains into it, so the pit beside the hole is not filled
+    dem = numpy.full((5, 5), 9.0, dtype=numpy.float32)
+    dem[2, 2] = numpy.nan
+    dem[2, 3] = 1.0
+    filled = fill.fill_depressions(dem)
+    assert numpy.isnan(filled[2, 2])
+    assert filled[2, 3] == 1.0
@@ -0,0 +1,97 @@
+# Checks of the GeoTIFF reader on small files written by hand
+import struct
+import zlib
+
+import numpy
+
+import raster
+
+# field type -> struct format, as raster.FIELD_TYPES
+FORMATS = {3: "H", 4: "I", 12: "d"}
+
+
+def write_tiff(path, entries, blocks, offsets_tag, counts_tag):
+    # little-endian TIFF: header, the blocks, then one IFD of entries {tag: (type, values)}
+    pos = 8
+    offsets = []
+    for block in blocks:
+        offsets.append(pos)
+        pos += len(block)
+    entries = dict(entries)
+    entries[offsets_tag] = (4, offsets)
+    entries[counts_tag] = (4, [len(block) for block in blocks])
+    ifd = pos + pos % 2
+    extra = ifd + 2 + 12 * len(entries) + 4
+    table, values = b"", b""
+    for tag in sorted(entries):
+        typ, data = entries[tag]
+        raw = data if typ == 2 else struct.pack("<" + FORMATS[typ] * len(data), *data)
+        if len(raw) <= 4:
+            table += struct.pack("<HHI", tag, typ, len(data)) + raw.ljust(4, b"\0")
+        else:
+            table += struct.pack("<HHII", tag, typ, len(data), extra + len(values))
+            values += raw
+    with open(path, "wb") as f:
+        f.write(b"II" + struct.pack("<HI", 42, ifd) + b"".join(blocks) + b"\0" * (ifd - pos))
+        f.write(struct.pack("<H", len(entries)) + table + struct.pack("<I", 0) + values)
+
+
+def test_packbits():
+    # the example of the TIFF 6.0 specification
+    data = bytearray([0xFE, 0xAA, 0x02, 0x80, 0x00, 0x2A, 0xFD, 0xAA, 0x03, 0x80, 0x00, 0x2A, 0x22,
+                      0xF7, 0xAA])
+    out = bytearray([0xAA] * 3 + [0x80, 0x00, 0x2A] + [0xAA] * 4 + [0x80, 0x00, 0x2A, 0x22] + [0xAA] * 10)
+    assert raster.packbits_decode(bytes(data)) == bytes(out)
+
+
+def test_tiled_deflate_with_predictor(tmp_path):
+    # 20 x 24 cells in 2 x 2 tiles of 16, the tiles on the right and bottom padded
+    values = (numpy.arange(20 * 24, dtype=numpy.uint16) * 37).reshape(20, 24)
+    padded = numpy.zeros((32, 32), dtype=numpy.uint16)
+    padded[:20, :24] = values
+    blocks = []
+    for by in range(2):
+        for bx in range(2):
+            tile = padded[by * 16:(by + 1) * 16, bx * 16:(bx + 1) * 16]
+            diff = tile.copy()
+            diff[:, 1:] = tile[:, 1:] - tile[:, :-1]
+            blocks.append(zlib.compress(diff.astype("<u2").tobytes()))
+    entries = {raster.IMAGE_WIDTH: (3, [24]), raster.IMAGE_LENGTH: (3, [20]),
+               raster.BITS_PER_SAMPLE: (3, [16]), raster.COMPRESSION: (3, [8]), raster.PREDICTOR: (3, [2]),
+               raster.TILE_WIDTH: (3, [16]), raster.TILE_LENGTH: (3, [16])}
+    path = str(tmp_path / "tiled.tif")
+    write_tiff(path, entries, blocks, raster.TILE_OFFSETS, raster.TILE_BYTE_COUNTS)
+    with raster.GeoTiff(path, raster.BlockCache()) as tif:
+        assert tif.tiled and tif.dtype == numpy.dtype("<u2")
+        numpy.testing.assert_array_equal(tif.read(0, 0, 20, 24), values)
+        numpy.testing.assert_array_equal(tif.read(10, 12, 8, 8), values[10:18, 12:20])
+        # no NoData in the file, cells off the raster read as 0
+        window = tif.read(18, 22, 4, 4)
+        numpy.testing.assert_array_equal(window[:2, :2], values[18:, 22:])
+        assert not window[2:].any() and not window[:, 2:].any()
+
+
+def test_strips_georeference_and_nodata(tmp_path):
+    # 7 x 5 float cells in strips of 3 rows, uncompressed, so memory-mapped
+    values = numpy.arange(35, dtype=numpy.float32).reshape(7, 5)
+    blocks = [values[r:r + 3].astype("<f4").tobytes() for r in range(0, 7, 3)]
+    entries = {raster.IMAGE_WIDTH: (3, [5]), raster.IMAGE_LENGTH: (3, [7]),
+               raster.BITS_PER_SAMPLE: (3, [32]), raster.SAMPLE_FORMAT: (3, [3]),
+               raster.ROWS_PER_STRIP: (3, [3]),
+               raster.MODEL_PIXEL_SCALE: (12, [30.0, 30.0, 0.0]),
+               raster.MODEL_TIEPOINT: (12, [0.0, 0.0, 0.0, 500000.0, 4000000.0, 0.0]),
+               raster.GDAL_NODATA: (2, b"-9999\0")}
+    path = str(tmp_path / "strips.tif")
+    write_tiff(path, entries, blocks, raster.STRIP_OFFSETS, raster.STRIP_BYTE_COUNTS)
+    with raster.GeoTiff(path, raster.BlockCache()) as tif:
+        assert tif._mm is not None
+        assert tif.nodata == -9999
+        assert tif.cellsize == (30.0, 30.0)
+        assert tif.extent == (500000.0, 4000000.0 - 7 * 30, 500000.0 + 5 * 30, 4000000.0)
+        numpy.testing.assert_array_equal(tif.read(0, 0, 7, 5), values)
+        window = tif.read(-1, 3, 3, 3)
+        numpy.testing.assert_array_equal(window[1:, :2], values[:2, 3:])
+        assert (window[0] == -9999).all() and (window[:, 2] == -9999).all()
+        cells, row0, col0 = tif.read_bbox(500000.0 + 30, 4000000.0 - 90, 500000.0 + 90, 4000000.0 - 30)
+        assert (row0, col0) == (1, 1)
+        numpy.testing.assert_array_equal(cells, values[1:3, 1:3])
@@ -0,0 +1,32 @@
+# Checks of the stream orders on a hand-drawn network
+import numpy
+
+import accumulation
+import streams
+
+# two sources meet in an order 2 stream, a third source joins it lower down
+#   A . B
+#   . J .
+#   C K .
+#   . O .
+DIRECTION = numpy.array([[2, 0, 8],
+                         [0, 4, 0],
+                         [1, 4, 0],
+                         [0, 4, 0]], dtype=numpy.uint8)
+
+
+def test_strahler_and_shreve():
+    acc, topology = accumulation.flow_accumulation(DIRECTION)
+    net = streams.network(topology, DIRECTION, DIRECTION > 0)
+    numpy.testing.assert_array_equal(net.strahler, [[1, 0, 1], [0, 2, 0], [1, 2, 0], [0, 2, 0]])
+    numpy.testing.assert_array_equal(net.shreve, [[1, 0, 1], [0, 2, 0], [1, 3, 0], [0, 3, 0]])
+
+
+def test_longest_flow_path_and_length():
+    acc, topology = accumulation.flow_accumulation(DIRECTION)
+    net = streams.network(topology, DIRECTION, DIRECTION > 0)
+    # A (or B) to O: one diagonal step, then two straight ones
+    assert abs(net.upstream[3, 1] - (2 + numpy.sqrt(2))) < 1e-12
+    # A-J, B-J, J-K, C-K and K-O, the step out of O leaves the grid
+    length = streams.stream_length(DIRECTION, DIRECTION > 0)
+    assert abs(length - (3 + 2 * numpy.sqrt(2))) < 1e-12
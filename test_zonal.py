@@ -0,0 +1,49 @@
+# Checks that chunked and merged zonal statistics equal a single pass
+import numpy
+
+import zonal
+
+ZONES = numpy.array([[1, 1, 2, 0],
+                     [1, 2, 2, 3],
+                     [3, 3, 2, 0]])
+VALUES = numpy.array([[1.0, 4.0, 2.0, 99.0],
+                      [7.0, numpy.nan, 5.0, 3.0],
+                      [6.0, 0.5, 8.0, 99.0]])
+
+
+def test_stats_of_zones():
+    out = zonal.ZonalStats(4).add(ZONES, VALUES).result()
+    numpy.testing.assert_array_equal(out["count"][1:], [3, 3, 3])
+    numpy.testing.assert_allclose(out["mean"][1:], [4.0, 5.0, 9.5 / 3])
+    numpy.testing.assert_array_equal(out["min"][1:], [1.0, 2.0, 0.5])
+    numpy.testing.assert_allclose(out["std"][1:], [numpy.std([1.0, 4.0, 7.0]), numpy.std([2.0, 5.0, 8.0]),
+                                                   numpy.std([3.0, 6.0, 0.5])])
+
+
+def test_merged_chunks_equal_one_pass():
+    whole = zonal.ZonalStats(4).add(ZONES, VALUES).result()
+    parts = zonal.ZonalStats(4).add(ZONES[:1], VALUES[:1])
+    merged = parts.merge(zonal.ZonalStats(4).add(ZONES[1:], VALUES[1:])).result()
+    for key in ("count", "sum", "mean", "min", "max", "std"):
+        numpy.testing.assert_allclose(merged[key], whole[key])
+
+
+def test_combined_zones_equal_their_union():
+    # zones 1 and 2 as one group, zone 3 alone
+    stats = zonal.ZonalStats(4).add(ZONES, VALUES)
+    out = stats.combine(numpy.array([0, 0, 1]), numpy.array([1, 2, 3]), 2).result()
+    union = numpy.where(ZONES == 3, 2, numpy.where(ZONES > 0, 1, 0))
+    whole = zonal.ZonalStats(3).add(union, VALUES).result()
+    for key in ("count", "sum", "mean", "min", "max", "std"):
+        numpy.testing.assert_allclose(out[key], whole[key][1:])
+
+
+def test_quantiles_merge_and_count_outside():
+    whole = zonal.ZonalQuantiles(4, 0.0, 8.0, 16).add(ZONES, VALUES)
+    parts = zonal.ZonalQuantiles(4, 0.0, 8.0, 16).add(ZONES[:2], VALUES[:2])
+    parts.merge(zonal.ZonalQuantiles(4, 0.0, 8.0, 16).add(ZONES[2:], VALUES[2:]))
+    numpy.testing.assert_array_equal(parts.counts, whole.counts)
+    out = parts.result()
+    # zone 0 is skipped, so the 99s are never outside
+    numpy.testing.assert_array_equal(out["outside"], [0, 0, 0, 0])
+    numpy.testing.assert_allclose(out["median"][1:], [4.0, 5.0, 3.0], atol=0.5)
@@ -0,0 +1,386 @@
+# Zonal statistics for all subbasins in one pass over a raster
+# Replacement for ExtractByMask + GetRasterProperties_management once per basin
+import numpy
+
+# Rows of a raster reduced per call of ZonalStats.add, bounds the temporaries
+CHUNK_ROWS = 1024
+# Bins of ZonalQuantiles over the value range, quantiles are within one bin width
+BINS = 1024
+# Quantiles reported by ZonalQuantiles.result, as (key, probability)
+PROBS = (("p10", 0.1), ("median", 0.5), ("p90", 0.9))
+
+
+############################################################################################################
+# Zone grid
+############################################################################################################
+class ZoneGrid(object):
+    """Integer zone grid for basins that may overlap (nested gauge basins).
+
+    Each cell holds an atom id, an atom being the set of basins that cover the cell;
+    atom 0 is covered by no basin. Statistics are reduced per atom and merged into
+    per-basin results, so one grid serves any number of nested basins.
+    """
+
+    def __init__(self, shape, nbasins):
+        self.grid = numpy.zeros(shape, dtype=numpy.int32)
+        self.members = [()]
+        self.nbasins = nbasins
+
+    def burn(self, basin, mask, row0=0, col0=0):
+        # Add basin to every cell where mask is set, mask is placed at (row0, col0)
+        mask = numpy.asarray(mask, dtype=bool)
+        win = self.grid[row0:row0 + mask.shape[0], col0:col0 + mask.shape[1]]
+        mask = mask[:win.shape[0], :win.shape[1]]
+        old = win[mask]
+        if not old.size:
+            return
+        u, inv = numpy.unique(old, return_inverse=True)
+        start = len(self.members)
+        for a in u.tolist():
+            self.members.append(self.members[a] + (basin,))
+        win[mask] = (start + inv.ravel()).astype(numpy.int32)
+
+    def pairs(self):
+        # (basin, atom) pairs of every basin membership
+        basins, atoms = [], []
+        for a, m in enumerate(self.members):
+            basins.extend(m)
+            atoms.extend([a] * len(m))
+        return numpy.array(basins, dtype=numpy.int64), numpy.array(atoms, dtype=numpy.int64)
+
+    @property
+    def natoms(self):
+        return len(self.members)
+
+
+############################################################################################################
+# Statistics
+############################################################################################################
+class ZonalStats(object):
+    """Per-zone count, sum, mean, min, max and std, updated chunk by chunk.
+
+    Means and squared deviations are merged with Chan's parallel formula, so chunks,
+    tiles and results from other processes can be combined in any order. Integer
+    rasters (scaled NDVI, soil percentages) are reduced in their own type and also
+    summed exactly in int64, their sum and mean do not depend on that order.
+    """
+
+    def __init__(self, nzones):
+        self.nzones = nzones
+        self.count = numpy.zeros(nzones, dtype=numpy.int64)
+        # exact sums while every value added is an integer, None after a float block
+        self.total = numpy.zeros(nzones, dtype=numpy.int64)
+        self.mean = numpy.zeros(nzones, dtype=numpy.float64)
+        self.m2 = numpy.zeros(nzones, dtype=numpy.float64)
+        self.min = numpy.empty(nzones, dtype=numpy.float64)
+        self.min.fill(numpy.inf)
+        self.max = numpy.empty(nzones, dtype=numpy.float64)
+        self.max.fill(-numpy.inf)
+
+    def add(self, zones, values, nodata=None):
+        # Reduce a block of values with the matching block of the zone grid
+        zones = numpy.asarray(zones)
+        values = numpy.asarray(values)
+        for r in range(0, zones.shape[0], CHUNK_ROWS):
+            self.add_cells(zones[r:r + CHUNK_ROWS].ravel(), values[r:r + CHUNK_ROWS].ravel(), nodata)
+        return self
+
+    def add_cells(self, z, v, nodata=None):
+        # Flat zone ids and values of the same cells, zone 0 is skipped
+        ok = z > 0
+        if nodata is not None:
+            ok &= v != nodata
+        if v.dtype.kind == "f":
+            ok &= ~numpy.isnan(v)
+        z = z[ok]
+        v = v[ok]
+        if not z.size:
+            return
+        n = numpy.bincount(z, minlength=self.nzones)
+        s = numpy.bincount(z, weights=v, minlength=self.nzones)
+        if v.dtype.kind not in "biu":
+            self.total = None
+        elif self.total is not None:
+            if v.dtype.itemsize <= 2:
+                # float64 sums of 16-bit values are exact up to 2 ** 37 cells per chunk
+                self.total += s.astype(numpy.int64)
+            else:
+                numpy.add.at(self.total, z, v.astype(numpy.int64))
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            mean = s / n
+        dev = v - mean[z]
+        m2 = numpy.bincount(z, weights=dev * dev, minlength=self.nzones)
+        self._merge(n, mean, m2)
+        numpy.minimum.at(self.min, z, v)
+        numpy.maximum.at(self.max, z, v)
+
+    def _merge(self, n, mean, m2):
+        total = self.count + n
+        hit = n > 0
+        delta = mean[hit] - self.mean[hit]
+        self.m2[hit] += m2[hit] + delta * delta * self.count[hit] * n[hit] / total[hit]
+        self.mean[hit] += delta * n[hit] / total[hit]
+        self.count = total
+
+    def merge(self, other):
+        # Fold in the statistics of the same zones computed elsewhere
+        self.total = self.total + other.total if self.total is not None and other.total is not None else None
+        self._merge(other.count, other.mean, other.m2)
+        numpy.minimum(self.min, other.min, out=self.min)
+        numpy.maximum(self.max, other.max, out=self.max)
+        return self
+
+    def combine(self, groups, atoms, ngroups):
+        # Statistics of ngroups groups, zone atoms[i] belonging to group groups[i]
+        out = ZonalStats(ngroups)
+        n = self.count[atoms]
+        out.count = numpy.bincount(groups, weights=n, minlength=ngroups).astype(numpy.int64)
+        s = numpy.bincount(groups, weights=self.mean[atoms] * n, minlength=ngroups)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            out.mean = numpy.where(out.count > 0, s / out.count, 0.0)
+        dev = self.mean[atoms] - out.mean[groups]
+        out.m2 = numpy.bincount(groups, weights=self.m2[atoms] + n * dev * dev, minlength=ngroups)
+        if self.total is None:
+            out.total = None
+        else:
+            numpy.add.at(out.total, groups, self.total[atoms])
+        numpy.minimum.at(out.min, groups, self.min[atoms])
+        numpy.maximum.at(out.max, groups, self.max[atoms])
+        return out
+
+    def result(self, scale=1.0):
+        # dict of per-zone arrays, NaN where a zone has no valid cell; scale multiplies
+        # the values (e.g. 1 / 10000.0 for NDVI x 10000) and is applied here only
+        empty = self.count == 0
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            std = numpy.sqrt(self.m2 / self.count) * scale
+            if self.total is None:
+                total = self.mean * self.count
+                mean = self.mean.copy()
+            else:
+                total = self.total.copy()
+                mean = total / self.count.astype(numpy.float64)
+        out = {
+            "count": self.count,
+            "sum": total if scale == 1.0 else total * scale,
+            "mean": mean * scale,
+            "min": self.min * scale,
+            "max": self.max * scale,
+            "std": std,
+        }
+        for key in ("mean", "min", "max", "std"):
+            out[key][empty] = numpy.nan
+        return out
+
+
+class ZonalHistogram(object):
+    """Per-zone counts of every integer class, in one pass over the raster.
+
+    Memory is O(zones x classes) whatever the raster size; values outside
+    [0, nclasses) and NoData are not counted.
+    """
+
+    def __init__(self, nzones, nclasses):
+        self.nzones = nzones
+        self.nclasses = nclasses
+        self.counts = numpy.zeros((nzones, nclasses), dtype=numpy.int64)
+
+    def add(self, zones, values, nodata=None):
+        zones = numpy.asarray(zones)
+        values = numpy.asarray(values)
+        for r in range(0, zones.shape[0], CHUNK_ROWS):
+            self.add_cells(zones[r:r + CHUNK_ROWS].ravel(), values[r:r + CHUNK_ROWS].ravel(), nodata)
+        return self
+
+    def add_cells(self, z, v, nodata=None):
+        # Flat zone ids and class values of the same cells, zone 0 is skipped
+        ok = (z > 0) & (v >= 0) & (v < self.nclasses)
+        if nodata is not None:
+            ok &= v != nodata
+        key = z[ok].astype(numpy.int64) * self.nclasses + v[ok].astype(numpy.int64)
+        self.counts += numpy.bincount(key, minlength=self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def combine(self, groups, atoms, ngroups):
+        out = ZonalHistogram(ngroups, self.nclasses)
+        numpy.add.at(out.counts, groups, self.counts[atoms])
+        return out
+
+    def result(self):
+        # (zones, classes) counts
+        return self.counts
+
+
+class ZonalQuantiles(object):
+    """Per-zone distribution of values in a fixed-bin histogram over [lo, hi].
+
+    Memory is O(zones x bins) whatever the raster size. Histograms with the same lo,
+    hi and bins merge by adding, so chunks, tiles and worker processes combine in
+    any order. A quantile is interpolated inside the bin where the cumulative count
+    crosses it, so it is off by less than one bin width (hi - lo) / bins; min, max
+    and mean are exact. Values outside [lo, hi] are counted in the end bins and per
+    zone in outside; the bound only holds for zones without any (error is inf for
+    the others), so lo and hi should span the data, e.g. from value_range.
+    """
+
+    def __init__(self, nzones, lo, hi, bins=BINS):
+        self.nzones = nzones
+        self.lo = float(lo)
+        self.hi = float(hi) if hi > lo else float(lo) + 1.0
+        self.bins = bins
+        self.counts = numpy.zeros((nzones, bins), dtype=numpy.int64)
+        self.outside = numpy.zeros(nzones, dtype=numpy.int64)
+        self.stats = ZonalStats(nzones)
+
+    @property
+    def width(self):
+        return (self.hi - self.lo) / self.bins
+
+    def add(self, zones, values, nodata=None):
+        zones = numpy.asarray(zones)
+        values = numpy.asarray(values)
+        for r in range(0, zones.shape[0], CHUNK_ROWS):
+            self.add_cells(zones[r:r + CHUNK_ROWS].ravel(), values[r:r + CHUNK_ROWS].ravel(), nodata)
+        return self
+
+    def add_cells(self, z, v, nodata=None):
+        # Flat zone ids and values of the same cells, zone 0 is skipped
+        ok = z > 0
+        if nodata is not None:
+            ok &= v != nodata
+        if v.dtype.kind == "f":
+            ok &= ~numpy.isnan(v)
+        z, v = z[ok], v[ok]
+        if not z.size:
+            return
+        out = (v < self.lo) | (v > self.hi)
+        if out.any():
+            self.outside += numpy.bincount(z[out].astype(numpy.int64), minlength=self.nzones)
+        b = numpy.clip(((v - self.lo) / self.width).astype(numpy.int64), 0, self.bins - 1)
+        key = z.astype(numpy.int64) * self.bins + b
+        self.counts += numpy.bincount(key, minlength=self.counts.size).reshape(self.counts.shape)
+        self.stats.add_cells(z, v)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.outside += other.outside
+        self.stats.merge(other.stats)
+        return self
+
+    def combine(self, groups, atoms, ngroups):
+        out = ZonalQuantiles(ngroups, self.lo, self.hi, self.bins)
+        numpy.add.at(out.counts, groups, self.counts[atoms])
+        numpy.add.at(out.outside, groups, self.outside[atoms])
+        out.stats = self.stats.combine(groups, atoms, ngroups)
+        return out
+
+    def quantiles(self, probs):
+        """(zones, len(probs)) values below which each fraction probs of a zone's cells lie.
+
+        E.g. probs numpy.linspace(0, 1, 11) of elevation give the hypsometric curve.
+        """
+        probs = numpy.asarray(probs, dtype=numpy.float64)
+        cum = numpy.cumsum(self.counts, axis=1)
+        n = cum[:, -1:]
+        out = numpy.empty((self.nzones, probs.size), dtype=numpy.float64)
+        for k, p in enumerate(probs):
+            target = p * n
+            b = numpy.minimum((cum < target).sum(axis=1), self.bins - 1)
+            rows = numpy.arange(self.nzones)
+            before = cum[rows, b] - self.counts[rows, b]
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                frac = numpy.clip((target[:, 0] - before) / self.counts[rows, b], 0.0, 1.0)
+            out[:, k] = self.lo + (b + numpy.nan_to_num(frac)) * self.width
+        # the exact extremes are better than the edges of the end bins
+        out = numpy.clip(out, self.stats.min[:, None], self.stats.max[:, None])
+        out[n[:, 0] == 0] = numpy.nan
+        return out
+
+    def result(self, probs=PROBS):
+        """dict of per-zone arrays: count, min, max, mean, one key per quantile of probs,
+        hypsometric ((mean - min) / (max - min), the hypsometric integral of elevation),
+        outside, the values outside [lo, hi], and error, the bound on the quantiles
+        (inf where outside is not 0)."""
+        out = self.stats.result()
+        q = self.quantiles([p for key, p in probs])
+        for k, (key, p) in enumerate(probs):
+            out[key] = q[:, k]
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            relief = out["max"] - out["min"]
+            out["hypsometric"] = numpy.where(relief > 0, (out["mean"] - out["min"]) / relief, numpy.nan)
+        out["outside"] = self.outside.copy()
+        out["error"] = numpy.where(self.outside == 0, self.width, numpy.inf)
+        return out
+
+
+def value_range(values, nodata=None):
+    # (lo, hi) of the valid values, the span of ZonalQuantiles bins over a raster
+    values = numpy.asarray(values)
+    if nodata is not None:
+        values = values[values != nodata]
+    if not values.size:
+        return 0.0, 1.0
+    # fmin and fmax skip NaN without a copy of the raster
+    lo, hi = float(numpy.fmin.reduce(values, axis=None)), float(numpy.fmax.reduce(values, axis=None))
+    if numpy.isnan(lo):
+        return 0.0, 1.0
+    return lo, hi
+
+
+def distribution(values, nodata=None, bins=BINS):
+    """ZonalQuantiles result of all valid cells of values as one zone, a dict of floats."""
+    lo, hi = value_range(values, nodata)
+    values = numpy.asarray(values)
+    acc = ZonalQuantiles(2, lo, hi, bins).add(numpy.ones(values.shape, dtype=numpy.int32), values, nodata)
+    return dict((key, float(numpy.ravel(value)[-1])) for key, value in acc.result().items())
+
+
+def zonal_stats(zones, values, nodata=None):
+    """Per-basin statistics of values over a ZoneGrid covering the same cells.
+
+    Returns a dict of arrays indexed by basin: count, sum, mean, min, max, std.
+    """
+    atoms = ZonalStats(zones.natoms).add(zones.grid, values, nodata)
+    groups, members = zones.pairs()
+    return atoms.combine(groups, members, zones.nbasins).result()
+
+
+def exact_sum(values):
+    # Sum of values, in int64 for integer data so it is exact whatever the order
+    values = numpy.asarray(values)
+    return values.sum(dtype=numpy.int64 if values.dtype.kind in "biu" else numpy.float64)
+
+
+def linear_trend(x, y):
+    """Least-squares slope of y against x for every column of y, NaN values left out.
+
+    y has one row per x (e.g. years x basins); columns with fewer than two values get NaN.
+    """
+    x = numpy.asarray(x, dtype=numpy.float64)[:, None]
+    y = numpy.asarray(y, dtype=numpy.float64)
+    ok = ~numpy.isnan(y)
+    n = ok.sum(axis=0)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        xm = (x * ok).sum(axis=0) / n
+        ym = numpy.where(ok, y, 0.0).sum(axis=0) / n
+        dx = numpy.where(ok, x - xm, 0.0)
+        slope = (dx * numpy.where(ok, y - ym, 0.0)).sum(axis=0) / (dx * dx).sum(axis=0)
+    slope[n < 2] = numpy.nan
+    return slope
+
+
+def zonal_quantiles(zones, values, lo, hi, bins=BINS, nodata=None):
+    """Per-basin distribution of values over a ZoneGrid, see ZonalQuantiles.result."""
+    atoms = ZonalQuantiles(zones.natoms, lo, hi, bins).add(zones.grid, values, nodata)
+    groups, members = zones.pairs()
+    return atoms.combine(groups, members, zones.nbasins).result()
+
+
+def zonal_histogram(zones, values, nclasses, nodata=None):
+    """Per-basin class counts of values over a ZoneGrid, an array of shape (basins, nclasses)."""
+    atoms = ZonalHistogram(zones.natoms, nclasses).add(zones.grid, values, nodata)
+    groups, members = zones.pairs()
+    return atoms.combine(groups, members, zones.nbasins).result()